@@ -0,0 +1,10 @@
+# coding=utf-8
+# LIFX protocol bridge support code for the Indigo plugin.
+#
+# The Indigo backend isn't exported here because it can only be imported inside the Indigo plugin host.
+
+from .backend import DeviceBackend, DeviceNotFound
+from .egress import EgressQueue
+from .engine import BridgeEngine
+from .memory_backend import InMemoryBackend
+from .zones import ZoneStripBackend
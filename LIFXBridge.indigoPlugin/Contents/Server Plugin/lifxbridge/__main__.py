@@ -0,0 +1,81 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Run the bridge engine standalone with synthetic in-memory devices, no Indigo needed:
+#
+#   cd "LIFXBridge.indigoPlugin/Contents/Server Plugin"
+#   python -m lifxbridge --devices 50 --latency 0.05 --port 56700
+####################
+
+import argparse
+import logging
+import threading
+
+from .engine import BridgeEngine, DEFAULT_LIFX_PORT
+from .memory_backend import InMemoryBackend
+from .profiling import MODES, MODE_CPROFILE
+from .workers import WorkerPool
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="lifxbridge", description="Run the LIFX bridge with synthetic devices")
+    parser.add_argument("--devices", type=int, default=10, help="number of synthetic devices to publish")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each set command takes")
+    parser.add_argument("--port", type=int, default=DEFAULT_LIFX_PORT, help="UDP port to listen on")
+    parser.add_argument("--bind", default="", help="address to bind to")
+    parser.add_argument("--warm-start", metavar="PATH", help="publish the devices saved in PATH at startup, and save them there")
+    parser.add_argument("--workers", type=int, default=0, help="answer from this many worker processes sharing the port")
+    parser.add_argument("--no-rate-limit", action="store_true", help="answer every client however fast it sends, e.g. for lifxbridge.loadgen")
+    parser.add_argument("--trace-slow", type=float, metavar="MS", help="trace requests and log any slower than MS milliseconds")
+    parser.add_argument("--profile", choices=MODES, help="profile the receive thread")
+    parser.add_argument("--profile-seconds", type=float, default=60.0, help="how long to profile for")
+    parser.add_argument("--debug", action="store_true", help="log every message")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO, format="%(asctime)s [%(levelname)8s] %(name)s: %(message)s")
+
+    engine = BridgeEngine(InMemoryBackend.synthetic(args.devices, args.latency), args.port, args.bind)
+    engine.limiter.enabled = not args.no_rate_limit
+    if args.trace_slow:
+        engine.tracer.slow_threshold = args.trace_slow / 1000.0
+        engine.tracer.enable()
+    if args.profile:
+        extension = "pstats" if args.profile == MODE_CPROFILE else "folded"
+        engine.profiler.request(args.profile, args.profile_seconds, f"profile.{extension}")
+    if args.warm_start and engine.warm_start(args.warm_start):
+        engine.schedule_refresh()
+    else:
+        engine.refresh()
+    if args.workers:
+        serve_workers(engine, args)
+        return
+    engine.open()
+    logging.getLogger("Plugin.Bridge").info(f"Publishing {args.devices} devices on port {engine.port}")
+    try:
+        engine.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        engine.save_warm_start()
+        engine.close()
+
+
+########################################
+# The engine here only holds the devices and runs the commands; the workers answer the clients
+########################################
+def serve_workers(engine, args):
+    pool = WorkerPool(engine, args.workers, logging.DEBUG if args.debug else logging.INFO)
+    pool.start()
+    logging.getLogger("Plugin.Bridge").info(f"Publishing {args.devices} devices on port {pool.port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pool.stop()
+        engine.save_warm_start()
+        engine.close()
+
+
+if __name__ == "__main__":
+    main()
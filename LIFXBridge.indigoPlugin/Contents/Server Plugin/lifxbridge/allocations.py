@@ -0,0 +1,141 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Allocation accounting per message type, using tracemalloc.
+#
+# While tracking is on, every request the receive thread handles is measured in two stages: decode
+# (unpack_lifx_message) and respond (the handler, including building and packing the replies).  For every
+# request the tracker records the net change in traced memory across each stage, which is cheap.  Every
+# sample_every'th request it also takes a tracemalloc snapshot between stages and diffs them, which gives
+# the object counts and the source lines the memory was allocated from.  The numbers are net: memory that
+# was allocated and freed again inside a stage doesn't show up, and what's left is what can make the
+# process grow.
+#
+# tracemalloc slows every allocation in the process while it's running, and the traced memory total includes
+# other threads, so this is for finding where memory goes rather than for leaving on.
+####################
+
+import linecache
+import os
+import threading
+import tracemalloc
+from collections import Counter
+
+DEFAULT_SAMPLE_EVERY = 20           # take snapshots for one request in this many
+TOP_SITES = 15                      # allocation sites listed in the report
+
+STAGES = ("decode", "respond")
+
+
+class AllocationRequest(object):
+    __slots__ = ("name", "memory", "snapshot")
+
+    def __init__(self, name, sampled):
+        self.name = name
+        self.memory = tracemalloc.get_traced_memory()[0]
+        self.snapshot = take_snapshot() if sampled else None
+
+
+class TypeStats(object):
+    __slots__ = ("requests", "sampled", "bytes", "objects")
+
+    def __init__(self):
+        self.requests = 0
+        self.sampled = 0
+        self.bytes = Counter()              # stage -> net bytes, every request
+        self.objects = Counter()            # stage -> net objects, sampled requests
+
+
+def take_snapshot():
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+        tracemalloc.Filter(False, linecache.__file__),
+    ))
+
+
+class AllocationTracker(object):
+
+    def __init__(self, sample_every=DEFAULT_SAMPLE_EVERY):
+        self.sample_every = sample_every
+        self.enabled = False
+        self.started_tracing = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+            self.types = dict()             # message type name -> TypeStats
+            self.sites = dict()             # (file, line) -> [net bytes, net objects]
+
+    ########################################
+    # Turn tracking on or off.  tracemalloc is only stopped again if this tracker started it.
+    ########################################
+    def enable(self, enabled=True):
+        if enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracing = True
+        elif not enabled and self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+        self.enabled = enabled
+
+    ########################################
+    # Start measuring a request.  Returns None if tracking is off.
+    ########################################
+    def begin(self, name):
+        if not self.enabled:
+            return None
+        self.count += 1
+        return AllocationRequest(name, self.count % self.sample_every == 0)
+
+    ########################################
+    # Close a stage of request: charge the memory change since the last stage (or begin) to it.
+    ########################################
+    def stage(self, request, stage):
+        memory = tracemalloc.get_traced_memory()[0]
+        snapshot = take_snapshot() if request.snapshot else None
+        with self.lock:
+            stats = self.types.get(request.name)
+            if stats is None:
+                stats = self.types[request.name] = TypeStats()
+            stats.bytes[stage] += memory - request.memory
+            if stage == STAGES[0]:
+                stats.requests += 1
+            if snapshot:
+                if stage == STAGES[0]:
+                    stats.sampled += 1
+                for diff in snapshot.compare_to(request.snapshot, "lineno"):
+                    if not diff.size_diff and not diff.count_diff:
+                        continue
+                    frame = diff.traceback[0]
+                    entry = self.sites.setdefault((frame.filename, frame.lineno), [0, 0])
+                    entry[0] += diff.size_diff
+                    entry[1] += diff.count_diff
+                    stats.objects[stage] += diff.count_diff
+        request.memory = memory
+        request.snapshot = snapshot
+
+    ########################################
+    # Per message type averages and the top allocation sites, for the log
+    ########################################
+    def report(self, top=TOP_SITES):
+        with self.lock:
+            types = {name: stats for name, stats in self.types.items()}
+            sites = sorted(self.sites.items(), key=lambda item: item[1][0], reverse=True)[:top]
+        if not types:
+            return ["No allocations recorded" + ("" if self.enabled else ", allocation tracking is turned off")]
+
+        lines = [f"Net allocations per request ({self.count} requests, snapshots of 1 in {self.sample_every}):",
+                 f"    {'type':<18} {'requests':>8} {'decode B':>9} {'respond B':>10} {'sampled':>8} {'decode obj':>11} {'respond obj':>12}"]
+        for name, stats in sorted(types.items()):
+            average = [stats.bytes[stage] / stats.requests for stage in STAGES]
+            objects = [stats.objects[stage] / stats.sampled if stats.sampled else 0.0 for stage in STAGES]
+            lines.append(f"    {name:<18} {stats.requests:>8} {average[0]:>9.0f} {average[1]:>10.0f} {stats.sampled:>8} {objects[0]:>11.1f} {objects[1]:>12.1f}")
+
+        lines.append("Top allocation sites in sampled requests (net bytes, net objects):")
+        for (filename, lineno), (size, count) in sites:
+            source = linecache.getline(filename, lineno).strip()
+            lines.append(f"    {size:>10} {count:>8}  {os.path.basename(filename)}:{lineno}  {source}")
+        return lines
@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# The interface between the bridge engine and whatever owns the devices it publishes.
+#
+# The engine only speaks LIFX.  Everything it needs to know about the real devices (which ones are published,
+# their power and color, and how to change them) comes through a DeviceBackend.  The plugin uses the Indigo
+# backend; the in-memory backend lets the engine run, and be load tested, without Indigo.
+#
+# All levels are in LIFX units: power is 0 or 65535, and hue, saturation and brightness are 0-65535.
+####################
+
+import re
+
+PRODUCT_WHITE_800 = 10      # White 800 (Low Voltage)
+PRODUCT_COLOR_1000 = 22     # Color 1000
+PRODUCT_LIFX_Z = 32         # LIFX Z (multizone strip)
+
+
+class DeviceNotFound(KeyError):
+    pass
+
+
+########################################
+# Fake MAC for a device, derived from its ID.  00:16 followed by the ID as four hex bytes.
+########################################
+def fakeMAC(deviceID):
+    hexString = format(deviceID, '08x')
+    macString = ':'.join(re.findall('..', hexString))
+    return f"00:16:{macString}"
+
+
+class DeviceBackend(object):
+
+    ########################################
+    # Returns a list of PublishedDevice entries for every device that should be published
+    ########################################
+    def published_devices(self):
+        raise NotImplementedError
+
+    ########################################
+    # Device state.  Each of these raises DeviceNotFound if the device no longer exists.
+    ########################################
+    def get_power(self, devID):
+        raise NotImplementedError
+
+    def get_brightness(self, devID):
+        raise NotImplementedError
+
+    # returns (hue, saturation, brightness, kelvin)
+    def get_color(self, devID):
+        raise NotImplementedError
+
+    # returns the LIFX product ID the device should be reported as
+    def get_product(self, devID):
+        raise NotImplementedError
+
+    # returns the (hue, saturation, brightness, kelvin) of each zone, or None if the device isn't multizone
+    def get_zones(self, devID):
+        return None
+
+    # IDs of the devices in a folder, in name order.  Backends without folders have none.
+    def folder_devices(self, folderID):
+        return []
+
+    ########################################
+    # Device commands.  Each of these raises DeviceNotFound if the device no longer exists.
+    ########################################
+    def set_power(self, devID, turnOn):
+        raise NotImplementedError
+
+    def set_color(self, devID, hue, saturation, brightness, kelvin):
+        raise NotImplementedError
+
+    # color zones start to end (inclusive) of a multizone device.  apply is the MultiZoneSetColorZones field.
+    # Fails (returns False) for a device that isn't multizone.
+    def set_zones(self, devID, start, end, color, apply):
+        return False
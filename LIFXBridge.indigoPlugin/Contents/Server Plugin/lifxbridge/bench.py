@@ -0,0 +1,335 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Loopback benchmark for the bridge engine.
+#
+# Starts a BridgeEngine on 127.0.0.1 with synthetic in-memory devices and drives it with scripted client
+# workloads.  For every workload, and every message type in it, reports requests/sec, reply latency
+# percentiles (send to last expected reply), dropped requests and engine CPU per request.  Results can be
+# saved as a JSON baseline and later runs compared against it:
+#
+#   cd "LIFXBridge.indigoPlugin/Contents/Server Plugin"
+#   python -m lifxbridge.bench --devices 50 --save baseline.json
+#   python -m lifxbridge.bench --devices 50 --compare baseline.json
+#
+# CPU is the engine thread's own CPU time, so the client's work isn't counted.  Work done on the fan-out
+# pool (tagged set commands) isn't counted either.
+####################
+
+import argparse
+import json
+import logging
+import platform
+import random
+import select
+import socket
+import struct
+import sys
+import time
+
+from lifxlan.message import BROADCAST_MAC
+from lifxlan.msgtypes import *
+
+from .engine import BridgeEngine
+from .memory_backend import InMemoryBackend
+from .router import MSG_NAMES, peek_header
+
+DEFAULT_WORKLOADS = ("discovery", "poll", "setpower", "storm", "mixed")
+
+_source_seq = struct.Struct("<I").pack_into     # source at offset 4, seq is the single byte at offset 23
+
+
+class BenchEngine(BridgeEngine):
+
+    ########################################
+    # The engine with CPU accounting.  serve_once() covers everything the engine thread does (decode,
+    # dispatch, backend calls and egress); dispatch() is also charged to the request's message type.
+    ########################################
+    def __init__(self, *args, **kwargs):
+        BridgeEngine.__init__(self, *args, **kwargs)
+        self.reset_cpu()
+
+    def reset_cpu(self):
+        self.cpu_total = 0.0
+        self.cpu_by_type = dict()
+
+    def serve_once(self):
+        start = time.thread_time()
+        BridgeEngine.serve_once(self)
+        self.cpu_total += time.thread_time() - start
+
+    def dispatch(self, header, data, addr):
+        start = time.thread_time()
+        BridgeEngine.dispatch(self, header, data, addr)
+        self.cpu_by_type[header.msg_type] = self.cpu_by_type.get(header.msg_type, 0.0) + time.thread_time() - start
+
+
+class Template(object):
+
+    ########################################
+    # A pre-packed request.  Only the source and sequence number change from one send to the next, so they
+    # are patched into a copy of the packed bytes rather than packing a new message every time.
+    #
+    #   expected is the number of replies a request gets when nothing is lost
+    ########################################
+    def __init__(self, message, expected):
+        self.msg_type = message.message_type
+        self.packed = bytes(message.packed_message)
+        self.expected = expected
+
+    def packet(self, source, seq):
+        data = bytearray(self.packed)
+        _source_seq(data, 4, source)
+        data[23] = seq
+        return data
+
+
+########################################
+# Workloads.  Each returns a list of (weight, Template) to draw requests from.
+########################################
+def build_workload(name, macs):
+    count = len(macs)
+    if name == "discovery":     # a discovery storm, every client looking for bulbs at once
+        return [(1, Template(GetService(BROADCAST_MAC, 0, 0, {}, False, False), count))]
+    if name == "poll":          # apps polling the state of every bulb
+        return [(1, Template(LightGet(BROADCAST_MAC, 0, 0, {}, False, False), count))]
+    if name == "setpower":      # bursts of on/off commands, one bulb at a time
+        return [(1, Template(SetPower(mac, 0, 0, {"power_level": level}, True, False), 1))
+                for mac in macs for level in (0, 65535)]
+    if name == "storm":         # on/off commands in the middle of a discovery storm
+        templates = [(9, Template(GetService(BROADCAST_MAC, 0, 0, {}, False, False), count))]
+        templates += [(1 / count, Template(SetPower(mac, 0, 0, {"power_level": 65535}, True, False), 1)) for mac in macs]
+        return templates
+    if name == "mixed":
+        templates = [(10, Template(GetService(BROADCAST_MAC, 0, 0, {}, False, False), count)),
+                     (20, Template(LightGet(BROADCAST_MAC, 0, 0, {}, False, False), count))]
+        for mac in macs:
+            templates.append((40 / count, Template(LightGet(mac, 0, 0, {}, False, False), 1)))
+            templates.append((20 / count, Template(SetPower(mac, 0, 0, {"power_level": 65535}, True, False), 1)))
+            # LightSetColor always gets a LightState back, as well as the Ack
+            color = {"color": (0, 0, 32768, 3500), "duration": 0}
+            templates.append((10 / count, Template(LightSetColor(mac, 0, 0, color, True, False), 2)))
+        return templates
+    raise ValueError(f"unknown workload: {name}")
+
+
+def percentile(ordered, pct):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+class Client(object):
+
+    def __init__(self, port, window, timeout):
+        self.addr = ("127.0.0.1", port)
+        self.window = window
+        self.timeout = timeout
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.sock.bind(("127.0.0.1", 0))
+        self.sock.setblocking(False)
+        self.source = random.randint(2, 0xFFFFFFFF)
+        self.seq = 0
+
+    ########################################
+    # The engine ignores a sequence number it saw in the last few requests, and 0 is special, so sequence
+    # numbers run 1-255 and skip any that are still outstanding.
+    ########################################
+    def next_seq(self, pending):
+        while True:
+            self.seq = self.seq % 255 + 1
+            if self.seq not in pending:
+                return self.seq
+
+    ########################################
+    # Send count requests drawn from templates, keeping up to window of them outstanding.  A request is done
+    # when all of its expected replies have arrived; one that's still short after timeout seconds is dropped.
+    ########################################
+    def run(self, templates, count, rng):
+        weights = [weight for weight, _ in templates]
+        choices = [template for _, template in templates]
+        pending = dict()        # seq -> [template, sent_at, replies]
+        samples = dict()        # msg_type -> list of latencies
+        dropped = dict()        # msg_type -> requests that timed out
+        missing = dict()        # msg_type -> replies that never came
+        sent = 0
+
+        start = time.perf_counter()
+        while sent < count or pending:
+            while sent < count and len(pending) < self.window:
+                template = rng.choices(choices, weights)[0]
+                seq = self.next_seq(pending)
+                pending[seq] = [template, time.perf_counter(), 0]
+                self.sock.sendto(template.packet(self.source, seq), self.addr)
+                sent += 1
+
+            readable, _, _ = select.select([self.sock], [], [], 0.005)
+            now = time.perf_counter()
+            while readable:
+                try:
+                    data = self.sock.recv(2048)
+                except BlockingIOError:
+                    break
+                now = time.perf_counter()
+                header = peek_header(data)
+                if header is None or header.source != self.source or header.seq not in pending:
+                    continue
+                entry = pending[header.seq]
+                entry[2] += 1
+                if entry[2] >= entry[0].expected:
+                    del pending[header.seq]
+                    samples.setdefault(entry[0].msg_type, []).append(now - entry[1])
+
+            for seq, (template, sent_at, replies) in list(pending.items()):
+                if now - sent_at > self.timeout:
+                    del pending[seq]
+                    dropped[template.msg_type] = dropped.get(template.msg_type, 0) + 1
+                    missing[template.msg_type] = missing.get(template.msg_type, 0) + template.expected - replies
+        elapsed = time.perf_counter() - start
+        return elapsed, samples, dropped, missing
+
+    def close(self):
+        self.sock.close()
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000.0, 3)
+
+
+def summarize(requests, latencies, dropped, missing, elapsed, cpu):
+    ordered = sorted(latencies)
+    return {
+        "requests": requests,
+        "completed": len(ordered),
+        "dropped": dropped,
+        "missing_replies": missing,
+        "requests_per_sec": round(len(ordered) / elapsed, 1) if elapsed else None,
+        "p50_ms": ms(percentile(ordered, 50)),
+        "p95_ms": ms(percentile(ordered, 95)),
+        "p99_ms": ms(percentile(ordered, 99)),
+        "cpu_us_per_request": round(cpu / requests * 1e6, 1) if requests else None,
+    }
+
+
+def run_workload(engine, name, macs, args):
+    rng = random.Random(args.seed)
+    templates = build_workload(name, macs)
+    client = Client(engine.port, args.window, args.timeout)
+    try:
+        # a few requests to warm up caches before anything is measured
+        client.run(templates, min(20, args.requests), rng)
+        time.sleep(0.05)
+        engine.reset_cpu()
+        elapsed, samples, dropped, missing = client.run(templates, args.requests, rng)
+    finally:
+        client.close()
+    time.sleep(0.05)    # let the engine finish with anything left in its queue
+
+    result = {"types": dict()}
+    all_latencies = []
+    for msg_type in set(samples) | set(dropped):
+        latencies = samples.get(msg_type, [])
+        all_latencies.extend(latencies)
+        requests = len(latencies) + dropped.get(msg_type, 0)
+        result["types"][MSG_NAMES[msg_type]] = summarize(requests, latencies, dropped.get(msg_type, 0), missing.get(msg_type, 0),
+                                                         elapsed, engine.cpu_by_type.get(msg_type, 0.0))
+    result.update(summarize(args.requests, all_latencies, sum(dropped.values()), sum(missing.values()), elapsed, engine.cpu_total))
+    result["elapsed_sec"] = round(elapsed, 3)
+    return result
+
+
+def print_results(results):
+    print(f"{'workload':<12} {'type':<16} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'drops':>6} {'cpu us/req':>10}")
+    def fmt(value):
+        return "-" if value is None else value
+
+    for name, result in results["workloads"].items():
+        rows = [("all", result)] + sorted(result["types"].items())
+        for label, row in rows:
+            print(f"{name:<12} {label:<16} {fmt(row['requests_per_sec']):>9} {fmt(row['p50_ms']):>8} {fmt(row['p95_ms']):>8} "
+                  f"{fmt(row['p99_ms']):>8} {row['dropped']:>6} {fmt(row['cpu_us_per_request']):>10}")
+
+
+########################################
+# Compare a run against a saved baseline.  Returns the list of regressions bigger than tolerance (a fraction).
+########################################
+def compare(results, baseline, tolerance):
+    checks = (("requests_per_sec", -1), ("p95_ms", 1), ("cpu_us_per_request", 1))    # direction that's worse
+    regressions = []
+    print(f"\nCompared with baseline from {baseline.get('timestamp', 'unknown')}:")
+    for name, result in results["workloads"].items():
+        base = baseline.get("workloads", {}).get(name)
+        if not base:
+            continue
+        rows = [("all", result, base)] + [(label, row, base["types"][label]) for label, row in sorted(result["types"].items()) if label in base["types"]]
+        for label, row, base_row in rows:
+            for key, worse in checks:
+                new, old = row.get(key), base_row.get(key)
+                if not new or not old:
+                    continue
+                change = (new - old) / old
+                flag = ""
+                if change * worse > tolerance:
+                    flag = "  REGRESSION"
+                    regressions.append((name, label, key, change))
+                print(f"  {name:<12} {label:<16} {key:<20} {old:>10} -> {new:<10} {change:+.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="lifxbridge.bench", description="Loopback benchmark for the LIFX bridge engine")
+    parser.add_argument("--devices", type=int, default=20, help="number of synthetic published devices")
+    parser.add_argument("--requests", type=int, default=500, help="requests per workload")
+    parser.add_argument("--window", type=int, default=8, help="requests outstanding at once")
+    parser.add_argument("--timeout", type=float, default=1.0, help="seconds before an unanswered request counts as dropped")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each backend set command takes")
+    parser.add_argument("--workloads", default=",".join(DEFAULT_WORKLOADS), help="comma separated list of workloads")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the request mix")
+    parser.add_argument("--save", metavar="FILE", help="write the results to FILE as a JSON baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with a JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="fractional change that counts as a regression")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    backend = InMemoryBackend.synthetic(args.devices, args.latency)
+    engine = BenchEngine(backend, port=0, bind_addr="127.0.0.1")
+    engine.limiter.enabled = False      # the workloads come from one client, far faster than any real one
+    engine.open()
+    engine.refresh()
+    macs = [device.mac for device in engine.registry.snapshot]
+    engine.start()
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {"devices": args.devices, "requests": args.requests, "window": args.window, "latency": args.latency, "seed": args.seed},
+        "workloads": dict(),
+    }
+    try:
+        for name in args.workloads.split(","):
+            results["workloads"][name] = run_workload(engine, name.strip(), macs, args)
+    finally:
+        engine.stop()
+        engine.close()
+
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "w") as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("config") != results["config"]:
+            print(f"\nWarning: baseline config {baseline.get('config')} differs from this run")
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
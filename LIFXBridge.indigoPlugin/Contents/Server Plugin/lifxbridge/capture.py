@@ -0,0 +1,204 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Raw packet capture for the bridge.
+#
+# Every datagram the bridge receives or sends is appended to a fixed-size ring as (time, source, destination,
+# bytes).  That's one tuple and a deque append per packet, so the capture can stay on all the time, and the
+# last few thousand packets of an incident are there to be saved when someone notices.  save() writes the
+# ring as a standard pcap file (raw IPv4 link type) that Wireshark or tcpdump can read.  The engine records
+# requests as it handles them, so they're in the order they were answered, which isn't always the order they
+# arrived in.
+#
+# read_pcap() goes the other way, for the replay tool.  It reads our own files as well as tcpdump or
+# Wireshark captures (Ethernet, Linux cooked, BSD loopback or raw IP), and keeps only the UDP datagrams.
+####################
+
+import collections
+import socket
+import struct
+import time
+
+DEFAULT_CAPTURE_SIZE = 8192         # datagrams kept, inbound and outbound together
+MAX_ARRIVALS = 4096                 # clients whose local address is remembered
+
+PCAP_MAGIC = 0xa1b2c3d4             # microsecond timestamps
+PCAP_MAGIC_NS = 0xa1b23c4d          # nanosecond timestamps
+PCAPNG_MAGIC = 0x0a0d0d0a
+PCAP_VERSION = (2, 4)
+PCAP_SNAPLEN = 65535
+
+LINKTYPE_NULL = 0                   # BSD loopback, 4 byte address family in the capturing host's byte order
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101                  # each record starts with an IPv4 header
+LINKTYPE_LOOP = 108                 # OpenBSD loopback, address family in network byte order
+LINKTYPE_LINUX_SLL = 113            # Linux "any" interface
+LINKTYPE_IPV4 = 228
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_VLAN = 0x8100
+
+_pcap_header = struct.Struct("<IHHiIII")
+_record_header = struct.Struct("<IIII")
+_ipv4_header = struct.Struct("!BBHHHBBH4s4s")
+_udp_header = struct.Struct("!HHHH")
+
+
+class CaptureRing(object):
+
+    ########################################
+    #   local is the bridge's own (address, port), used as the other end of every captured datagram unless
+    #   arrived() has said which address a client reached
+    ########################################
+    def __init__(self, size=DEFAULT_CAPTURE_SIZE, local=("0.0.0.0", 0)):
+        self.ring = collections.deque(maxlen=size)
+        self.local = local
+        self.arrivals = dict()          # client (ip, port) -> local address its last datagram arrived on
+        self.captured = 0
+
+    ########################################
+    # A datagram from addr arrived on the local address ip.  The client's requests, and the replies that go
+    # back to it, are recorded with that address, which matters when the bridge listens on every interface.
+    ########################################
+    def arrived(self, addr, ip):
+        if len(self.arrivals) >= MAX_ARRIVALS and addr not in self.arrivals:
+            self.arrivals.clear()
+        self.arrivals[addr] = ip
+
+    def local_for(self, addr):
+        ip = self.arrivals.get(addr)
+        return self.local if ip is None else (ip, self.local[1])
+
+    ########################################
+    # The recording calls.  deque.append is atomic, so these are safe from any thread without a lock.
+    ########################################
+    def inbound(self, data, addr):
+        self.ring.append((time.time(), addr, self.local_for(addr), data))
+        self.captured += 1
+
+    def outbound(self, data, addr):
+        self.ring.append((time.time(), self.local_for(addr), addr, data))
+        self.captured += 1
+
+    def __len__(self):
+        return len(self.ring)
+
+    ########################################
+    # Copy of the ring, oldest first.  list() copies a deque without letting other threads in, so this is
+    # a consistent view even while packets are being recorded.
+    ########################################
+    def records(self):
+        return list(self.ring)
+
+    def clear(self):
+        self.ring.clear()
+
+    def resize(self, size):
+        self.ring = collections.deque(self.ring, maxlen=size)
+
+    def save(self, path):
+        return write_pcap(path, self.records())
+
+
+########################################
+# Build the IPv4 and UDP headers for one captured datagram.  The UDP checksum is left at zero, which IPv4
+# allows, and the IPv4 header checksum is computed so tools don't flag every packet.
+########################################
+def ip_udp_packet(src, dst, payload):
+    udp = _udp_header.pack(src[1], dst[1], 8 + len(payload), 0)
+    header = _ipv4_header.pack(0x45, 0, 20 + len(udp) + len(payload), 0, 0x4000, 64, socket.IPPROTO_UDP, 0,
+                               socket.inet_aton(src[0] or "0.0.0.0"), socket.inet_aton(dst[0] or "0.0.0.0"))
+    words = struct.unpack("!10H", header)
+    checksum = sum(words)
+    checksum = (checksum & 0xffff) + (checksum >> 16)
+    checksum = (checksum & 0xffff) + (checksum >> 16)
+    header = header[:10] + struct.pack("!H", ~checksum & 0xffff) + header[12:]
+    return header + udp + bytes(payload)
+
+
+########################################
+# Write (time, source, destination, bytes) records to a pcap file.  Returns the number of records written.
+########################################
+def write_pcap(path, records):
+    with open(path, "wb") as out:
+        out.write(_pcap_header.pack(PCAP_MAGIC, PCAP_VERSION[0], PCAP_VERSION[1], 0, 0, PCAP_SNAPLEN, LINKTYPE_RAW))
+        for timestamp, src, dst, payload in records:
+            packet = ip_udp_packet(src, dst, payload)
+            seconds = int(timestamp)
+            out.write(_record_header.pack(seconds, int((timestamp - seconds) * 1000000), len(packet), len(packet)))
+            out.write(packet)
+    return len(records)
+
+
+########################################
+# Offset of the IPv4 header within a captured frame, or None if the frame isn't IPv4.
+########################################
+def ip_offset(linktype, frame):
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        return 0
+    if linktype in (LINKTYPE_NULL, LINKTYPE_LOOP):
+        return 4 if frame[:4] in (b"\x02\x00\x00\x00", b"\x00\x00\x00\x02") else None    # AF_INET is 2 everywhere
+    if linktype == LINKTYPE_ETHERNET:
+        offset, ethertype = 14, struct.unpack_from("!H", frame, 12)[0]
+        while ethertype == ETHERTYPE_VLAN:
+            offset, ethertype = offset + 4, struct.unpack_from("!H", frame, offset + 2)[0]
+        return offset if ethertype == ETHERTYPE_IPV4 else None
+    if linktype == LINKTYPE_LINUX_SLL:
+        return 16 if struct.unpack_from("!H", frame, 14)[0] == ETHERTYPE_IPV4 else None
+    raise ValueError(f"unsupported pcap link type {linktype}")
+
+
+########################################
+# The (source, destination, payload) of a UDP datagram in an IPv4 packet, or None for anything else,
+# including fragments.
+########################################
+def udp_datagram(packet):
+    if len(packet) < 28 or packet[0] >> 4 != 4 or packet[9] != socket.IPPROTO_UDP:
+        return None
+    if struct.unpack_from("!H", packet, 6)[0] & 0x3fff:
+        return None
+    header_len = (packet[0] & 0x0f) * 4
+    sport, dport, length, _ = _udp_header.unpack_from(packet, header_len)
+    payload = packet[header_len + 8:header_len + length]
+    src = (socket.inet_ntoa(packet[12:16]), sport)
+    dst = (socket.inet_ntoa(packet[16:20]), dport)
+    return src, dst, bytes(payload)
+
+
+########################################
+# Read a pcap file into (time, source, destination, bytes) records, the same shape CaptureRing keeps.
+# Anything that isn't a complete UDP datagram over IPv4 is skipped.
+########################################
+def read_pcap(path):
+    records = []
+    with open(path, "rb") as capture:
+        header = capture.read(_pcap_header.size)
+        if len(header) < _pcap_header.size:
+            raise ValueError(f"{path} is too short to be a pcap file")
+        for endian in "<>":
+            magic = struct.unpack(endian + "I", header[:4])[0]
+            if magic in (PCAP_MAGIC, PCAP_MAGIC_NS):
+                break
+        else:
+            if magic == PCAPNG_MAGIC:
+                raise ValueError(f"{path} is pcapng, save it from Wireshark as pcap instead")
+            raise ValueError(f"{path} is not a pcap file")
+        linktype = struct.unpack(endian + "I", header[20:24])[0] & 0x0fffffff
+        divisor = 1e9 if magic == PCAP_MAGIC_NS else 1e6
+        record_header = struct.Struct(endian + "IIII")
+
+        while True:
+            chunk = capture.read(record_header.size)
+            if len(chunk) < record_header.size:
+                break
+            seconds, fraction, included, _ = record_header.unpack(chunk)
+            frame = capture.read(included)
+            if len(frame) < included:
+                break       # truncated by a capture that was cut off mid-write
+            offset = ip_offset(linktype, frame)
+            if offset is None:
+                continue
+            datagram = udp_datagram(frame[offset:])
+            if datagram is not None:
+                records.append((seconds + fraction / divisor,) + datagram)
+    return records
@@ -0,0 +1,55 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Coalesce bursts of calls to an expensive function.
+#
+# trigger() runs the function on a background timer, at most once per window.  Triggers that arrive while a
+# run is already scheduled are folded into it, and a trigger that arrives shortly after a run is deferred
+# until the window has passed, so a burst of triggers costs at most one immediate run and one trailing run.
+####################
+
+import logging
+import threading
+import time
+
+
+class Debouncer(object):
+
+    def __init__(self, window, func, name="debounce"):
+        self.logger = logging.getLogger("Plugin.Debouncer")
+        self.window = window
+        self.func = func
+        self.name = name
+        self.lock = threading.Lock()
+        self.timer = None
+        self.last_run = 0.0
+        self.coalesced = 0
+
+    def trigger(self):
+        with self.lock:
+            if self.timer:
+                self.coalesced += 1
+                return
+            delay = max(0.0, self.last_run + self.window - time.monotonic())
+            self.timer = threading.Timer(delay, self._run)
+            self.timer.name = self.name
+            self.timer.daemon = True
+            self.timer.start()
+
+    def cancel(self):
+        with self.lock:
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+
+    def _run(self):
+        with self.lock:
+            self.timer = None
+            self.last_run = time.monotonic()
+            coalesced, self.coalesced = self.coalesced, 0
+        if coalesced:
+            self.logger.debug(f"{self.name}: {coalesced} requests coalesced")
+        try:
+            self.func()
+        except Exception as err:
+            self.logger.exception(f"{self.name} failed: {err}")
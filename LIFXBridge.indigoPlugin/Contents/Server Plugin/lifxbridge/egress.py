@@ -0,0 +1,125 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Paced egress queue for bridge replies.
+#
+# Replies are queued on one of two lanes.  The priority lane holds acks and replies to set commands and is
+# always drained first.  The bulk lane holds discovery and tagged-query replies, which can be hundreds of
+# datagrams for a single request.  The bulk lane is drained round-robin across destinations, with a limit on
+# how many datagrams each destination gets per tick, and each tick is capped by a packet and byte budget so
+# a large inventory is spread over several ticks instead of overrunning the client's receive buffer.
+#
+# The engine calls flush() as often as it likes, after every request it handles.  The priority lane goes out
+# on every call, but the bulk lane only gets its budget once per tick of real time, however many calls that is.
+####################
+
+import logging
+import socket
+import threading
+import time
+from collections import OrderedDict, deque
+
+DEFAULT_TICK = 0.01                 # seconds between flushes while anything is queued
+DEFAULT_PACKETS_PER_TICK = 32       # total datagrams sent per flush, both lanes
+DEFAULT_BYTES_PER_TICK = 8192       # total bytes sent per flush, both lanes
+DEFAULT_DEST_PACKETS_PER_TICK = 8   # bulk datagrams sent to any one destination per flush
+DEFAULT_MAX_QUEUED = 4096           # bulk datagrams held before new ones are dropped
+
+
+class EgressQueue(object):
+
+    def __init__(self, sock, tick=DEFAULT_TICK, packets_per_tick=DEFAULT_PACKETS_PER_TICK, bytes_per_tick=DEFAULT_BYTES_PER_TICK,
+                 dest_packets_per_tick=DEFAULT_DEST_PACKETS_PER_TICK, max_queued=DEFAULT_MAX_QUEUED, capture=None):
+        self.logger = logging.getLogger("Plugin.EgressQueue")
+        self.sock = sock
+        self.tick = tick
+        self.packets_per_tick = packets_per_tick
+        self.bytes_per_tick = bytes_per_tick
+        self.dest_packets_per_tick = dest_packets_per_tick
+        self.max_queued = max_queued
+        self.capture = capture          # CaptureRing that records every datagram actually sent
+
+        self.lock = threading.Lock()
+        self.priority = deque()         # (data, addr)
+        self.bulk = OrderedDict()       # addr -> deque of data, in round-robin order
+        self.bulk_count = 0
+        self.next_tick = 0.0            # monotonic time the bulk lane gets its next budget
+
+        self.sent = 0
+        self.dropped = 0
+
+    ########################################
+    # Queue a datagram for addr.  Priority datagrams go ahead of everything on the bulk lane.
+    ########################################
+    def send(self, data, addr, priority=False):
+        with self.lock:
+            if priority:
+                self.priority.append((data, addr))
+                return
+            if self.bulk_count >= self.max_queued:
+                self.dropped += 1
+                return
+            queue = self.bulk.get(addr)
+            if queue is None:
+                queue = self.bulk[addr] = deque()
+            queue.append(data)
+            self.bulk_count += 1
+
+    def pending(self):
+        return len(self.priority) + self.bulk_count
+
+    ########################################
+    # Send the priority lane, and the bulk lane up to one tick's budget if a tick has gone by since it was last
+    # sent.  Returns the number of datagrams sent.
+    ########################################
+    def flush(self):
+        with self.lock:
+            packets = 0
+            nbytes = 0
+
+            while self.priority:
+                data, addr = self.priority.popleft()
+                self._sendto(data, addr)
+                packets += 1
+                nbytes += len(data)
+
+            if not self.bulk:
+                return packets
+            now = time.monotonic()
+            if now < self.next_tick:
+                return packets
+            self.next_tick = now + self.tick
+
+            dest_sent = dict()
+            while self.bulk and packets < self.packets_per_tick and nbytes < self.bytes_per_tick:
+                addr, queue = next(iter(self.bulk.items()))
+                if dest_sent.get(addr, 0) >= self.dest_packets_per_tick:
+                    break       # every remaining destination has used its share for this tick
+                data = queue.popleft()
+                self.bulk_count -= 1
+                self._sendto(data, addr)
+                packets += 1
+                nbytes += len(data)
+                dest_sent[addr] = dest_sent.get(addr, 0) + 1
+                if queue:
+                    self.bulk.move_to_end(addr)
+                else:
+                    del self.bulk[addr]
+
+            return packets
+
+    def clear(self):
+        with self.lock:
+            self.priority.clear()
+            self.bulk.clear()
+            self.bulk_count = 0
+
+    def _sendto(self, data, addr):
+        try:
+            self.sock.sendto(data, addr)
+            self.sent += 1
+            if self.capture is not None:
+                self.capture.outbound(data, addr)
+        except socket.error as err:
+            self.dropped += 1
+            self.logger.warning(f"sendto {addr[0]}:{addr[1]} failed: {err}")
@@ -0,0 +1,101 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Fast reply encoding with struct.
+#
+# lifxlan builds every message bit by bit with bitstring, which is most of the cost of answering a discovery
+# broadcast: one StateService per published device.  The replies that only depend on the device's registry
+# entry (StateService, StateLabel, StateLocation, StateGroup, and their Acks) are packed here instead, from
+# parts of the payload that are encoded once per device when the registry is built (EncodedDevice).  The
+# bytes are the same as lifxlan's, except that labels are always exactly 32 bytes; lifxlan pads by
+# characters, so it sends a longer payload for labels over 32 characters or with multi-byte characters.  A
+# label that's too long is cut at a character boundary, so clients can always decode it.
+####################
+
+import struct
+from collections import namedtuple
+
+from lifxlan.message import BROADCAST_MAC, HEADER_SIZE_BYTES
+from lifxlan.msgtypes import MSG_IDS, Acknowledgement, StateService, StateLabel, StateLocation, StateGroup
+
+# size, flags (origin, tagged, addressable, protocol), source, target (MAC and two zero bytes), reserved,
+# ack/response flags, sequence, reserved, message type, reserved
+HEADER = struct.Struct("<HHI8s6xBB8xHH")
+LABEL_SIZE = 32
+
+PROTOCOL = 1024
+ADDRESSABLE = 0x1000
+TAGGED = 0x2000
+
+STATE_SERVICE = struct.Struct("<BI")            # service, port
+UPDATED_AT = struct.Struct("<Q")
+
+ACKNOWLEDGEMENT_ID = MSG_IDS[Acknowledgement]
+STATE_SERVICE_ID = MSG_IDS[StateService]
+STATE_LABEL_ID = MSG_IDS[StateLabel]
+STATE_LOCATION_ID = MSG_IDS[StateLocation]
+STATE_GROUP_ID = MSG_IDS[StateGroup]
+
+assert HEADER.size == HEADER_SIZE_BYTES
+
+
+########################################
+# The parts of a device's replies that only change with its registry entry
+########################################
+class EncodedDevice(namedtuple("EncodedDevice", ["target", "label", "location"])):
+    __slots__ = ()
+
+    @classmethod
+    def of(cls, device):
+        return cls(target_bytes(device.mac), label_bytes(device.label), bytes(device.location))
+
+
+########################################
+# Stands in for a lifxlan Message where the engine sends replies: it only needs these two attributes
+########################################
+class PackedReply(object):
+    __slots__ = ("message_type", "packed_message")
+
+    def __init__(self, message_type, packed_message):
+        self.message_type = message_type
+        self.packed_message = packed_message
+
+
+def target_bytes(mac):
+    return bytes.fromhex(mac.replace(":", "")) + b"\0\0"
+
+
+########################################
+# A label as LIFX carries it, cut to 32 bytes without splitting a character
+########################################
+def encode_label(label):
+    return label.encode("utf-8")[:LABEL_SIZE].decode("utf-8", "ignore").encode("utf-8")
+
+
+def label_bytes(label):
+    return encode_label(label).ljust(LABEL_SIZE, b"\0")
+
+
+def header(message_type, target, source, seq_num, payload_size, ack_requested=False, response_requested=False):
+    flags = PROTOCOL | ADDRESSABLE | (TAGGED if target == BROADCAST_TARGET else 0)
+    return HEADER.pack(HEADER_SIZE_BYTES + payload_size, flags, source, target, (ack_requested << 1) | response_requested,
+                       seq_num, message_type, 0)
+
+
+def packed_reply(message_type, target, source, seq_num, payload=b""):
+    return PackedReply(message_type, header(message_type, target, source, seq_num, len(payload)) + payload)
+
+
+def state_service_payload(port, service=1):
+    return STATE_SERVICE.pack(service, port)
+
+
+########################################
+# StateLocation and StateGroup share a layout: a 16 byte ID (the device's location here), the label, and
+# the time it was last updated in nanoseconds
+########################################
+def location_payload(encoded, updated_at):
+    return encoded.location + encoded.label + UPDATED_AT.pack(updated_at)
+
+
+BROADCAST_TARGET = target_bytes(BROADCAST_MAC)
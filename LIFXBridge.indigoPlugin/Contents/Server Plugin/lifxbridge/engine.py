@@ -0,0 +1,1073 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# The LIFX bridge protocol engine: receive loop, dedupe, dispatch and reply encoding.
+#
+# The engine impersonates one LIFX bulb per published device.  It knows nothing about Indigo; the devices and
+# their state come from a DeviceBackend, so the same engine runs inside the plugin and standalone on any box.
+####################
+
+import logging
+import socket
+import struct
+import sys
+import threading
+import time
+
+from lifxlan.msgtypes import *
+from lifxlan.unpack import unpack_lifx_message
+
+from .allocations import AllocationTracker
+from .backend import DeviceNotFound
+from .capture import CaptureRing, DEFAULT_CAPTURE_SIZE
+from .debounce import Debouncer
+from .egress import EgressQueue
+from .encode import packed_reply, location_payload, state_service_payload, ACKNOWLEDGEMENT_ID, STATE_SERVICE_ID, STATE_LABEL_ID, \
+    STATE_LOCATION_ID, STATE_GROUP_ID
+from .fanout import FanOut
+from .inbound import InboundQueue
+from .metrics import MetricsRegistry
+from .packetlog import PacketLog, THREADDEBUG
+from .profiling import ThreadProfiler
+from .ratelimit import RateLimiter, ADMIT
+from .registry import DeviceRegistry
+from .router import InboundRouter, MSG_NAMES
+from .tracing import Tracer
+from .transitions import TransitionScheduler, Fade, Waveform, LOWEST_LEVEL
+from . import warmstart
+
+DEFAULT_LIFX_PORT = 56700
+ZONES_PER_MESSAGE = 8       # MultiZoneStateMultiZone carries 8 zones
+REFRESH_DEBOUNCE = 2.0      # seconds between full rescans of the backend's device list
+IDLE_TIMEOUT = 2.0          # seconds to block on the socket when there's nothing queued to send
+DRAIN_LIMIT = 64            # datagrams read off the socket at a time, before handling the most urgent
+HANDLE_BATCH = 16           # requests handled per serve_once()
+
+# IP_PKTINFO isn't exported by the socket module; these are the values from the system headers.  On macOS the
+# option that turns it on is IP_RECVPKTINFO, which has the same value.
+IP_PKTINFO = getattr(socket, "IP_PKTINFO", {"linux": 8, "darwin": 26}.get(sys.platform))
+PKTINFO_FORMAT = "I4s4s"            # struct in_pktinfo: interface index, local address, header destination
+PKTINFO_SIZE = struct.calcsize(PKTINFO_FORMAT)
+
+# Messages a bulb sends rather than receives.  The inbound router drops these before they're decoded.
+NOT_SUPPORTED_IDS = {MSG_IDS[cls] for cls in (StateService, StateHostInfo, StateHostFirmware, StateWifiInfo, StateWifiFirmware, StatePower,
+                                              StateLabel, StateVersion, StateInfo, Acknowledgement, StateLocation, StateGroup, EchoResponse,
+                                              LightState, LightStatePower)}
+
+
+########################################
+# The address this machine uses for the LAN: the one the kernel would send from towards a public address.
+# Connecting a UDP socket sends nothing.  Returns "0.0.0.0" if there's no route.
+########################################
+def primary_address():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        try:
+            probe.connect(("192.0.2.1", DEFAULT_LIFX_PORT))
+            return probe.getsockname()[0]
+        except socket.error:
+            return "0.0.0.0"
+
+
+class BridgeEngine(object):
+
+    def __init__(self, backend, port=DEFAULT_LIFX_PORT, bind_addr="", refresh_debounce=REFRESH_DEBOUNCE, capture_size=DEFAULT_CAPTURE_SIZE,
+                 reuse_port=False):
+        self.logger = logging.getLogger("Plugin.Bridge")
+        self.backend = backend
+        self.bind_addr = bind_addr
+        self.port = port
+        self.reuse_port = reuse_port    # share the port with other engines (worker processes) via SO_REUSEPORT
+        self.pktinfo = False            # the socket reports the local address each datagram arrived on (IP_PKTINFO)
+
+        # recent (source, seq) pairs, so a client's retransmits are only answered once
+        self.seen_msg_list = [None, None, None, None, None, None]
+        self.router = InboundRouter()
+        self.limiter = RateLimiter()
+        self.inbound = InboundQueue()
+        self.registry = DeviceRegistry()
+        self.registry.add_listener(lambda snapshot: self.router.set_bridge_macs(snapshot.by_mac))
+        self.refresher = Debouncer(refresh_debounce, self.refresh, "refreshDeviceList")
+        self.fanout = FanOut()
+        self.capture = CaptureRing(capture_size)
+        self.tracer = Tracer()
+        self.profiler = ThreadProfiler()
+        self.allocations = AllocationTracker()
+        self.transitions = TransitionScheduler(self.transition_step)
+        self.faded_off = dict()         # devID -> brightness of a device that was faded off, to turn it back on at
+        self.packet_log = PacketLog(self.logger)
+        self.warm_start_path = None
+        self.sock = None
+        self.egress = None
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.init_metrics()
+
+    ########################################
+    # Counters and histograms recorded as requests are handled, plus callbacks for the numbers the router
+    # and egress queue already keep.
+    ########################################
+    def init_metrics(self):
+        self.metrics = MetricsRegistry()
+        self.packets_in = self.metrics.counter("lifx_packets_in_total", "Requests accepted for handling, by message type", "type")
+        self.packets_out = self.metrics.counter("lifx_packets_out_total", "Replies queued, by message type", "type")
+        self.metrics.callback("lifx_packets_dropped_total", "Inbound datagrams dropped before decoding, by reason",
+                              lambda: self.router.dropped, "counter", "reason")
+        self.metrics.callback("lifx_ratelimit_dropped_total", "Requests dropped for being over their client's budget, by class",
+                              lambda: self.limiter.dropped, "counter", "class")
+        self.metrics.callback("lifx_ratelimit_deferred_total", "Set commands held back until their client's budget refilled",
+                              lambda: self.limiter.deferred, "counter")
+        self.metrics.callback("lifx_ratelimit_blocked_total", "Requests dropped because their client was blocked for flooding",
+                              lambda: self.limiter.blocked, "counter")
+        self.metrics.callback("lifx_ratelimit_blocked_clients", "Clients blocked for flooding right now",
+                              lambda: len(self.limiter.blocked_clients()))
+        self.metrics.callback("lifx_inbound_queued", "Requests waiting to be handled",
+                              lambda: self.inbound.pending())
+        self.metrics.callback("lifx_inbound_dropped_total", "Requests dropped because their priority queue was full, by class",
+                              lambda: self.inbound.dropped, "counter", "class")
+        self.queue_wait = self.metrics.histogram("lifx_queue_wait_seconds", "Time a request waited to be handled, by class", "class")
+        self.dedupe_hits = self.metrics.counter("lifx_dedupe_hits_total", "Repeated requests that were skipped")
+        self.client_requests = self.metrics.counter("lifx_client_requests_total", "Requests accepted for handling, by client address", "client")
+        self.handler_latency = self.metrics.histogram("lifx_handler_seconds", "Time to decode and handle a request, by message type", "type")
+        self.command_latency = self.metrics.histogram("lifx_command_seconds", "Time the device backend took to carry out a command", "command")
+        self.command_failures = self.metrics.counter("lifx_command_failures_total", "Device backend commands that failed", "command")
+        self.request_errors = self.metrics.counter("lifx_request_errors_total", "Requests that couldn't be decoded or handled, by message type", "type")
+        self.metrics.callback("lifx_egress_sent_total", "Datagrams sent by the egress queue",
+                              lambda: self.egress.sent if self.egress else 0, "counter")
+        self.metrics.callback("lifx_egress_dropped_total", "Replies dropped by the egress queue because it was full or the send failed",
+                              lambda: self.egress.dropped if self.egress else 0, "counter")
+        self.metrics.callback("lifx_egress_queued", "Replies waiting in the egress queue",
+                              lambda: self.egress.pending() if self.egress else 0)
+        self.metrics.callback("lifx_published_devices", "Devices published to LIFX clients",
+                              lambda: len(self.registry.snapshot))
+        self.metrics.callback("lifx_transitions_active", "Fades and waveforms running",
+                              lambda: self.transitions.running())
+        self.metrics.callback("lifx_transition_steps_total", "Intermediate transition steps sent to devices",
+                              lambda: self.transitions.steps, "counter")
+        self.metrics.callback("lifx_transition_steps_skipped_total", "Transition steps skipped by the step rate limit",
+                              lambda: self.transitions.skipped, "counter")
+
+    ########################################
+    # Socket setup and teardown.  A port of 0 binds an ephemeral port, which is then available as self.port.
+    #
+    # On a wildcard bind the packet capture needs to know which of the machine's addresses a client reached,
+    # so the socket reports it with IP_PKTINFO.  Without IP_PKTINFO the capture uses the primary address.
+    ########################################
+    def open(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.bind((self.bind_addr, self.port))
+        self.sock.settimeout(IDLE_TIMEOUT)
+        self.port = self.sock.getsockname()[1]
+        self.pktinfo = False
+        if not self.bind_addr and IP_PKTINFO is not None:
+            self.sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+            self.pktinfo = True
+        self.capture.local = (self.bind_addr or primary_address(), self.port)
+
+        # replies are paced out through the egress queue so a tagged request doesn't flood the client
+        self.egress = EgressQueue(self.sock, capture=self.capture)
+
+    def close(self):
+        self.refresher.cancel()
+        self.transitions.stop()
+        self.logger.debug(f"inbound routing: {self.router.stats()}")
+        self.logger.debug(f"rate limiting: {self.limiter.stats()}")
+        self.logger.debug(f"inbound queues: {self.inbound.stats()}")
+        if self.sock:
+            self.egress.flush()
+            self.sock.close()
+        self.fanout.shutdown()
+
+    ########################################
+    # Rebuild the registry from the backend's list of published devices.
+    ########################################
+    def refresh(self):
+        self.logger.debug("refreshDeviceList called")
+        start = time.perf_counter()
+        devices = self.backend.published_devices()
+        self.registry.replace(devices)
+        self.logger.debug(f"{len(devices):d} devices published, rescan took {time.perf_counter() - start:.3f} seconds")
+        self.save_warm_start()
+
+    ########################################
+    # Fill the registry from the warm-start snapshot at path, which is also where it's saved from now on.
+    # Returns the number of devices loaded, 0 if there's no usable snapshot.
+    ########################################
+    def warm_start(self, path):
+        self.warm_start_path = path
+        start = time.perf_counter()
+        try:
+            devices, encoded = warmstart.load(path)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as err:
+            self.logger.warning(f"Unable to read warm-start snapshot {path}: {err}")
+            return 0
+        self.registry.replace(devices, encoded)
+        self.logger.debug(f"{len(devices):d} devices published from the warm-start snapshot in {time.perf_counter() - start:.3f} seconds")
+        return len(devices)
+
+    def save_warm_start(self):
+        if not self.warm_start_path:
+            return
+        try:
+            warmstart.save(self.warm_start_path, self.registry.snapshot)
+        except OSError as err:
+            self.logger.error(f"Unable to save warm-start snapshot {self.warm_start_path}: {err}")
+
+    ########################################
+    # Ask for a full rescan of the device list.  Rescans are coalesced, so no matter how many of these come in
+    # there will be at most one per debounce window.
+    ########################################
+    def schedule_refresh(self):
+        self.refresher.trigger()
+
+    ########################################
+    # Receive loop
+    ########################################
+
+    ########################################
+    # Wait for a datagram (or until the socket times out), then handle a batch of queued requests, most
+    # urgent first, and send whatever replies are due.  Everything waiting on the socket is queued before each
+    # request is handled, so a set command doesn't wait behind the discovery requests that arrived before it.
+    # The socket doesn't block while there are requests queued, or for long while there are replies to send or
+    # an "all devices" command is running.  Set commands wait in their queue until that command has finished.
+    ########################################
+    def serve_once(self):
+        self.profiler.tick()
+        self.fanout.poll()
+        if self.inbound.pending(not self.fanout.pending()):
+            self.sock.settimeout(0)
+        elif self.egress.pending() or self.limiter.pending() or self.fanout.pending():
+            self.sock.settimeout(self.egress.tick)
+        else:
+            self.sock.settimeout(IDLE_TIMEOUT)
+        received = self.receive()
+        if received:
+            self.handle_datagram(*received)
+            self.drain()
+        for header, data, addr in self.limiter.release():
+            self.inbound.push(header, data, addr, time.perf_counter_ns())
+        for _ in range(HANDLE_BATCH):
+            queued = self.inbound.pop(not self.fanout.pending())
+            if queued is None:
+                break
+            name, header, data, addr, arrived = queued
+            self.queue_wait.observe(name, (time.perf_counter_ns() - arrived) / 1e9)
+            trace = self.tracer.start(addr, arrived)
+            self.tracer.mark("route")
+            self.capture.inbound(data, addr)
+            self.dispatch(header, data, addr)
+            self.egress.flush()
+            if trace:
+                self.tracer.finish("send")
+            self.drain()
+        self.egress.flush()
+
+    ########################################
+    # Queue whatever else is waiting on the socket, without blocking
+    ########################################
+    def drain(self):
+        self.sock.settimeout(0)
+        for _ in range(DRAIN_LIMIT):
+            received = self.receive()
+            if received is None:
+                break
+            self.handle_datagram(*received)
+
+    ########################################
+    # Read one datagram from the socket.  Returns (data, addr), or None if there's nothing to handle.
+    ########################################
+    def receive(self):
+        received = self.receive_datagram()
+        return received and received[:2]
+
+    ########################################
+    # Read one datagram and, with IP_PKTINFO, the local address it arrived on and the destination in its IP
+    # header (they differ for a broadcast).  Returns (data, addr, local, destination), with None for the
+    # addresses if the socket doesn't report them, or None if there's nothing to read.
+    ########################################
+    def receive_datagram(self):
+        try:
+            if not self.pktinfo:
+                data, addr = self.sock.recvfrom(2048)
+                return data, addr, None, None
+            data, ancdata, _, addr = self.sock.recvmsg(2048, socket.CMSG_SPACE(PKTINFO_SIZE))
+        except (socket.timeout, BlockingIOError):
+            return None
+        except socket.error as err:
+            self.logger.error(f"Socket receive failed: {err}")
+            return None
+        for level, kind, info in ancdata:
+            if level == socket.IPPROTO_IP and kind == IP_PKTINFO and len(info) >= PKTINFO_SIZE:
+                _, local, destination = struct.unpack(PKTINFO_FORMAT, info[:PKTINFO_SIZE])
+                self.capture.arrived(addr, socket.inet_ntoa(local))
+                return data, addr, local, destination
+        return data, addr, None, None
+
+    ########################################
+    # Run the receive loop until stop_event is set.  Used when the engine runs outside the plugin.
+    ########################################
+    def serve_forever(self, stop_event=None):
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            self.serve_once()
+
+    ########################################
+    # Run the receive loop on a background thread, for tools and tests that drive the engine from outside.
+    ########################################
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.serve_forever, args=(self.stop_event,), name="LIFXBridge", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    ########################################
+    # Write the packet capture ring to a pcap file.  Returns the number of datagrams written.
+    ########################################
+    def save_capture(self, path):
+        return self.capture.save(path)
+
+    ########################################
+    # Queue a datagram if it's a request addressed to one of our devices, or to everyone, and it's within its
+    # client's budget.  Nothing is decoded until the request comes off the queue.
+    #
+    # Requests go into the packet capture when they're handled, not when they arrive, so the capture has them
+    # in the order they were answered and a replay can answer them in the same order.  Requests dropped by the
+    # rate limiter or a full queue are left out; everything else the router drops goes in as it arrives.
+    ########################################
+    def handle_datagram(self, data, addr):
+        arrived = time.perf_counter_ns()
+        header = self.router.route(data)
+        if header is None:
+            self.capture.inbound(data, addr)
+        elif self.limiter.admit(header, data, addr) == ADMIT:
+            self.inbound.push(header, data, addr, arrived)
+
+    ########################################
+    # Decode and handle one request.  A request that makes the decoder or a handler fail is logged and
+    # counted, and the engine goes on to the next one.
+    ########################################
+    def dispatch(self, header, data, addr):
+        start = time.perf_counter()
+        msg_name = MSG_NAMES[header.msg_type]
+        self.tracer.name(msg_name)
+        self.packets_in.inc(msg_name)
+        self.client_requests.inc(addr[0])
+        allocations = self.allocations.begin(msg_name)
+        try:
+            message = unpack_lifx_message(data)
+            self.tracer.mark("decode")
+            if allocations:
+                self.allocations.stage(allocations, "decode")
+            self.respond(message, addr[0], addr[1])
+        except Exception as err:
+            self.request_errors.inc(msg_name)
+            self.logger.error(f"Unable to handle {msg_name} from {addr[0]}:{addr[1]}: {err}", exc_info=self.logger.isEnabledFor(logging.DEBUG))
+            return
+        self.tracer.mark("dispatch")
+        if allocations:
+            self.allocations.stage(allocations, "respond")
+        self.handler_latency.observe(msg_name, time.perf_counter() - start)
+
+    ########################################
+    # The few numbers worth watching from outside, for the plugin to mirror into Indigo variables.
+    # Latencies are in milliseconds, None until there's been something to measure.
+    ########################################
+    def metrics_summary(self):
+        handler_p95 = self.handler_latency.quantile(0.95)
+        command_p95 = self.command_latency.quantile(0.95)
+        return {
+            "packets_in": self.packets_in.total(),
+            "packets_out": self.packets_out.total(),
+            "packets_dropped": sum(self.router.dropped.values()) + sum(self.limiter.dropped.values()) + self.limiter.blocked +
+                               sum(self.inbound.dropped.values()) + (self.egress.dropped if self.egress else 0),
+            "dedupe_hits": self.dedupe_hits.total(),
+            "command_failures": self.command_failures.total(),
+            "handler_p95_ms": None if handler_p95 is None else round(handler_p95 * 1000.0, 2),
+            "command_p95_ms": None if command_p95 is None else round(command_p95 * 1000.0, 2),
+        }
+
+    ########################################
+    #   Methods that deal with LIFX protocol messages
+    ########################################
+
+    ########################################
+    # All replies go through the egress queue.  Acks and replies to set commands use the priority lane so
+    # they are never stuck behind a discovery burst.
+    ########################################
+    def send_reply(self, replyMessage, ip_addr, port, priority=False):
+        self.tracer.mark("encode")      # the reply was packed when it was built, just before this call
+        self.packets_out.inc(MSG_NAMES[replyMessage.message_type])
+        self.egress.send(replyMessage.packed_message, (ip_addr, port), priority)
+        self.tracer.mark("queue")
+
+    def respond(self, message, ip_addr, port):
+
+        source = message.source_id
+        seq_num = message.seq_num
+        debug = self.packet_log.begin(message.message_type)     # False unless debugging is on and this packet is sampled
+
+        if (source, seq_num) in self.seen_msg_list:
+            self.dedupe_hits.inc()
+
+            if debug and self.packet_log.threaddebug:
+                self.logger.log(THREADDEBUG, f"lifxRespond, skipping repeat seq_num = {seq_num:d}, type = {message.message_type:d}, target = {message.target_addr}")
+            return
+
+        elif seq_num == 0:
+            pass
+        else:
+            self.seen_msg_list.pop(0)
+            self.seen_msg_list.append((source, seq_num))
+
+        if debug and self.packet_log.threaddebug:
+            self.logger.log(THREADDEBUG, f"lifxRespond: message = \n{message}")
+
+        # Take one snapshot of the published devices for the whole request.  Callbacks may swap in a new
+        # registry while we're working, but this request sees a consistent view without any locking.
+        snapshot = self.registry.snapshot
+
+        if message.message_type == MSG_IDS[GetService]:  # 2
+
+            payload = state_service_payload(self.port)
+
+            for device in snapshot:
+                if debug:
+                    self.logger.debug(f"GetService message, replying for: {device.name}")
+                encoded = snapshot.encoded[device.id]
+                replyMessage = packed_reply(STATE_SERVICE_ID, encoded.target, source, seq_num, payload)
+                self.send_reply(replyMessage, ip_addr, port)
+
+                if message.ack_requested:
+                    if debug:
+                        self.logger.debug("GetService message, sending Ack ")
+                    replyMessage = packed_reply(ACKNOWLEDGEMENT_ID, encoded.target, source, seq_num)
+                    self.send_reply(replyMessage, ip_addr, port)
+
+            # repeat with service 5?  The bulbs do.
+
+        elif message.message_type == MSG_IDS[GetHostInfo]:  # 12
+
+            device = snapshot.lookup(message.target_addr)
+            if device:
+
+                if debug:
+                    self.logger.debug(f"GetHostInfo message, replying for: {device.name}")
+
+                payload = {"signal": "0", "tx": "0", "rx": "0", "reserved1": "0"}
+                replyMessage = StateHostInfo(message.target_addr, source, seq_num, payload, False, False)
+                self.send_reply(replyMessage, ip_addr, port)
+
+                if message.ack_requested:
+                    replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
+                    self.send_reply(replyMessage, ip_addr, port)
+
+        elif message.message_type == MSG_IDS[GetHostFirmware]:  # 14
+
+            device = snapshot.lookup(message.target_addr)
+            if device:
+
+                if debug:
+                    self.logger.debug(f"GetHostFirmware message, replying for: {device.name}")
+
+                payload = {"build": "1428977151000000000", "reserved1": "1428977151000000000", "version": "65538"}
+                replyMessage = StateHostFirmware(message.target_addr, source, seq_num, payload, False, False)
+                self.send_reply(replyMessage, ip_addr, port)
+
+                if message.ack_requested:
+                    replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
+                    self.send_reply(replyMessage, ip_addr, port)
+
+        elif message.message_type == MSG_IDS[GetWifiInfo]:  # 16
+
+            device = snapshot.lookup(message.target_addr)
+            if device:  # reply with info for requested device
+
+                if debug:
+                    self.logger.debug(f"GetWifiInfo message, replying for: {device.name}")
+
+                payload = {"signal": "944912011", "tx": "3397400", "rx": "23670", "reserved1": "3010"}
+                replyMessage = StateWifiInfo(message.target_addr, source, seq_num, payload, False, False)
+                self.send_reply(replyMessage, ip_addr, port)
+
+                if message.ack_requested:
+                    replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
+                    self.send_reply(replyMessage, ip_addr, port)
+
+        elif message.message_type == MSG_IDS[GetWifiFirmware]:  # 18
+
+            device = snapshot.lookup(message.target_addr)
+            if device:  # reply with info for requested device
+
+                if debug:
+                    self.logger.debug(f"GetWifiFirmware message, replying for: {device.name}")
+
+                payload = {"build": "0", "reserved1": "0", "version": "6619161"}
+                replyMessage = StateWifiFirmware(message.target_addr, source, seq_num, payload, False, False)
+                self.send_reply(replyMessage, ip_addr, port)
+
+                if message.ack_requested:
+                    replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
+                    self.send_reply(replyMessage, ip_addr, port)
+
+        elif message.message_type == MSG_IDS[GetPower]:  # 20
+
+            device = snapshot.lookup(message.target_addr)
+            if device:  # reply with info for requested device
+
+                if debug:
+                    self.logger.debug(f"GetPower message, replying for: {device.name}")
+
+                power_level = self.device_power(device.id)
+                if power_level is not None:
+                    payload = {"power_level": power_level}
+                    replyMessage = StatePower(message.target_addr, source, seq_num, payload, False, False)
+                    self.send_reply(replyMessage, ip_addr, port)
+
+                if message.ack_requested:
+                    replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
+                    self.send_reply(replyMessage, ip_addr, port)
+
+        elif message.message_type == MSG_IDS[SetPower]:  # 21
+
+            if message.tagged:
+                for field in message.payload_fields:
+                    if field[0] == "Power":
+                        self.fan_out_command(message, ip_addr, port, StatePower, self.change_device_power, field[1])
+                        break
+                return
+
+            device = snapshot.lookup(message.target_addr)
+            if device:
+
+                if debug:
+                    self.logger.debug(f"SetPower message for: {device.name}")
+
+                for field in message.payload_fields:
+                    if field[0] == "Power":
+                        self.change_device_power(device.id, field[1])
+                        break
+
+                if message.ack_requested:
+                    replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
+                    self.send_reply(replyMessage, ip_addr, port, priority=True)
+
+                if message.response_requested:
+                    replyMessage = self.state_reply(StatePower, device, source, seq_num)
+                    if replyMessage:
+                        self.send_reply(replyMessage, ip_addr, port, priority=True)
+
+        elif message.message_type == MSG_IDS[GetLabel]:  # 23
+
+            for device in snapshot:
+
+                if message.target_addr == device.mac or message.tagged:
+
+                    if debug:
+                        self.logger.debug(f"GetLabel message, replying for: {device.name}")
+
+                    encoded = snapshot.encoded[device.id]
+                    replyMessage = packed_reply(STATE_LABEL_ID, encoded.target, source, seq_num, encoded.label)
+                    self.send_reply(replyMessage, ip_addr, port)
+
+                    if message.ack_requested:
+                        replyMessage = packed_reply(ACKNOWLEDGEMENT_ID, encoded.target, source, seq_num)
+                        self.send_reply(replyMessage, ip_addr, port)
+
+        elif message.message_type == MSG_IDS[SetLabel]:  # 24
+            if debug:
+                self.logger.debug("SetLabel message - not supported!")
+
+            if message.ack_requested and snapshot.lookup(message.target_addr):  # reply with info for requested device
+                replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
+                self.send_reply(replyMessage, ip_addr, port, priority=True)
+
+            if message.response_requested:
+                if debug:
+                    self.logger.debug("Oops!  Client wants a response to SetLabel")
+
+        elif message.message_type == MSG_IDS[GetVersion]:  # 32
+
+            device = snapshot.lookup(message.target_addr)
+            if device:  # reply with info for requested device
+
+                if debug:
+                    self.logger.debug(f"GetVersion message, replying for: {device.name}")
+
+                product = self.device_product(device.id)
+                if product is not None:
+                    payload = {"vendor": 1, "product": product, "version": 0}
+                    replyMessage = StateVersion(message.target_addr, source, seq_num, payload, False, False)
+                    self.send_reply(replyMessage, ip_addr, port)
+
+                if message.ack_requested:
+                    replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
+                    self.send_reply(replyMessage, ip_addr, port)
+
+        elif message.message_type == MSG_IDS[GetInfo]:  # 34
+
+            time_s = str(int(time.time() * 1000000000))
+
+            device = snapshot.lookup(message.target_addr)
+            if device:  # reply with info for requested device
+
+                if debug:
+                    self.logger.debug(f"GetInfo message, replying for: {device.name}")
+
+                payload = {"time": time_s, "uptime": "1243200000000", "downtime": "0"}
+                replyMessage = StateInfo(message.target_addr, source, seq_num, payload, False, False)
+                self.send_reply(replyMessage, ip_addr, port)
+
+                if message.ack_requested:
+                    replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
+                    self.send_reply(replyMessage, ip_addr, port)
+
+        elif message.message_type in (MSG_IDS[GetLocation], MSG_IDS[GetGroup]):  # 48, 51
+
+            device = snapshot.lookup(message.target_addr)
+            if device:  # reply with info for requested device
+
+                if debug:
+                    self.logger.debug(f"{type(message).__name__} message, replying for: {device.name}")
+
+                # the device's location doubles as its group
+                encoded = snapshot.encoded[device.id]
+                replyType = STATE_LOCATION_ID if message.message_type == MSG_IDS[GetLocation] else STATE_GROUP_ID
+                replyMessage = packed_reply(replyType, encoded.target, source, seq_num, location_payload(encoded, time.time_ns()))
+                self.send_reply(replyMessage, ip_addr, port)
+
+                if message.ack_requested:
+                    replyMessage = packed_reply(ACKNOWLEDGEMENT_ID, encoded.target, source, seq_num)
+                    self.send_reply(replyMessage, ip_addr, port)
+
+        elif message.message_type == MSG_IDS[EchoRequest]:  # 58
+
+            payload = {"byte_array": message.byte_array}
+            for device in snapshot:
+
+                if debug:
+                    self.logger.debug(f"EchoRequest message, replying for: {device.name}")
+
+                replyMessage = EchoResponse(device.mac, source, seq_num, payload, False, False)
+                self.send_reply(replyMessage, ip_addr, port)
+
+                if message.ack_requested:
+                    replyMessage = Acknowledgement(device.mac, source, seq_num, None, False, False)
+                    self.send_reply(replyMessage, ip_addr, port)
+
+        elif message.message_type == MSG_IDS[LightGet]:  # 101
+
+            for device in snapshot:
+
+                if message.target_addr == device.mac or message.tagged:
+
+                    replyMessage = self.state_reply(LightState, device, source, seq_num)
+                    if replyMessage:
+                        if debug:
+                            self.logger.debug(f"LightGet for {device.name}, power_level = {replyMessage.power_level}, colors = {replyMessage.color}")
+                        self.send_reply(replyMessage, ip_addr, port)
+
+                    if message.ack_requested:
+                        replyMessage = Acknowledgement(device.mac, source, seq_num, None, False, False)
+                        self.send_reply(replyMessage, ip_addr, port)
+
+        elif message.message_type == MSG_IDS[LightSetColor]:  # 102
+
+            if message.tagged:
+                for field in message.payload_fields:
+                    if field[0] == "Color":
+                        self.fan_out_command(message, ip_addr, port, LightState, self.change_device_color, *field[1], message.duration)
+                        break
+                return
+
+            device = snapshot.lookup(message.target_addr)
+            if device:
+
+                if debug:
+                    self.logger.debug(f"LightSetColor command is for device: {device.name}, payload = {message.payload_fields}")
+
+                for field in message.payload_fields:
+                    if field[0] == "Color":
+                        (hue, saturation, brightness, color) = field[1]
+                        self.change_device_color(device.id, hue, saturation, brightness, color, message.duration)
+                        break
+
+                if message.ack_requested:
+                    replyMessage = Acknowledgement(device.mac, source, seq_num, None, False, False)
+                    self.send_reply(replyMessage, ip_addr, port, priority=True)
+
+                #                    if message.response_requested:
+                if True:
+                    replyMessage = self.state_reply(LightState, device, source, seq_num)
+                    if replyMessage:
+                        if debug:
+                            self.logger.debug(f"LightSetColor response power_level = {replyMessage.power_level}, colors = {replyMessage.color}")
+                        self.send_reply(replyMessage, ip_addr, port, priority=True)
+
+        elif message.message_type == MSG_IDS[LightSetWaveform]:  # 103
+
+            if message.tagged:
+                self.fan_out_command(message, ip_addr, port, LightState, self.start_waveform, message.color, message.period,
+                                     message.cycles, message.duty_cycle, message.waveform, message.transient)
+                return
+
+            device = snapshot.lookup(message.target_addr)
+            if device:
+
+                if debug:
+                    self.logger.debug(f"LightSetWaveform for {device.name}: waveform = {message.waveform}, color = {message.color}, "
+                                      f"period = {message.period}, cycles = {message.cycles}, transient = {message.transient}")
+
+                self.start_waveform(device.id, message.color, message.period, message.cycles, message.duty_cycle, message.waveform,
+                                    message.transient)
+
+                if message.ack_requested:
+                    replyMessage = Acknowledgement(device.mac, source, seq_num, None, False, False)
+                    self.send_reply(replyMessage, ip_addr, port, priority=True)
+
+                if message.response_requested:
+                    replyMessage = self.state_reply(LightState, device, source, seq_num)
+                    if replyMessage:
+                        self.send_reply(replyMessage, ip_addr, port, priority=True)
+
+        elif message.message_type == MSG_IDS[LightGetPower]:  # 116
+
+            for device in snapshot:
+
+                if message.target_addr == device.mac or message.tagged:
+
+                    if debug:
+                        self.logger.debug(f"LightGetPower message, replying for: {device.name}")
+
+                    power_level = self.device_brightness(device.id)
+                    if power_level is not None:
+                        payload = {"power_level": power_level}
+                        replyMessage = LightStatePower(device.mac, source, seq_num, payload, False, False)
+                        self.send_reply(replyMessage, ip_addr, port)
+
+                    if message.ack_requested:
+                        replyMessage = Acknowledgement(device.mac, source, seq_num, None, False, False)
+                        self.send_reply(replyMessage, ip_addr, port)
+
+        elif message.message_type == MSG_IDS[LightSetPower]:  # 117
+
+            if message.tagged:
+                for field in message.payload_fields:
+                    if field[0] == "Power Level":
+                        self.fan_out_command(message, ip_addr, port, LightStatePower, self.change_device_power, field[1], message.duration)
+                        break
+                return
+
+            device = snapshot.lookup(message.target_addr)
+            if device:
+                if debug:
+                    self.logger.debug(f"LightSetPower command is for device: '{device.name}', payload_fields = '{message.payload_fields}'")
+
+                for field in message.payload_fields:
+                    if field[0] == "Power Level":
+                        self.change_device_power(device.id, field[1], message.duration)
+                        break
+
+                if message.ack_requested:
+                    replyMessage = Acknowledgement(device.mac, source, seq_num, None, False, False)
+                    self.send_reply(replyMessage, ip_addr, port, priority=True)
+
+                if message.response_requested:
+                    replyMessage = self.state_reply(LightStatePower, device, source, seq_num)
+                    if replyMessage:
+                        self.send_reply(replyMessage, ip_addr, port, priority=True)
+
+        elif message.message_type == MSG_IDS[MultiZoneGetColorZones]:  # 502
+
+            device = snapshot.lookup(message.target_addr)
+            if device:
+
+                zones = self.device_zones(device.id)
+                if zones is not None:   # only zone strips are multizone
+                    if debug:
+                        self.logger.debug(f"MultiZoneGetColorZones {message.start_index}-{message.end_index} for {device.name}, {len(zones)} zones")
+                    for replyMessage in self.zone_replies(device, zones, message.start_index, message.end_index, source, seq_num):
+                        self.send_reply(replyMessage, ip_addr, port)
+
+                if message.ack_requested:
+                    replyMessage = Acknowledgement(device.mac, source, seq_num, None, False, False)
+                    self.send_reply(replyMessage, ip_addr, port)
+
+        elif message.message_type == MSG_IDS[MultiZoneSetColorZones]:  # 501
+
+            device = snapshot.lookup(message.target_addr)
+            if device:
+
+                if debug:
+                    self.logger.debug(f"MultiZoneSetColorZones {message.start_index}-{message.end_index} for {device.name}, "
+                                      f"color = {message.color}, apply = {message.apply}")
+
+                self.transitions.cancel(device.id)
+                self.set_device_zones(device.id, message.start_index, message.end_index, message.color, message.apply)
+
+                if message.ack_requested:
+                    replyMessage = Acknowledgement(device.mac, source, seq_num, None, False, False)
+                    self.send_reply(replyMessage, ip_addr, port, priority=True)
+
+                if message.response_requested:
+                    zones = self.device_zones(device.id)
+                    if zones is not None:
+                        for replyMessage in self.zone_replies(device, zones, message.start_index, message.end_index, source, seq_num):
+                            self.send_reply(replyMessage, ip_addr, port, priority=True)
+
+        elif message.message_type in NOT_SUPPORTED_IDS:  # StateX, Acknowledgement, EchoResponse
+
+            if debug:
+                self.logger.debug(f"{type(message).__name__} message for {message.target_addr} - not supported!")
+            if message.ack_requested:
+                if debug:
+                    self.logger.debug("Oops!  Client wants an ACK")
+            if message.response_requested:
+                if debug:
+                    self.logger.debug("Oops!  Client wants a response")
+
+        else:
+            if debug:
+                self.logger.debug(f"Unknown message type from {ip_addr}:{port}\n{message}")
+
+    ########################################
+    # Apply a tagged (all devices) set command.  The command is run for every published device in parallel,
+    # then each device that succeeded gets its own Ack (and state reply, if one was requested) just like a
+    # real bulb would send.  Failures are reported per device.  The receive thread doesn't wait: the replies
+    # are sent from serve_once() when the batch is done, or the fan-out timeout (5 seconds) is up, and queries
+    # and discovery are answered in the meantime.
+    #
+    #   replyClass is the state message to send if the client asked for a response
+    #   func is called as func(devID, *args) and returns True on success
+    ########################################
+    def fan_out_command(self, message, ip_addr, port, replyClass, func, *args):
+        devices = list(self.registry.snapshot)
+        self.tracer.mark("lookup")
+
+        def on_done(results):
+            succeeded = [device for device in devices if results[device.id] is True]
+            for device in devices:
+                if results[device.id] is not True:
+                    self.logger.error(f"{type(message).__name__} for all devices failed for {device.name}: {results[device.id]}")
+            if self.packet_log.debug:
+                self.logger.debug(f"Tagged message type {message.message_type} applied to {len(succeeded)} of {len(devices)} devices")
+
+            for device in succeeded:
+                if message.ack_requested:
+                    replyMessage = Acknowledgement(device.mac, message.source_id, message.seq_num, None, False, False)
+                    self.send_reply(replyMessage, ip_addr, port, priority=True)
+                if message.response_requested:
+                    replyMessage = self.state_reply(replyClass, device, message.source_id, message.seq_num)
+                    if replyMessage:
+                        self.send_reply(replyMessage, ip_addr, port, priority=True)
+
+        self.fanout.start([device.id for device in devices], func, *args, on_done=on_done)
+        self.tracer.mark("backend")
+
+    ########################################
+    # Build a StatePower, LightStatePower or LightState reply for a device.  Returns None if the device is gone.
+    ########################################
+    def state_reply(self, replyClass, device, source, seq_num):
+        if replyClass is LightState:
+            payload = {"color": self.device_color(device.id), "power_level": self.device_power(device.id), "label": device.label, "reserved1": 0, "reserved2": 0}
+        else:
+            payload = {"power_level": self.device_power(device.id)}
+        if None in payload.values():
+            return None
+        return replyClass(device.mac, source, seq_num, payload, False, False)
+
+    ########################################
+    # The replies to a request for zones start to end, like a LIFX Z sends them: a single zone comes back as a
+    # MultiZoneStateZone, a range as MultiZoneStateMultiZone messages of 8 zones each.
+    ########################################
+    def zone_replies(self, device, zones, start, end, source, seq_num):
+        count = len(zones)
+        end = min(end, count - 1)
+        if start > end:
+            return []
+        if start == end:
+            return [MultiZoneStateZone(device.mac, source, seq_num, {"count": count, "index": start, "color": zones[start]}, False, False)]
+        replies = []
+        for index in range(start, end + 1, ZONES_PER_MESSAGE):
+            colors = zones[index:index + ZONES_PER_MESSAGE]
+            colors += [(0, 0, 0, 0)] * (ZONES_PER_MESSAGE - len(colors))
+            replies.append(MultiZoneStateMultiZone(device.mac, source, seq_num, {"count": count, "index": index, "color": colors}, False, False))
+        return replies
+
+    ########################################
+    #   Backend calls.  A device that has gone away is logged and triggers a (debounced) rescan; the getters
+    #   return None and the setters return False.
+    ########################################
+    def device_missing(self, devID):
+        self.logger.error(f"Device with id {devID} doesn't exist. The device list will be rebuilt.")
+        self.schedule_refresh()
+
+    def device_power(self, devID):
+        self.tracer.mark("lookup")
+        try:
+            return self.backend.get_power(devID)
+        except DeviceNotFound:
+            self.device_missing(devID)
+        finally:
+            self.tracer.mark("backend")
+
+    def device_brightness(self, devID):
+        self.tracer.mark("lookup")
+        try:
+            return self.backend.get_brightness(devID)
+        except DeviceNotFound:
+            self.device_missing(devID)
+        finally:
+            self.tracer.mark("backend")
+
+    def device_color(self, devID):
+        self.tracer.mark("lookup")
+        try:
+            return self.backend.get_color(devID)
+        except DeviceNotFound:
+            self.device_missing(devID)
+        finally:
+            self.tracer.mark("backend")
+
+    def device_product(self, devID):
+        self.tracer.mark("lookup")
+        try:
+            return self.backend.get_product(devID)
+        except DeviceNotFound:
+            self.device_missing(devID)
+        finally:
+            self.tracer.mark("backend")
+
+    def device_zones(self, devID):
+        self.tracer.mark("lookup")
+        try:
+            return self.backend.get_zones(devID)
+        except DeviceNotFound:
+            self.device_missing(devID)
+        finally:
+            self.tracer.mark("backend")
+
+    ########################################
+    #   The setters are also timed, and anything but a True result (including an exception, which is passed
+    #   on) counts as a failed command.
+    ########################################
+    def set_device_power(self, devID, turnOn):
+        self.tracer.mark("lookup")
+        start = time.perf_counter()
+        result = False
+        try:
+            result = self.backend.set_power(devID, turnOn)
+        except DeviceNotFound:
+            self.device_missing(devID)
+        finally:
+            self.command_done("set_power", start, result)
+        return result
+
+    def set_device_color(self, devID, hue, saturation, brightness, kelvin):
+        self.tracer.mark("lookup")
+        start = time.perf_counter()
+        result = False
+        try:
+            result = self.backend.set_color(devID, hue, saturation, brightness, kelvin)
+        except DeviceNotFound:
+            self.device_missing(devID)
+        finally:
+            self.command_done("set_color", start, result)
+        return result
+
+    def set_device_zones(self, devID, start_index, end_index, color, apply):
+        self.tracer.mark("lookup")
+        start = time.perf_counter()
+        result = False
+        try:
+            result = self.backend.set_zones(devID, start_index, end_index, color, apply)
+        except DeviceNotFound:
+            self.device_missing(devID)
+        finally:
+            self.command_done("set_zones", start, result)
+        return result
+
+    ########################################
+    #   Commands from clients, which may be spread over a duration (in ms) by the transition scheduler.  Any
+    #   command for a device stops the transition it had running.  Return True if the command was carried out
+    #   or the transition started.
+    ########################################
+    def change_device_color(self, devID, hue, saturation, brightness, kelvin, duration=0):
+        self.transitions.cancel(devID)
+        self.faded_off.pop(devID, None)
+        target = (hue, saturation, brightness, kelvin)
+        if duration and self.transitions.enabled:
+            start = self.device_color(devID)
+            if start is not None and tuple(start) != target:
+                self.transitions.start(Fade(devID, start, target, duration / 1000.0))
+                return True
+        return self.set_device_color(devID, hue, saturation, brightness, kelvin)
+
+    ########################################
+    #   A timed power change works like a LIFX bulb's: the brightness fades down to the dimmest step and the
+    #   device is turned off, or fades up from nothing to the brightness it had.  Indigo reports an off dimmer's
+    #   brightness as 0, so the brightness of a device that was faded off is remembered here, and it's turned
+    #   back on at that level, faded or not.  Other devices fade on to full.
+    ########################################
+    def change_device_power(self, devID, level, duration=0):
+        self.transitions.cancel(devID)
+        timed = duration and self.transitions.enabled
+        brightness = self.faded_off.pop(devID, None)
+        if timed or (level and brightness):
+            color = self.device_color(devID)
+            power = self.device_power(devID)
+            if color is not None and power is not None and bool(power) != bool(level):
+                hue, saturation, current, kelvin = color
+                if level:
+                    lit = (hue, saturation, brightness or 65535, kelvin)
+                    if not timed:
+                        return self.set_device_color(devID, *lit) is True and self.set_device_power(devID, True)
+                    self.transitions.start(Fade(devID, (hue, saturation, 0, kelvin), lit, duration / 1000.0,
+                                                lambda: self.set_device_power(devID, True), lit[2]))
+                else:
+                    fade = Fade(devID, color, (hue, saturation, min(current, LOWEST_LEVEL), kelvin), duration / 1000.0,
+                                brightness=current)
+                    fade.on_done = lambda: self.faded_to_off(fade)
+                    self.transitions.start(fade)
+                return True
+        return self.set_device_power(devID, level)
+
+    ########################################
+    # The end of a fade to off: turn the device off, and remember the brightness it had
+    ########################################
+    def faded_to_off(self, fade):
+        if self.set_device_power(fade.devID, False) is True and fade.brightness:
+            self.faded_off[fade.devID] = fade.brightness
+
+    ########################################
+    #   LightSetWaveform.  period is in ms; duty_cycle is the skew ratio, -32768 to 32767.  Without the
+    #   transition scheduler the device goes straight to where the waveform would end: nowhere, if transient.
+    ########################################
+    def start_waveform(self, devID, color, period, cycles, duty_cycle, waveform, transient):
+        self.transitions.cancel(devID)
+        if not transient:
+            self.faded_off.pop(devID, None)
+        original = self.device_color(devID)
+        if original is None:
+            return False
+        if not self.transitions.enabled:
+            return True if transient else self.set_device_color(devID, *color)
+        self.transitions.start(Waveform(devID, original, color, period / 1000.0, cycles, (duty_cycle + 32768) / 65535.0,
+                                        waveform, transient))
+        return True
+
+    def transition_step(self, devID, color):
+        return self.set_device_color(devID, *color)
+
+    def command_done(self, command, start, result):
+        self.tracer.mark("backend")
+        self.command_latency.observe(command, time.perf_counter() - start)
+        if result is not True:
+            self.command_failures.inc(command)
@@ -0,0 +1,100 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Parallel fan-out of a command across many devices.
+#
+# A tagged "all lights" set command has to be applied to every published device.  Running the commands one
+# after another makes "all off" take the sum of every device's command time, so they're run through a bounded
+# thread pool instead and the whole batch takes about as long as the slowest device.
+#
+# The engine doesn't wait for a batch.  start() hands it to the pool and returns, and the receive thread calls
+# poll() as it goes round its loop; a batch's on_done is called from poll(), on the receive thread, once every
+# command has finished or the timeout is up.  run() is the blocking version, for threads with nothing else
+# to do.  Commands that haven't started by the timeout are cancelled; ones already running are left to finish
+# on their pool thread, and their results are dropped.
+####################
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+DEFAULT_MAX_WORKERS = 16
+DEFAULT_TIMEOUT = 5.0       # seconds to wait for the whole batch
+
+
+class FanOutTimeout(Exception):
+    pass
+
+
+class Batch(object):
+    __slots__ = ("futures", "deadline", "on_done")
+
+    def __init__(self, futures, deadline, on_done):
+        self.futures = futures          # future -> target
+        self.deadline = deadline        # monotonic time
+        self.on_done = on_done
+
+
+class FanOut(object):
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, timeout=DEFAULT_TIMEOUT):
+        self.logger = logging.getLogger("Plugin.FanOut")
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="LIFXFanOut")
+        self.batches = []               # started and not yet handed to on_done, oldest first
+
+    ########################################
+    # Call func(target, *args) for every target in parallel and wait for all of them.
+    #
+    #   Returns a dict of target -> result.  The result is whatever func returned, or the exception it raised,
+    #   or a FanOutTimeout if it didn't finish in time.  Commands still waiting for a pool thread at the timeout
+    #   are cancelled.
+    ########################################
+    def run(self, targets, func, *args):
+        futures = {self.executor.submit(func, target, *args): target for target in targets}
+        wait(futures, timeout=self.timeout)
+        return self.results(futures)
+
+    ########################################
+    # Start calling func(target, *args) for every target in parallel, without waiting.  poll() calls
+    # on_done(results) when they've all finished, with results as run() returns them.
+    ########################################
+    def start(self, targets, func, *args, on_done):
+        futures = {self.executor.submit(func, target, *args): target for target in targets}
+        self.batches.append(Batch(futures, time.monotonic() + self.timeout, on_done))
+
+    ########################################
+    # Hand every batch that's finished or timed out to its on_done, on the calling thread.  Returns the
+    # number of batches handed over.
+    ########################################
+    def poll(self):
+        if not self.batches:
+            return 0
+        now = time.monotonic()
+        finished = [batch for batch in self.batches if now >= batch.deadline or all(future.done() for future in batch.futures)]
+        if finished:
+            self.batches = [batch for batch in self.batches if batch not in finished]
+        for batch in finished:
+            try:
+                batch.on_done(self.results(batch.futures))
+            except Exception as err:
+                self.logger.exception(f"Handling fan-out results failed: {err}")
+        return len(finished)
+
+    def pending(self):
+        return len(self.batches)
+
+    def results(self, futures):
+        results = dict()
+        for future, target in futures.items():
+            if not future.done():
+                future.cancel()
+                results[target] = FanOutTimeout(f"no result after {self.timeout} seconds")
+                continue
+            exception = future.exception()
+            results[target] = exception if exception else future.result()
+        return results
+
+    def shutdown(self):
+        self.batches = []
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,605 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Virtual LIFX fleet: thousands of independent emulated bulbs on loopback, for scale testing lifxlan clients.
+#
+# Where the bridge answers for Indigo devices, every bulb here has its own state: MAC, label, group, location,
+# product, power and color, plus the zones of a multizone strip or the tiles of a tile chain.  Each bulb gets
+# its own UDP port (the loopback stand-in for its own IP address) and advertises it in StateService, so
+# lifxlan's Device objects talk to it directly after discovery.  A shared discovery port answers broadcasts
+# for the whole fleet.  Replies can be delayed and randomly dropped to look like a busy Wi-Fi network.
+#
+#   cd "LIFXBridge.indigoPlugin/Contents/Server Plugin"
+#   python -m lifxbridge.fleet --bulbs 2000 --multizone 0.1 --tiles 0.05 --delay 0.005 --jitter 0.01 --loss 0.01
+#   python -m lifxbridge.fleet --bulbs 500 --benchmark       # time lifxlan discovery, Group and TileChain calls
+####################
+
+import argparse
+import heapq
+import logging
+import os
+import random
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+
+from lifxlan.msgtypes import *
+from lifxlan.unpack import unpack_lifx_message
+
+from .backend import PRODUCT_WHITE_800, PRODUCT_COLOR_1000, PRODUCT_LIFX_Z
+from .router import REQUEST_TYPES, BROADCAST_TARGET, mac_to_bytes, peek_header
+
+try:
+    import resource
+except ImportError:     # not available on Windows
+    resource = None
+
+PRODUCT_TILE = 55
+
+DEFAULT_FLEET_PORT = 56700
+LIFX_OUI = "d0:73:d5"
+TILE_SIZE = 8               # tiles are 8 x 8 pixels
+CHAIN_SLOTS = 16            # StateDeviceChain always carries 16 tile entries
+ZONES_PER_MESSAGE = 8       # MultiZoneStateMultiZone carries 8 zones
+HOST_FIRMWARE = {"build": 1548977726000000000, "reserved1": 0, "version": (3 << 16) | 70}
+WIFI_FIRMWARE = {"build": 0, "reserved1": 0, "version": (1 << 16) | 0}
+BOOT_TIME_NS = time.time_ns()
+
+_source_seq = struct.Struct("<I").pack_into     # source at offset 4, seq is the single byte at offset 23
+
+
+class VirtualBulb(object):
+
+    def __init__(self, mac, label, product, group, location, zones=0, tiles=0):
+        self.mac = mac
+        self.mac_bytes = mac_to_bytes(mac)
+        self.label = label
+        self.product = product
+        self.group = group              # (id, label, updated_at)
+        self.location = location        # (id, label, updated_at)
+        self.power = 0
+        self.color = (0, 0, 65535, 3500)
+        self.infrared = 0
+        self.zones = [self.color] * zones
+        self.tiles = [{"user_x": float(i), "user_y": 0.0, "colors": [self.color] * (TILE_SIZE * TILE_SIZE)} for i in range(tiles)]
+        self.port = None
+        self.sock = None
+        self.cache = dict()             # reply class -> packed reply that doesn't change with bulb state
+
+    def __repr__(self):
+        return f"VirtualBulb({self.mac}, {self.label!r}, product={self.product})"
+
+
+########################################
+# Build a fleet of count bulbs.  multizone and tiles are the fractions of the fleet that are LIFX Z strips and
+# tile chains; of the rest, half are color bulbs and half are white.  Bulbs are spread over the groups and
+# locations round robin.
+########################################
+def generate_fleet(count, multizone=0.0, tiles=0.0, zones=16, chain=5, groups=10, locations=2, seed=None):
+    rng = random.Random(seed)
+    now = time.time_ns()
+    group_list = [(bytes(rng.getrandbits(8) for _ in range(16)), f"Group {i + 1}", now) for i in range(max(1, groups))]
+    location_list = [(bytes(rng.getrandbits(8) for _ in range(16)), f"Location {i + 1}", now) for i in range(max(1, locations))]
+
+    strips = int(round(count * multizone))
+    chains = int(round(count * tiles))
+    bulbs = []
+    for i in range(count):
+        mac = f"{LIFX_OUI}:{(i >> 16) & 0xff:02x}:{(i >> 8) & 0xff:02x}:{i & 0xff:02x}"
+        group = group_list[i % len(group_list)]
+        location = location_list[i % len(location_list)]
+        if i < strips:
+            bulb = VirtualBulb(mac, f"Strip {i + 1}", PRODUCT_LIFX_Z, group, location, zones=zones)
+        elif i < strips + chains:
+            bulb = VirtualBulb(mac, f"Tiles {i + 1}", PRODUCT_TILE, group, location, tiles=chain)
+        else:
+            product = PRODUCT_COLOR_1000 if i % 2 else PRODUCT_WHITE_800
+            bulb = VirtualBulb(mac, f"Bulb {i + 1}", product, group, location)
+        bulbs.append(bulb)
+    return bulbs
+
+
+########################################
+# Make lifxlan send its broadcasts to the fleet instead of the LAN broadcast addresses
+########################################
+def point_lifxlan_at(host, port=DEFAULT_FLEET_PORT):
+    device_module = sys.modules["lifxlan.device"] if "lifxlan.device" in sys.modules else __import__("lifxlan.device", fromlist=["device"])
+    device_module.UDP_BROADCAST_IP_ADDRS = [host]
+    device_module.UDP_BROADCAST_PORT = port
+    lan_module = __import__("lifxlan.lifxlan", fromlist=["lifxlan"])
+    lan_module.UDP_BROADCAST_PORT = port
+
+
+def raise_file_limit(needed):
+    if resource is None:
+        return False
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft >= needed:
+        return True
+    target = needed if hard == resource.RLIM_INFINITY else min(hard, needed)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    except (ValueError, OSError):
+        return False
+    return target >= needed
+
+
+class VirtualFleet(object):
+
+    ########################################
+    #   delay is the minimum time before a bulb replies, jitter a random extra on top of it (seconds)
+    #   loss is the fraction of replies that are dropped
+    #   shared_port answers everything on the discovery port instead of giving each bulb its own
+    ########################################
+    def __init__(self, bulbs, host="127.0.0.1", port=DEFAULT_FLEET_PORT, delay=0.0, jitter=0.0, loss=0.0, shared_port=False, seed=None):
+        self.logger = logging.getLogger("Plugin.Fleet")
+        self.bulbs = bulbs
+        self.by_mac = {bulb.mac_bytes: bulb for bulb in bulbs}
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.shared_port = shared_port
+        self.rng = random.Random(seed)
+
+        self.selector = selectors.DefaultSelector()
+        self.sock = None
+        self.delayed = []           # heap of (due, counter, sock, data, addr)
+        self.counter = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+        self.received = 0
+        self.replies = 0
+        self.lost = 0
+        self.by_type = dict()
+
+        self.handlers = {
+            MSG_IDS[GetService]: self.get_service,
+            MSG_IDS[GetHostInfo]: self.get_host_info,
+            MSG_IDS[GetHostFirmware]: self.get_host_firmware,
+            MSG_IDS[GetWifiInfo]: self.get_wifi_info,
+            MSG_IDS[GetWifiFirmware]: self.get_wifi_firmware,
+            MSG_IDS[GetPower]: self.get_power,
+            MSG_IDS[SetPower]: self.set_power,
+            MSG_IDS[GetLabel]: self.get_label,
+            MSG_IDS[SetLabel]: self.set_label,
+            MSG_IDS[GetVersion]: self.get_version,
+            MSG_IDS[GetInfo]: self.get_info,
+            MSG_IDS[GetLocation]: self.get_location,
+            MSG_IDS[GetGroup]: self.get_group,
+            MSG_IDS[EchoRequest]: self.echo,
+            MSG_IDS[LightGet]: self.light_get,
+            MSG_IDS[LightSetColor]: self.light_set_color,
+            MSG_IDS[LightGetPower]: self.light_get_power,
+            MSG_IDS[LightSetPower]: self.light_set_power,
+            MSG_IDS[LightGetInfrared]: self.get_infrared,
+            MSG_IDS[LightSetInfrared]: self.set_infrared,
+            MSG_IDS[MultiZoneGetColorZones]: self.get_color_zones,
+            MSG_IDS[MultiZoneSetColorZones]: self.set_color_zones,
+            MSG_IDS[GetDeviceChain]: self.get_device_chain,
+            MSG_IDS[SetUserPosition]: self.set_user_position,
+            MSG_IDS[GetTileState64]: self.get_tile_state,
+            MSG_IDS[SetTileState64]: self.set_tile_state,
+        }
+
+    ########################################
+    # Socket setup and teardown
+    ########################################
+    def open(self):
+        self.sock = self.bind(self.port)
+        self.port = self.sock.getsockname()[1]
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+
+        if not self.shared_port and not raise_file_limit(len(self.bulbs) + 256):
+            self.logger.warning(f"Not enough file descriptors for {len(self.bulbs)} bulb sockets, all bulbs will share port {self.port}")
+            self.shared_port = True
+
+        for bulb in self.bulbs:
+            if self.shared_port:
+                bulb.sock, bulb.port = self.sock, self.port
+            else:
+                bulb.sock = self.bind(0)
+                bulb.port = bulb.sock.getsockname()[1]
+                self.selector.register(bulb.sock, selectors.EVENT_READ, bulb)
+
+        start = time.perf_counter()
+        for bulb in self.bulbs:
+            self.pack_static(bulb)
+        self.logger.debug(f"static replies for {len(self.bulbs)} bulbs packed in {time.perf_counter() - start:.2f} seconds")
+
+    ########################################
+    # Only the discovery socket shares its port.  lifxlan binds its client sockets to ephemeral ports with
+    # SO_REUSEADDR, and if the bulb sockets allowed it too a client could be handed a bulb's port.
+    ########################################
+    def bind(self, port):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        sock.bind((self.host, port))
+        sock.setblocking(False)
+        return sock
+
+    def close(self):
+        for key in list(self.selector.get_map().values()):
+            self.selector.unregister(key.fileobj)
+            key.fileobj.close()
+        self.selector.close()
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.serve_forever, args=(self.stop_event,), name="LIFXFleet", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    ########################################
+    # Receive loop
+    ########################################
+    def serve_forever(self, stop_event=None):
+        stop_event = stop_event or self.stop_event
+        while not stop_event.is_set():
+            self.serve_once()
+
+    def serve_once(self, idle=0.1):
+        timeout = idle
+        if self.delayed:
+            timeout = max(0.0, min(idle, self.delayed[0][0] - time.perf_counter()))
+        for key, _ in self.selector.select(timeout):
+            while True:
+                try:
+                    data, addr = key.fileobj.recvfrom(2048)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except socket.error as err:
+                    self.logger.error(f"recvfrom failed: {err}")
+                    break
+                self.handle_datagram(data, addr, key.data)
+        self.send_due()
+
+    ########################################
+    # Work out which bulbs a datagram is for.  On a bulb's own port that's just the bulb (real bulbs answer
+    # tagged requests sent straight to them).  On the discovery port it's every bulb for a tagged or
+    # broadcast request, or the one bulb with the target MAC.
+    ########################################
+    def handle_datagram(self, data, addr, bulb):
+        header = peek_header(data)
+        if header is None or header.msg_type not in REQUEST_TYPES:
+            return
+        if bulb is not None:
+            if header.tagged or header.target == BROADCAST_TARGET or header.target == bulb.mac_bytes:
+                targets = (bulb,)
+            else:
+                return
+        elif header.tagged or header.target == BROADCAST_TARGET:
+            targets = self.bulbs
+        else:
+            bulb = self.by_mac.get(header.target)
+            if bulb is None:
+                return
+            targets = (bulb,)
+
+        self.received += 1
+        self.by_type[header.msg_type] = self.by_type.get(header.msg_type, 0) + 1
+        message = unpack_lifx_message(data)
+        handler = self.handlers.get(header.msg_type)
+        for bulb in targets:
+            if message.ack_requested:
+                self.reply(bulb, addr, Acknowledgement(bulb.mac, message.source_id, message.seq_num, None, False, False).packed_message)
+            if handler:
+                for reply in handler(bulb, message):
+                    self.reply(bulb, addr, reply)
+
+    ########################################
+    # Queue a reply from a bulb, after the configured delay, unless the simulated network loses it
+    ########################################
+    def reply(self, bulb, addr, data):
+        if self.loss and self.rng.random() < self.loss:
+            self.lost += 1
+            return
+        delay = self.delay + (self.rng.uniform(0.0, self.jitter) if self.jitter else 0.0)
+        if delay <= 0.0:
+            self.sendto(bulb.sock, data, addr)
+        else:
+            self.counter += 1
+            heapq.heappush(self.delayed, (time.perf_counter() + delay, self.counter, bulb.sock, data, addr))
+
+    def send_due(self):
+        now = time.perf_counter()
+        while self.delayed and self.delayed[0][0] <= now:
+            _, _, sock, data, addr = heapq.heappop(self.delayed)
+            self.sendto(sock, data, addr)
+
+    def sendto(self, sock, data, addr):
+        try:
+            sock.sendto(data, addr)
+            self.replies += 1
+        except socket.error as err:
+            self.lost += 1
+            self.logger.debug(f"sendto {addr} failed: {err}")
+
+    ########################################
+    # Replies that only depend on things that never change (product, firmware, group...) are packed once per
+    # bulb, when the fleet opens, and re-stamped with each request's source and sequence number.  Packing them
+    # on demand would stall the first discovery of a big fleet for seconds.
+    ########################################
+    @staticmethod
+    def pack_static(bulb):
+        location, location_label, location_updated = bulb.location
+        group, group_label, group_updated = bulb.group
+        payloads = {
+            StateService: {"service": 1, "port": bulb.port},
+            StateHostInfo: {"signal": 0, "tx": 0, "rx": 0, "reserved1": 0},
+            StateHostFirmware: HOST_FIRMWARE,
+            StateWifiInfo: {"signal": 1000, "tx": 0, "rx": 0, "reserved1": 0},
+            StateWifiFirmware: WIFI_FIRMWARE,
+            StateVersion: {"vendor": 1, "product": bulb.product, "version": 0},
+            StateLocation: {"location": location, "label": location_label, "updated_at": location_updated},
+            StateGroup: {"group": group, "label": group_label, "updated_at": group_updated},
+        }
+        bulb.cache = {replyClass: bytes(replyClass(bulb.mac, 0, 0, payload, False, False).packed_message) for replyClass, payload in payloads.items()}
+
+    @staticmethod
+    def static(bulb, message, replyClass):
+        data = bytearray(bulb.cache[replyClass])
+        _source_seq(data, 4, message.source_id)
+        data[23] = message.seq_num
+        return data
+
+    @staticmethod
+    def state(bulb, message, replyClass, payload):
+        return replyClass(bulb.mac, message.source_id, message.seq_num, payload, False, False).packed_message
+
+    ########################################
+    #   Message handlers.  Each returns a list of packed replies from one bulb; the Ack is handled above.
+    #   Set messages only get a state reply if the client asked for one.
+    ########################################
+    def get_service(self, bulb, message):
+        return [self.static(bulb, message, StateService)]
+
+    def get_host_info(self, bulb, message):
+        return [self.static(bulb, message, StateHostInfo)]
+
+    def get_host_firmware(self, bulb, message):
+        return [self.static(bulb, message, StateHostFirmware)]
+
+    def get_wifi_info(self, bulb, message):
+        return [self.static(bulb, message, StateWifiInfo)]
+
+    def get_wifi_firmware(self, bulb, message):
+        return [self.static(bulb, message, StateWifiFirmware)]
+
+    def get_version(self, bulb, message):
+        return [self.static(bulb, message, StateVersion)]
+
+    def get_location(self, bulb, message):
+        return [self.static(bulb, message, StateLocation)]
+
+    def get_group(self, bulb, message):
+        return [self.static(bulb, message, StateGroup)]
+
+    def get_info(self, bulb, message):
+        now = time.time_ns()
+        return [self.state(bulb, message, StateInfo, {"time": now, "uptime": now - BOOT_TIME_NS, "downtime": 0})]
+
+    def echo(self, bulb, message):
+        return [self.state(bulb, message, EchoResponse, {"byte_array": message.byte_array})]
+
+    def get_power(self, bulb, message):
+        return [self.state(bulb, message, StatePower, {"power_level": bulb.power})]
+
+    def set_power(self, bulb, message):
+        bulb.power = 65535 if message.power_level else 0
+        return self.get_power(bulb, message) if message.response_requested else []
+
+    def get_label(self, bulb, message):
+        return [self.state(bulb, message, StateLabel, {"label": bulb.label})]
+
+    def set_label(self, bulb, message):
+        bulb.label = message.label.rstrip("\x00") if isinstance(message.label, str) else message.label.decode("utf-8", "replace").rstrip("\x00")
+        return self.get_label(bulb, message) if message.response_requested else []
+
+    def light_get(self, bulb, message):
+        payload = {"color": bulb.color, "power_level": bulb.power, "label": bulb.label, "reserved1": 0, "reserved2": 0}
+        return [self.state(bulb, message, LightState, payload)]
+
+    def light_set_color(self, bulb, message):
+        color = tuple(message.color)
+        if bulb.product == PRODUCT_WHITE_800:
+            color = (0, 0, color[2], color[3])      # no hue or saturation on a white bulb
+        bulb.color = color
+        bulb.zones = [color] * len(bulb.zones)
+        for tile in bulb.tiles:
+            tile["colors"] = [color] * len(tile["colors"])
+        return self.light_get(bulb, message) if message.response_requested else []
+
+    def light_get_power(self, bulb, message):
+        return [self.state(bulb, message, LightStatePower, {"power_level": bulb.power})]
+
+    def light_set_power(self, bulb, message):
+        bulb.power = 65535 if message.power_level else 0
+        return self.light_get_power(bulb, message) if message.response_requested else []
+
+    def get_infrared(self, bulb, message):
+        return [self.state(bulb, message, LightStateInfrared, {"infrared_brightness": bulb.infrared})]
+
+    def set_infrared(self, bulb, message):
+        bulb.infrared = message.infrared_brightness
+        return self.get_infrared(bulb, message) if message.response_requested else []
+
+    ########################################
+    # Multizone.  A single zone comes back as a MultiZoneStateZone, a range as MultiZoneStateMultiZone
+    # messages of 8 zones each.
+    ########################################
+    def zone_states(self, bulb, message, start, end):
+        count = len(bulb.zones)
+        end = min(end, count - 1)
+        if start > end:
+            return []
+        if start == end:
+            return [self.state(bulb, message, MultiZoneStateZone, {"count": count, "index": start, "color": bulb.zones[start]})]
+        replies = []
+        for index in range(start, end + 1, ZONES_PER_MESSAGE):
+            colors = bulb.zones[index:index + ZONES_PER_MESSAGE]
+            colors += [(0, 0, 0, 0)] * (ZONES_PER_MESSAGE - len(colors))
+            replies.append(self.state(bulb, message, MultiZoneStateMultiZone, {"count": count, "index": index, "color": colors}))
+        return replies
+
+    def get_color_zones(self, bulb, message):
+        if not bulb.zones:
+            return []
+        return self.zone_states(bulb, message, message.start_index, message.end_index)
+
+    def set_color_zones(self, bulb, message):
+        if not bulb.zones:
+            return []
+        for index in range(message.start_index, min(message.end_index, len(bulb.zones) - 1) + 1):
+            bulb.zones[index] = tuple(message.color)
+        return self.zone_states(bulb, message, message.start_index, message.end_index) if message.response_requested else []
+
+    ########################################
+    # Tile chains
+    ########################################
+    def get_device_chain(self, bulb, message):
+        if not bulb.tiles:
+            return []
+        entries = []
+        for slot in range(CHAIN_SLOTS):
+            tile = bulb.tiles[slot] if slot < len(bulb.tiles) else None
+            entries.append({"reserved1": 0, "reserved2": 0, "reserved3": 0, "reserved4": 0,
+                            "user_x": tile["user_x"] if tile else 0.0, "user_y": tile["user_y"] if tile else 0.0,
+                            "width": TILE_SIZE if tile else 0, "height": TILE_SIZE if tile else 0, "reserved5": 0,
+                            "device_version_vendor": 1 if tile else 0, "device_version_product": bulb.product if tile else 0,
+                            "device_version_version": 0, "firmware_build": HOST_FIRMWARE["build"] if tile else 0, "reserved6": 0,
+                            "firmware_version": HOST_FIRMWARE["version"] if tile else 0, "reserved7": 0})
+        payload = {"start_index": 0, "total_count": len(bulb.tiles), "tile_devices": entries}
+        return [self.state(bulb, message, StateDeviceChain, payload)]
+
+    def set_user_position(self, bulb, message):
+        if message.tile_index < len(bulb.tiles):
+            bulb.tiles[message.tile_index]["user_x"] = message.user_x
+            bulb.tiles[message.tile_index]["user_y"] = message.user_y
+        return []
+
+    def tile_states(self, bulb, message):
+        replies = []
+        for index in range(message.tile_index, min(message.tile_index + max(1, message.length), len(bulb.tiles))):
+            payload = {"tile_index": index, "reserved": 0, "x": message.x, "y": message.y, "width": message.width,
+                       "colors": bulb.tiles[index]["colors"]}
+            replies.append(self.state(bulb, message, StateTileState64, payload))
+        return replies
+
+    def get_tile_state(self, bulb, message):
+        return self.tile_states(bulb, message) if bulb.tiles else []
+
+    def set_tile_state(self, bulb, message):
+        if not bulb.tiles:
+            return []
+        for index in range(message.tile_index, min(message.tile_index + max(1, message.length), len(bulb.tiles))):
+            bulb.tiles[index]["colors"] = [tuple(color) for color in message.colors]
+        return self.tile_states(bulb, message) if message.response_requested else []
+
+    def stats(self):
+        return {"received": self.received, "replies": self.replies, "lost": self.lost, "queued": len(self.delayed),
+                "by_type": {type_name(msg_type): count for msg_type, count in sorted(self.by_type.items())}}
+
+
+def type_name(msg_type):
+    for cls, msg_id in MSG_IDS.items():
+        if msg_id == msg_type:
+            return cls.__name__
+    return str(msg_type)
+
+
+########################################
+# Time some lifxlan workflows against a running fleet
+########################################
+def benchmark_lifxlan(fleet):
+    from lifxlan import LifxLAN, MultiZoneLight, TileChain
+
+    point_lifxlan_at(fleet.host, fleet.port)
+    results = []
+
+    def timed(label, func):
+        start = time.perf_counter()
+        try:
+            value = func()
+            outcome = "ok"
+        except Exception as err:
+            value = None
+            outcome = f"failed: {err}"
+        results.append((label, time.perf_counter() - start, outcome))
+        return value
+
+    lan = LifxLAN(num_lights=len(fleet.bulbs))
+    devices = timed(f"discover_devices ({len(fleet.bulbs)} bulbs)", lan.get_devices) or []
+    results.append((f"  found {len(devices)} devices", 0.0, ""))
+
+    group_label = fleet.bulbs[0].group[1]
+    group = timed(f"get_devices_by_group('{group_label}')", lambda: lan.get_devices_by_group(group_label))
+    if group:
+        members = len(group.get_device_list())
+        timed(f"Group.set_power on ({members} bulbs)", lambda: group.set_power("on"))
+        timed(f"Group.set_color ({members} bulbs)", lambda: group.set_color([21845, 65535, 65535, 3500]))
+
+    strips = [device for device in devices if isinstance(device, MultiZoneLight)]
+    if strips:
+        timed(f"MultiZoneLight.get_color_zones ({len(fleet.bulbs[0].zones)} zones)", strips[0].get_color_zones)
+    chains = [device for device in devices if isinstance(device, TileChain)]
+    if chains:
+        timed(f"TileChain.get_tilechain_colors ({chains[0].get_tile_count()} tiles)", chains[0].get_tilechain_colors)
+        colors = [[(0, 0, 65535, 3500)] * (TILE_SIZE * TILE_SIZE)] * chains[0].get_tile_count()
+        timed("TileChain.set_tilechain_colors", lambda: chains[0].set_tilechain_colors(colors))
+
+    for label, seconds, outcome in results:
+        print(f"{label:<50} {seconds * 1000.0:>10.1f} ms  {outcome}" if outcome else label)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="lifxbridge.fleet", description="Emulate a fleet of LIFX bulbs on loopback")
+    parser.add_argument("--bulbs", type=int, default=100, help="number of bulbs")
+    parser.add_argument("--multizone", type=float, default=0.0, help="fraction of the fleet that are LIFX Z strips")
+    parser.add_argument("--tiles", type=float, default=0.0, help="fraction of the fleet that are tile chains")
+    parser.add_argument("--zones", type=int, default=16, help="zones per strip")
+    parser.add_argument("--chain", type=int, default=5, help="tiles per chain")
+    parser.add_argument("--groups", type=int, default=10, help="number of groups")
+    parser.add_argument("--locations", type=int, default=2, help="number of locations")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds before a bulb replies")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra reply delay, up to this many seconds")
+    parser.add_argument("--loss", type=float, default=0.0, help="fraction of replies to drop")
+    parser.add_argument("--host", default="127.0.0.1", help="address to bind to")
+    parser.add_argument("--port", type=int, default=DEFAULT_FLEET_PORT, help="discovery port")
+    parser.add_argument("--shared-port", action="store_true", help="answer for every bulb on the discovery port")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for group/location IDs and the loss model")
+    parser.add_argument("--benchmark", action="store_true", help="time lifxlan workflows against the fleet, then exit")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)8s] %(name)s: %(message)s")
+
+    bulbs = generate_fleet(args.bulbs, args.multizone, args.tiles, args.zones, args.chain, args.groups, args.locations, args.seed)
+    fleet = VirtualFleet(bulbs, args.host, args.port, args.delay, args.jitter, args.loss, args.shared_port, args.seed)
+    fleet.open()
+    logging.getLogger("Plugin.Fleet").info(f"Emulating {len(bulbs)} bulbs, discovery on {args.host}:{fleet.port} (pid {os.getpid()})")
+    try:
+        if args.benchmark:
+            fleet.start()
+            benchmark_lifxlan(fleet)
+            fleet.stop()
+        else:
+            fleet.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.getLogger("Plugin.Fleet").info(f"fleet stats: {fleet.stats()}")
+        fleet.close()
+
+
+if __name__ == "__main__":
+    main()
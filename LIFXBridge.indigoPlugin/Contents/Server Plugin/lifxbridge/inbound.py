@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Priority queues for inbound requests.
+#
+# Set commands are what people notice: a light that takes a second to turn on.  Discovery is background
+# work, and expensive, since every GetService is answered once per published device.  The engine reads every
+# datagram waiting on the socket, routes it and sorts it into these queues by its raw header, then handles
+# the queued requests in priority order, going back to the socket between requests so a command that
+# arrives in the middle of a discovery storm goes straight to the front:
+#
+#   set         always first, in arrival order
+#   query       next, in arrival order, but every QUERY_RUN queries in a row a waiting discovery request
+#               gets a turn, so discovery can't be starved
+#   discovery   last, round robin between clients (ip, source), so one client's burst doesn't hold up
+#               another client's discovery
+#
+# Each queue is bounded; a request that arrives when its queue is full is dropped and counted.  The classes
+# are the rate limiter's.  With prioritize turned off everything goes through the query queue, first come
+# first served.  The engine can hold the set queue back (while an "all devices" command is still running, so
+# commands reach each device in order) and go on with the rest.
+####################
+
+from collections import deque, OrderedDict
+
+from .ratelimit import request_class, DISCOVERY, QUERY, SET
+
+DEFAULT_LIMITS = {SET: 256, QUERY: 512, DISCOVERY: 256}
+DISCOVERY_PER_CLIENT = 16
+QUERY_RUN = 8
+
+
+class InboundQueue(object):
+
+    def __init__(self, limits=None):
+        self.limits = dict(limits or DEFAULT_LIMITS)
+        self.prioritize = True
+        self.sets = deque()                 # (header, data, addr, arrived)
+        self.queries = deque()
+        self.discovery = OrderedDict()      # (ip, source) -> deque, in round robin order
+        self.discovery_count = 0
+        self.query_run = 0
+        self.dropped = {DISCOVERY: 0, QUERY: 0, SET: 0}
+
+    ########################################
+    # Queue a request that arrived at arrived (perf_counter_ns).  Returns False if it was dropped.
+    ########################################
+    def push(self, header, data, addr, arrived):
+        name = request_class(header) if self.prioritize else QUERY
+        entry = (header, data, addr, arrived)
+        if name == SET:
+            queue, count = self.sets, len(self.sets)
+        elif name == QUERY:
+            queue, count = self.queries, len(self.queries)
+        else:
+            key = (addr[0], header.source)
+            queue = self.discovery.get(key)
+            if queue is None:
+                queue = self.discovery[key] = deque()
+            count = self.discovery_count
+            if len(queue) >= DISCOVERY_PER_CLIENT:
+                count = self.limits[DISCOVERY]
+        if count >= self.limits[name]:
+            self.dropped[name] += 1
+            if name == DISCOVERY and not queue:
+                del self.discovery[(addr[0], header.source)]
+            return False
+        queue.append(entry)
+        if name == DISCOVERY:
+            self.discovery_count += 1
+        return True
+
+    ########################################
+    # The next request to handle, as (class, header, data, addr, arrived), or None if there isn't one.  With
+    # sets False the set queue is left alone.
+    ########################################
+    def pop(self, sets=True):
+        if sets and self.sets:
+            return (SET,) + self.sets.popleft()
+        if self.queries and (self.query_run < QUERY_RUN or not self.discovery_count):
+            self.query_run += 1
+            return (QUERY,) + self.queries.popleft()
+        self.query_run = 0
+        if self.discovery_count:
+            key, queue = next(iter(self.discovery.items()))
+            entry = queue.popleft()
+            if queue:
+                self.discovery.move_to_end(key)     # the client goes to the back of the line
+            else:
+                del self.discovery[key]
+            self.discovery_count -= 1
+            return (DISCOVERY,) + entry
+        return None
+
+    def pending(self, sets=True):
+        return (len(self.sets) if sets else 0) + len(self.queries) + self.discovery_count
+
+    def stats(self):
+        stats = {f"dropped_{name}": count for name, count in self.dropped.items()}
+        stats.update(sets=len(self.sets), queries=len(self.queries), discovery=self.discovery_count,
+                     discovery_clients=len(self.discovery))
+        return stats
@@ -0,0 +1,181 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# DeviceBackend for devices in the Indigo database.  Only importable inside the Indigo plugin host.
+####################
+
+import base64
+import colorsys
+import logging
+import os
+
+import indigo
+
+from .backend import DeviceBackend, DeviceNotFound, fakeMAC, PRODUCT_COLOR_1000, PRODUCT_WHITE_800
+from .registry import PublishedDevice
+
+PUBLISHED_KEY = "published"
+ALT_NAME_KEY = "alternate-name"
+MAC_KEY = "fakeMAC"
+TARGET_KEY = "target"
+LOCATION_KEY = "location"
+
+
+class IndigoBackend(DeviceBackend):
+
+    def __init__(self):
+        self.logger = logging.getLogger("Plugin.IndigoBackend")
+
+    ########################################
+    # Scan the Indigo database for published devices.  Devices published before locations were added get one.
+    ########################################
+    def published_devices(self):
+        devices = list()
+        for dev in indigo.devices:
+            props = dev.pluginProps
+            if PUBLISHED_KEY in props:
+                if not props.get(LOCATION_KEY, None):
+                    props[LOCATION_KEY] = base64.b64encode(bytearray(os.urandom(16)))
+                    dev.replacePluginPropsOnServer(props)
+                device = self.published_device(dev, props)
+                self.logger.debug(f"found published device: {dev.id:d} - {dev.name} ({device.alias}) - {device.mac}")
+                devices.append(device)
+        return devices
+
+    ########################################
+    # Build the registry entry for a published Indigo device
+    ########################################
+    @staticmethod
+    def published_device(dev, props):
+        location = bytearray(base64.b64decode(props[LOCATION_KEY]))
+        return PublishedDevice(dev.id, dev.name, props.get(ALT_NAME_KEY, ""), props.get(MAC_KEY, fakeMAC(dev.id)), location)
+
+    @staticmethod
+    def indigo_device(deviceId):
+        try:
+            return indigo.devices[deviceId]
+        except (Exception,):
+            raise DeviceNotFound(deviceId)
+
+    ########################################
+    # Turn on/off a device
+    #
+    #   deviceId is the ID of the device in Indigo
+    #   turnOn is a boolean to indicate on/off
+    ########################################
+    def set_power(self, deviceId, turnOn):
+        self.logger.debug(f"Set on state of device {deviceId:d} to {turnOn}")
+        try:
+            if turnOn:
+                indigo.device.turnOn(deviceId)
+            else:
+                indigo.device.turnOff(deviceId)
+        except (Exception,):
+            raise DeviceNotFound(deviceId)
+        return True
+
+    ########################################
+    # Get the brightness of a device
+    #
+    #   deviceId is the ID of the device in Indigo
+    #   brightness is in the range 0-65535 (LIFX range)
+    ########################################
+    def get_brightness(self, deviceId):
+        iDev = self.indigo_device(deviceId)
+        if isinstance(iDev, indigo.DimmerDevice):
+            brightness = int((float(iDev.brightness) / 100.0) * 65535)  # adjust to LIFX range
+        else:
+            brightness = int(iDev.onState) * 65535
+        self.logger.debug(f"getDeviceBrightness: {deviceId} is {brightness}")
+        return brightness
+
+    ########################################
+    # Set the color of a device
+    #
+    #   deviceId is the ID of the device in Indigo
+    #    hue, saturation, brightness are in the range 0-65535 (LIFX range)
+    ########################################
+    def set_color(self, deviceId, hue, saturation, brightness, kelvin):
+        self.logger.debug(f"setDeviceColor for {deviceId}: hue = {hue}, saturation = {saturation}, brightness = {brightness}, color = {kelvin}")
+        iDev = self.indigo_device(deviceId)
+
+        if isinstance(iDev, indigo.DimmerDevice):
+            if not iDev.supportsRGB:
+                adjusted = int(round(float(brightness / 65535.0) * 100.0))  # adjust to Indigo range
+                self.logger.debug(f"setDeviceColor: {deviceId:d} to {adjusted:d} (non-RGB)")
+                indigo.dimmer.setBrightness(iDev, value=adjusted)
+            else:
+                adj_hue = float(hue) / 65535.0
+                adj_sat = float(saturation) / 65535.0
+                adj_val = float(brightness) / 65535.0
+                self.logger.debug(f"setDeviceColor adjusted: hue = {adj_hue}, saturation = {adj_sat}, brightness = {adj_val}")
+                rgb_color = colorsys.hsv_to_rgb(adj_hue, adj_sat, adj_val)
+                self.logger.debug(f"setDeviceColor hsv_to_rgb = {rgb_color}")
+                adj_red = (rgb_color[0] * 100.0)
+                adj_green = (rgb_color[1] * 100.0)
+                adj_blue = (rgb_color[2] * 100.0)
+                self.logger.debug(f"setColorLevels: {deviceId} to red = {adj_red}, green = {adj_green}, blue = {adj_blue}")
+                indigo.dimmer.setColorLevels(iDev, adj_red, adj_green, adj_blue, 0, 0, 0)
+        else:
+            self.logger.debug(f"Device with id {deviceId} doesn't support dimming.")
+        return True     # nothing to do for an on/off device, but it's not a failure
+
+    ########################################
+    # Get the color of a device
+    #
+    #   deviceId is the ID of the device in Indigo
+    #   returns (hue, saturation, brightness, kelvin) in the LIFX ranges
+    ########################################
+    def get_color(self, deviceId):
+        iDev = self.indigo_device(deviceId)
+
+        if isinstance(iDev, indigo.DimmerDevice):
+            if not iDev.supportsRGB:
+                adj_hue = 0
+                adj_sat = 0
+                adj_val = int((iDev.brightness / 100.0) * 65535)
+                temp = 3000
+
+            else:
+                red = iDev.redLevel / 100.0  # normalize first
+                green = iDev.greenLevel / 100.0
+                blue = iDev.blueLevel / 100.0
+                hsv_color = colorsys.rgb_to_hsv(red, green, blue)
+
+                adj_hue = int(hsv_color[0] * 65535)  # convert to LIFX
+                adj_sat = int(hsv_color[1] * 65535)
+                adj_val = int(hsv_color[2] * 65535)
+                temp = iDev.whiteTemperature
+                if not temp:
+                    temp = 3000
+
+        else:
+            adj_hue = 0
+            adj_sat = 0
+            adj_val = int(iDev.onState * 65535)
+            temp = 3000
+
+        self.logger.debug(f"getDeviceColor of device {deviceId}: hue = {adj_hue}, sat = {adj_sat}, val = {adj_val}, temp = {temp}")
+        return adj_hue, adj_sat, adj_val, temp
+
+    ########################################
+    # Get the power state of a device
+    #
+    #   deviceId is the ID of the device in Indigo
+    #   power is 0 or 65535 (LIFX range)
+    ########################################
+    def get_power(self, deviceId):
+        return int(self.indigo_device(deviceId).onState) * 65535
+
+    def get_product(self, deviceId):
+        iDev = self.indigo_device(deviceId)
+        if isinstance(iDev, indigo.DimmerDevice) and iDev.supportsRGB:
+            return PRODUCT_COLOR_1000
+        return PRODUCT_WHITE_800
+
+    ########################################
+    # The devices in a folder that can be turned on and off, in name order, for zone strips
+    ########################################
+    def folder_devices(self, folderId):
+        devices = [dev for dev in indigo.devices if dev.folderId == folderId and hasattr(dev, "onState")]
+        return [dev.id for dev in sorted(devices, key=lambda dev: dev.name)]
@@ -0,0 +1,297 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Load generator for the bridge, or any other LIFX endpoint.
+#
+# lifxlan's broadcast_with_resp and req_with_resp send one request and block until it times out.  This sends a
+# mix of requests at a fixed rate from many simulated clients (source IDs) without waiting for the replies,
+# tracks every outstanding request by (source, seq), and reports throughput, loss and a latency histogram.
+# Requests are packed with the lifxlan codec.
+#
+#   cd "LIFXBridge.indigoPlugin/Contents/Server Plugin"
+#   python -m lifxbridge.loadgen --host 127.0.0.1 --rate 500 --duration 10 --mix LightGet=6,SetPower=2,GetService=1
+#   python -m lifxbridge.loadgen --ramp 100,200,500,1000,2000          # find the saturation point
+#
+# A request counts as answered when its first reply arrives, so the same mix works against the bridge and
+# against real bulbs.  Unanswered requests are counted as lost once they're older than --timeout.
+####################
+
+import argparse
+import bisect
+import random
+import select
+import socket
+import sys
+import time
+
+from lifxlan.message import BROADCAST_MAC
+from lifxlan.msgtypes import *
+
+from .bench import Template, percentile, ms
+from .engine import DEFAULT_LIFX_PORT
+from .router import peek_header
+
+HISTOGRAM_BUCKETS_MS = (0.25, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# message name -> (request for a given MAC, tagged).  Set commands ask for an Ack so there's always a reply.
+REQUESTS = {
+    "GetService": (lambda mac: GetService(BROADCAST_MAC, 0, 0, {}, False, False), True),
+    "GetPower": (lambda mac: GetPower(mac, 0, 0, {}, False, False), False),
+    "GetLabel": (lambda mac: GetLabel(mac, 0, 0, {}, False, False), False),
+    "GetVersion": (lambda mac: GetVersion(mac, 0, 0, {}, False, False), False),
+    "GetLocation": (lambda mac: GetLocation(mac, 0, 0, {}, False, False), False),
+    "GetGroup": (lambda mac: GetGroup(mac, 0, 0, {}, False, False), False),
+    "LightGet": (lambda mac: LightGet(mac, 0, 0, {}, False, False), False),
+    "LightGetPower": (lambda mac: LightGetPower(mac, 0, 0, {}, False, False), False),
+    "SetPower": (lambda mac: SetPower(mac, 0, 0, {"power_level": 65535}, True, False), False),
+    "LightSetPower": (lambda mac: LightSetPower(mac, 0, 0, {"power_level": 65535, "duration": 0}, True, False), False),
+    "LightSetColor": (lambda mac: LightSetColor(mac, 0, 0, {"color": (0, 0, 32768, 3500), "duration": 0}, True, False), False),
+    "EchoRequest": (lambda mac: EchoRequest(mac, 0, 0, {"byte_array": [0] * 64}, False, False), False),
+}
+
+DEFAULT_MIX = "LightGet=6,LightGetPower=2,SetPower=1,GetService=1"
+
+
+def mac_string(raw):
+    return ":".join(f"{b:02x}" for b in raw)
+
+
+def parse_mix(spec):
+    mix = []
+    for item in spec.split(","):
+        name, _, weight = item.partition("=")
+        name = name.strip()
+        if name not in REQUESTS:
+            raise ValueError(f"unsupported message type '{name}', choose from {', '.join(sorted(REQUESTS))}")
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+class Histogram(object):
+
+    def __init__(self, bounds=HISTOGRAM_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.samples = []
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.counts[bisect.bisect_left(self.bounds, seconds * 1000.0)] += 1
+
+    def lines(self, width=40):
+        total = len(self.samples) or 1
+        peak = max(self.counts) or 1
+        labels = [f"<= {bound:g} ms" for bound in self.bounds] + [f"> {self.bounds[-1]:g} ms"]
+        for label, count in zip(labels, self.counts):
+            if count:
+                yield f"    {label:>12} {count:>8} {count / total:>7.1%} {'#' * max(1, int(width * count / peak))}"
+
+
+class Stats(object):
+
+    def __init__(self):
+        self.sent = 0
+        self.answered = 0
+        self.lost = 0
+        self.histogram = Histogram()
+
+
+class LoadGenerator(object):
+
+    def __init__(self, host, port, sources, timeout):
+        self.addr = (host, port)
+        self.timeout = timeout
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.sock.bind(("", 0))
+        self.sock.setblocking(False)
+
+        # each simulated client has its own source ID and its own sequence numbers, starting at a random point
+        rng = random.Random()
+        self.sources = [rng.randint(2, 0xFFFFFFFF) for _ in range(sources)]
+        self.next_seq = {source: rng.randint(1, 255) for source in self.sources}
+        self.next_source = 0
+        self.pending = dict()       # (source, seq) -> (name, sent_at)
+
+    ########################################
+    # Find the devices at the endpoint with a GetService broadcast.  Returns a list of MAC strings.
+    ########################################
+    def discover(self, wait=1.0):
+        source = self.sources[0]
+        self.sock.sendto(GetService(BROADCAST_MAC, source, 0, {}, False, False).packed_message, self.addr)
+        macs = set()
+        deadline = time.perf_counter() + wait
+        while time.perf_counter() < deadline:
+            readable, _, _ = select.select([self.sock], [], [], deadline - time.perf_counter())
+            if readable:
+                header = peek_header(self.sock.recv(2048))
+                if header and header.source == source and header.msg_type == MSG_IDS[StateService]:
+                    macs.add(mac_string(header.target))
+        return sorted(macs)
+
+    ########################################
+    # Pick the next client round robin, and its next free sequence number.  Returns None if every client has
+    # all 255 sequence numbers outstanding.
+    ########################################
+    def allocate(self):
+        for _ in range(len(self.sources)):
+            source = self.sources[self.next_source]
+            self.next_source = (self.next_source + 1) % len(self.sources)
+            for _ in range(255):
+                seq = self.next_seq[source]
+                self.next_seq[source] = seq % 255 + 1
+                if (source, seq) not in self.pending:
+                    return source, seq
+        return None
+
+    ########################################
+    # Send requests drawn from templates at rate requests/sec for duration seconds, then wait up to timeout
+    # for the stragglers.  Returns a dict of message name -> Stats.
+    ########################################
+    def run(self, templates, rate, duration, rng):
+        names = list(templates)
+        weights = [templates[name][0] for name in names]
+        stats = {name: Stats() for name in names}
+        self.pending.clear()
+
+        interval = 1.0 / rate
+        start = time.perf_counter()
+        stop_sending = start + duration
+        next_send = start
+        while True:
+            now = time.perf_counter()
+            if now >= stop_sending and not self.pending:
+                break
+            if now > stop_sending + self.timeout:
+                break
+
+            # catch up on every send that's due, so the offered rate holds even if a select() overslept
+            while next_send <= now and next_send < stop_sending:
+                allocated = self.allocate()
+                if allocated is None:
+                    break
+                source, seq = allocated
+                name = rng.choices(names, weights)[0]
+                template = rng.choice(templates[name][1])
+                self.pending[(source, seq)] = (name, time.perf_counter())
+                try:
+                    self.sock.sendto(template.packet(source, seq), self.addr)
+                except BlockingIOError:
+                    pass    # the send buffer is full; the request will show up as lost
+                stats[name].sent += 1
+                next_send += interval
+
+            wait = max(0.0, min(next_send, stop_sending + self.timeout) - time.perf_counter())
+            readable, _, _ = select.select([self.sock], [], [], min(wait, 0.01))
+            while readable:
+                try:
+                    data = self.sock.recv(2048)
+                except BlockingIOError:
+                    break
+                received = time.perf_counter()
+                header = peek_header(data)
+                if header is None:
+                    continue
+                entry = self.pending.pop((header.source, header.seq), None)
+                if entry is None:
+                    continue
+                name, sent_at = entry
+                stats[name].answered += 1
+                stats[name].histogram.add(received - sent_at)
+
+            now = time.perf_counter()
+            for key, (name, sent_at) in list(self.pending.items()):
+                if now - sent_at > self.timeout:
+                    del self.pending[key]
+                    stats[name].lost += 1
+        for name, sent_at in self.pending.values():
+            stats[name].lost += 1
+        return stats
+
+    def close(self):
+        self.sock.close()
+
+
+def build_templates(mix, macs):
+    templates = dict()
+    for name, weight in mix:
+        factory, tagged = REQUESTS[name]
+        targets = [BROADCAST_MAC] if tagged else macs
+        templates[name] = (weight, [Template(factory(mac), 1) for mac in targets])
+    return templates
+
+
+def fmt_ms(seconds):
+    return "-" if seconds is None else ms(seconds)
+
+
+def print_report(rate, duration, stats, histograms):
+    sent = sum(s.sent for s in stats.values())
+    answered = sum(s.answered for s in stats.values())
+    lost = sum(s.lost for s in stats.values())
+    print(f"\noffered {rate:g} req/s for {duration:g} s: sent {sent}, answered {answered} ({answered / duration:.1f}/s), "
+          f"lost {lost} ({lost / max(sent, 1):.2%})")
+    print(f"  {'type':<16} {'sent':>8} {'answered':>9} {'lost':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for name, s in sorted(stats.items()):
+        ordered = sorted(s.histogram.samples)
+        p50, p90, p99, top = (fmt_ms(percentile(ordered, pct)) for pct in (50, 90, 99, 100))
+        print(f"  {name:<16} {s.sent:>8} {s.answered:>9} {s.lost:>6} {p50:>8} {p90:>8} {p99:>8} {top:>8}")
+        if histograms:
+            for line in s.histogram.lines():
+                print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="lifxbridge.loadgen", description="Send a mix of LIFX requests at a fixed rate and measure the replies")
+    parser.add_argument("--host", default="127.0.0.1", help="address of the LIFX endpoint (or a broadcast address)")
+    parser.add_argument("--port", type=int, default=DEFAULT_LIFX_PORT, help="LIFX port of the endpoint")
+    parser.add_argument("--rate", type=float, default=200.0, help="requests per second to offer")
+    parser.add_argument("--ramp", help="comma separated list of rates to step through, instead of --rate")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds to send at each rate")
+    parser.add_argument("--sources", type=int, default=16, help="number of simulated clients (source IDs)")
+    parser.add_argument("--timeout", type=float, default=1.0, help="seconds before an unanswered request counts as lost")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="message types and weights, e.g. LightGet=6,SetPower=1")
+    parser.add_argument("--loss-limit", type=float, default=0.01, help="loss fraction that marks the saturation point")
+    parser.add_argument("--no-histogram", dest="histograms", action="store_false", help="don't print latency histograms")
+    parser.add_argument("--seed", type=int, default=None, help="random seed for the request mix")
+    args = parser.parse_args()
+
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError as err:
+        parser.error(str(err))
+
+    generator = LoadGenerator(args.host, args.port, args.sources, args.timeout)
+    try:
+        macs = generator.discover()
+        if not macs:
+            print(f"No LIFX devices answered at {args.host}:{args.port}")
+            return 1
+        print(f"Found {len(macs)} devices at {args.host}:{args.port}")
+        templates = build_templates(mix, macs)
+
+        rng = random.Random(args.seed)
+        rates = [float(rate) for rate in args.ramp.split(",")] if args.ramp else [args.rate]
+        saturation = None
+        for rate in rates:
+            stats = generator.run(templates, rate, args.duration, rng)
+            print_report(rate, args.duration, stats, args.histograms)
+            sent = sum(s.sent for s in stats.values())
+            lost = sum(s.lost for s in stats.values())
+            if saturation is None and sent and lost / sent > args.loss_limit:
+                saturation = rate
+            time.sleep(args.timeout)    # let the endpoint drain before the next step
+    finally:
+        generator.close()
+
+    if args.ramp:
+        if saturation is None:
+            print(f"\nNo saturation up to {rates[-1]:g} req/s (loss stayed under {args.loss_limit:.1%})")
+        else:
+            print(f"\nSaturated at {saturation:g} req/s (loss over {args.loss_limit:.1%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# DeviceBackend that keeps its devices in memory, for running the bridge outside Indigo.
+#
+# Commands can be given an artificial latency so a load test sees roughly what an Indigo round trip costs.
+####################
+
+import os
+import threading
+import time
+
+from .backend import DeviceBackend, DeviceNotFound, fakeMAC, PRODUCT_COLOR_1000, PRODUCT_WHITE_800
+from .registry import PublishedDevice
+
+FIRST_DEVICE_ID = 100000000
+
+
+class MemoryDevice(object):
+    __slots__ = ("id", "name", "alias", "location", "rgb", "power", "hue", "saturation", "brightness", "kelvin")
+
+    def __init__(self, devID, name, alias="", rgb=False):
+        self.id = devID
+        self.name = name
+        self.alias = alias
+        self.location = bytearray(os.urandom(16))
+        self.rgb = rgb
+        self.power = 0
+        self.hue = 0
+        self.saturation = 0
+        self.brightness = 65535
+        self.kelvin = 3000
+
+
+class InMemoryBackend(DeviceBackend):
+
+    def __init__(self, command_latency=0.0):
+        self.command_latency = command_latency
+        self.devices = dict()
+        self.lock = threading.Lock()
+        self.commands = 0
+
+    ########################################
+    # Build a backend with count synthetic devices.  Every other device supports color.
+    ########################################
+    @classmethod
+    def synthetic(cls, count, command_latency=0.0):
+        backend = cls(command_latency)
+        for i in range(count):
+            backend.add_device(FIRST_DEVICE_ID + i, f"Synthetic {i + 1}", rgb=(i % 2 == 1))
+        return backend
+
+    def add_device(self, devID, name, alias="", rgb=False):
+        device = MemoryDevice(devID, name, alias, rgb)
+        with self.lock:
+            self.devices[devID] = device
+        return device
+
+    def remove_device(self, devID):
+        with self.lock:
+            self.devices.pop(devID, None)
+
+    def device(self, devID):
+        try:
+            return self.devices[devID]
+        except KeyError:
+            raise DeviceNotFound(devID)
+
+    def published_devices(self):
+        with self.lock:
+            devices = list(self.devices.values())
+        return [PublishedDevice(dev.id, dev.name, dev.alias, fakeMAC(dev.id), dev.location) for dev in devices]
+
+    def get_power(self, devID):
+        return self.device(devID).power
+
+    def get_brightness(self, devID):
+        dev = self.device(devID)
+        return dev.brightness if dev.power else 0
+
+    def get_color(self, devID):
+        dev = self.device(devID)
+        return dev.hue, dev.saturation, dev.brightness if dev.power else 0, dev.kelvin
+
+    def get_product(self, devID):
+        return PRODUCT_COLOR_1000 if self.device(devID).rgb else PRODUCT_WHITE_800
+
+    def set_power(self, devID, turnOn):
+        dev = self.device(devID)
+        self._command()
+        dev.power = 65535 if turnOn else 0
+        return True
+
+    def set_color(self, devID, hue, saturation, brightness, kelvin):
+        dev = self.device(devID)
+        self._command()
+        if dev.rgb:
+            dev.hue, dev.saturation = hue, saturation
+        dev.brightness, dev.kelvin = brightness, kelvin
+        dev.power = 65535 if brightness else 0
+        return True
+
+    def _command(self):
+        self.commands += 1
+        if self.command_latency:
+            time.sleep(self.command_latency)
@@ -0,0 +1,250 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Counters and latency histograms for the bridge.
+#
+# The metrics are plain dicts keyed by one label value (message type, drop reason, client address...), so
+# recording one is a lock, a dict lookup and an add.  Numbers that something else already keeps, like the
+# router's drop counts, are registered as callbacks and only read when the metrics are.  The registry can be
+# printed to the log, summarized into a handful of values for Indigo variables, and served in the Prometheus
+# text format on a loopback-only HTTP port.
+####################
+
+import bisect
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+# seconds; the interesting range runs from a cached Get (well under a millisecond) to a slow Indigo command
+DEFAULT_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+MAX_LABEL_VALUES = 256      # distinct label values per metric; any more are counted as "other"
+OTHER_LABEL = "other"
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def label_key(values, key):
+    if key in values or len(values) < MAX_LABEL_VALUES:
+        return key
+    return OTHER_LABEL
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Counter(object):
+    kind = "counter"
+
+    ########################################
+    #   label is the name of the one label this counter is broken down by, or None for a single value
+    ########################################
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.lock = threading.Lock()
+        self.values = dict() if label else {None: 0}
+
+    def inc(self, key=None, amount=1):
+        with self.lock:
+            key = label_key(self.values, key)
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+    def samples(self):
+        with self.lock:
+            return list(self.values.items())
+
+
+class Histogram(object):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, label=None, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.values = dict()        # label value -> [bucket counts (last one is +Inf), sum, count]
+
+    def observe(self, key, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            key = label_key(self.values, key)
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    ########################################
+    # Estimate the q quantile (0-1) from the buckets, interpolating within the bucket it falls in the same way
+    # Prometheus' histogram_quantile() does.  key None merges every label value.  Returns None if empty.
+    ########################################
+    def quantile(self, q, key=None):
+        with self.lock:
+            if key is None:
+                entries = list(self.values.values())
+            else:
+                entries = [self.values[key]] if key in self.values else []
+            counts = [sum(column) for column in zip(*(entry[0] for entry in entries))]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if index == len(self.buckets):
+                    return self.buckets[-1]     # in the +Inf bucket, the best we can say is "more than the last bound"
+                lower = self.buckets[index - 1] if index else 0.0
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def count(self, key=None):
+        with self.lock:
+            if key is not None:
+                return self.values[key][2] if key in self.values else 0
+            return sum(entry[2] for entry in self.values.values())
+
+    def samples(self):
+        with self.lock:
+            return [(key, list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+
+
+class Callback(object):
+
+    ########################################
+    # A metric read from somewhere else when the metrics are.  func returns a number, or a dict of
+    # label value -> number when label is set.
+    ########################################
+    def __init__(self, name, help_text, func, kind="gauge", label=None):
+        self.name = name
+        self.help = help_text
+        self.func = func
+        self.kind = kind
+        self.label = label
+
+    def samples(self):
+        value = self.func()
+        if self.label is None:
+            return [(None, value)]
+        return list(value.items())
+
+    def total(self):
+        return sum(value for _, value in self.samples())
+
+
+class MetricsRegistry(object):
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.started = time.time()
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, label=None):
+        return self.register(Counter(name, help_text, label))
+
+    def histogram(self, name, help_text, label=None, buckets=DEFAULT_LATENCY_BUCKETS):
+        return self.register(Histogram(name, help_text, label, buckets))
+
+    def callback(self, name, help_text, func, kind="gauge", label=None):
+        return self.register(Callback(name, help_text, func, kind, label))
+
+    def uptime(self):
+        return time.time() - self.started
+
+    ########################################
+    # Everything in the Prometheus text exposition format
+    ########################################
+    def prometheus_text(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            if metric.kind == "histogram":
+                for key, counts, total, count in metric.samples():
+                    label = f'{metric.label}="{escape(key)}",' if metric.label else ""
+                    cumulative = 0
+                    for bound, bucket in zip(metric.buckets + ("+Inf",), counts):
+                        cumulative += bucket
+                        lines.append(f'{metric.name}_bucket{{{label}le="{bound}"}} {cumulative}')
+                    label = f'{{{label[:-1]}}}' if label else ""
+                    lines.append(f"{metric.name}_sum{label} {total}")
+                    lines.append(f"{metric.name}_count{label} {count}")
+            else:
+                for key, value in metric.samples():
+                    label = f'{{{metric.label}="{escape(key)}"}}' if metric.label else ""
+                    lines.append(f"{metric.name}{label} {value}")
+        return "\n".join(lines) + "\n"
+
+    ########################################
+    # Human readable report for the log, one line per metric and label value
+    ########################################
+    def report(self):
+        uptime = self.uptime()
+        lines = [f"Bridge statistics after {uptime / 3600:.1f} hours:"]
+        for metric in self.metrics.values():
+            if metric.kind == "histogram":
+                for key, counts, total, count in sorted(metric.samples(), key=lambda sample: str(sample[0])):
+                    p50, p95, p99 = (metric.quantile(q, key) for q in (0.5, 0.95, 0.99))
+                    name = f"{metric.name}[{key}]" if metric.label else metric.name
+                    lines.append(f"    {name:<56} count {count:>8}  mean {total / count * 1000:8.2f} ms  "
+                                 f"p50 {p50 * 1000:8.2f} ms  p95 {p95 * 1000:8.2f} ms  p99 {p99 * 1000:8.2f} ms")
+            else:
+                for key, value in sorted(metric.samples(), key=lambda sample: str(sample[0])):
+                    name = f"{metric.name}[{key}]" if metric.label else metric.name
+                    rate = f"  ({value / uptime:.2f}/sec)" if metric.kind == "counter" and uptime else ""
+                    lines.append(f"    {name:<56} {value:>8}{rate}")
+        return lines
+
+
+class MetricsServer(object):
+
+    ########################################
+    # Serve the registry at http://127.0.0.1:port/metrics on a background thread.  The server only ever
+    # binds to loopback; anything off the box should scrape through a proxy or exporter.
+    ########################################
+    def __init__(self, registry, port):
+        import http.server      # pulls in email and ssl, so only loaded when the endpoint is turned on
+
+        self.logger = logging.getLogger("Plugin.Metrics")
+        self.registry = registry
+        logger = self.logger
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                logger.debug(fmt % args)
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="LIFXMetrics", daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
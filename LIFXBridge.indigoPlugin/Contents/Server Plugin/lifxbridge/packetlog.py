@@ -0,0 +1,90 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Level-gated, sampled logging for the packet path.
+#
+# Inside Indigo the "Plugin" logger passes everything down to its handlers and it's the handlers' levels that
+# decide what gets written, so logger.isEnabledFor(DEBUG) is true even with debugging turned off and every
+# debug f-string on the packet path gets built and thrown away.  PacketLog works out the level that will
+# really be written (the logger's level, or the lowest handler level on the way up, whichever is higher) and
+# caches it, so the engine can skip its debug lines with one attribute test.  The plugin passes in the level
+# picked in its prefs instead, since Indigo's plugin log file handler takes everything down to THREADDEBUG.
+#
+# When debugging is on, sample_every can cut the per-packet lines down to 1 in N packets of each message
+# type.  Every summary_interval seconds a summary line with the packet counts per type is logged instead,
+# so the log still shows the shape of the traffic.  Errors are logged as usual and never sampled.
+####################
+
+import logging
+import time
+
+from .router import MSG_NAMES
+
+THREADDEBUG = 5                     # Indigo's "Detailed Debugging Messages" level
+DEFAULT_SAMPLE_EVERY = 1            # log every packet
+DEFAULT_SUMMARY_INTERVAL = 60.0     # seconds
+
+
+########################################
+# The lowest level that logger will actually write somewhere
+########################################
+def effective_level(logger):
+    handler_levels = []
+    current = logger
+    while current:
+        handler_levels.extend(handler.level for handler in current.handlers)
+        if not current.propagate:
+            break
+        current = current.parent
+    if not handler_levels:
+        handler_levels.append(logging.lastResort.level if logging.lastResort else logging.WARNING)
+    return max(logger.getEffectiveLevel(), min(handler_levels))
+
+
+class PacketLog(object):
+
+    def __init__(self, logger, sample_every=DEFAULT_SAMPLE_EVERY, summary_interval=DEFAULT_SUMMARY_INTERVAL):
+        self.logger = logger
+        self.sample_every = sample_every
+        self.summary_interval = summary_interval
+        self.seen = dict()          # msg_type -> packets since debugging was turned on, for sampling
+        self.counts = dict()        # msg_type -> packets since the last summary
+        self.level = None           # set to override the level worked out from the logger
+        self.last_summary = time.monotonic()
+        self.next_summary = self.last_summary + summary_interval
+        self.refresh()
+
+    ########################################
+    # Re-read the logging levels.  Call this after changing a logger or handler level, or with the level to
+    # use from now on; it's also done at every summary.
+    ########################################
+    def refresh(self, level=None):
+        if level is not None:
+            self.level = level
+        level = self.level if self.level is not None else effective_level(self.logger)
+        self.debug = level <= logging.DEBUG
+        self.threaddebug = level <= THREADDEBUG
+
+    ########################################
+    # Count a packet and decide whether its debug lines should be logged.  Returns False straight away when
+    # debugging is off.
+    ########################################
+    def begin(self, msg_type):
+        if not self.debug:
+            return False
+        seen = self.seen[msg_type] = self.seen.get(msg_type, 0) + 1
+        self.counts[msg_type] = self.counts.get(msg_type, 0) + 1
+        now = time.monotonic()
+        if now >= self.next_summary:
+            self.summarize(now)
+        return seen % self.sample_every == 1 or self.sample_every == 1
+
+    def summarize(self, now):
+        if self.counts:
+            counts = ", ".join(f"{count:,d} {MSG_NAMES.get(msg_type, msg_type)}" for msg_type, count in
+                               sorted(self.counts.items(), key=lambda item: item[1], reverse=True))
+            self.logger.debug(f"In the last {now - self.last_summary:.0f}s: {counts}")
+        self.counts = dict()
+        self.last_summary = now
+        self.next_summary = now + self.summary_interval
+        self.refresh()
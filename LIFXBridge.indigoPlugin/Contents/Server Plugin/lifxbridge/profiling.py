@@ -0,0 +1,171 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# On-demand profiling of the bridge's receive thread.
+#
+# A profile is requested from any thread (a menu item, say) and started by the receive thread itself the next
+# time it calls tick(), because cProfile only sees the thread that enables it.  Two modes:
+#
+#   cprofile   deterministic cProfile of the receive thread, written as a .pstats file.  Accurate call counts,
+#              but every call costs more while it's running.
+#   sampling   a separate thread takes the receive thread's stack every few milliseconds and counts them.
+#              Written as collapsed stacks (.folded), one "frame;frame;frame count" line per distinct stack,
+#              which flamegraph.pl and speedscope read directly.  Cheap enough to leave on for minutes.
+#              Time spent inside a C call, like waiting in recvfrom, is counted against the Python function
+#              that made the call, so an idle bridge shows up as serve_once.
+#
+# When the time is up the output file is written and a short summary of the top functions is logged.
+####################
+
+import io
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+MODE_CPROFILE = "cprofile"
+MODE_SAMPLING = "sampling"
+MODES = (MODE_CPROFILE, MODE_SAMPLING)
+
+DEFAULT_SAMPLE_INTERVAL = 0.005     # seconds between stack samples
+SUMMARY_LINES = 15                  # functions listed in the log when a profile finishes
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+########################################
+# The stack of frame, outermost first, in collapsed-stack form
+########################################
+def collapse(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class StackSampler(object):
+
+    def __init__(self, thread_id, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="LIFXSampler", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                break       # the thread being sampled has exited
+            self.stacks[collapse(frame)] += 1
+            self.samples += 1
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def write(self, path):
+        with open(path, "w") as out:
+            for stack, count in self.stacks.most_common():
+                out.write(f"{stack} {count}\n")
+
+    ########################################
+    # Functions by the share of samples they were on top of the stack (self time) and anywhere in it
+    ########################################
+    def summary(self, limit=SUMMARY_LINES):
+        own = Counter()
+        total = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(";")
+            own[frames[-1]] += count
+            for name in set(frames):
+                total[name] += count
+        lines = [f"{'self %':>7} {'total %':>7}  function"]
+        for name, count in own.most_common(limit):
+            lines.append(f"{count * 100.0 / self.samples:7.1f} {total[name] * 100.0 / self.samples:7.1f}  {name}")
+        return lines
+
+
+class ThreadProfiler(object):
+
+    def __init__(self):
+        self.logger = logging.getLogger("Plugin.Profiler")
+        self.lock = threading.Lock()
+        self.pending = None         # (mode, seconds, path) waiting for the receive thread to pick it up
+        self.active = None          # (mode, end time, path, profile or sampler) while running
+
+    def running(self):
+        return self.pending is not None or self.active is not None
+
+    ########################################
+    # Ask for a profile of the receive thread.  Returns False if one is already pending or running.
+    ########################################
+    def request(self, mode, seconds, path):
+        if mode not in MODES:
+            raise ValueError(f"unknown profiling mode: {mode}")
+        with self.lock:
+            if self.running():
+                return False
+            self.pending = (mode, seconds, path)
+        return True
+
+    ########################################
+    # Called by the receive thread once per pass through its loop.  Costs one attribute check when there's
+    # nothing to do.
+    ########################################
+    def tick(self):
+        if self.pending is None and self.active is None:
+            return
+        with self.lock:
+            if self.pending:
+                self._start(*self.pending)
+                self.pending = None
+            elif time.time() >= self.active[1]:
+                self._finish()
+
+    def _start(self, mode, seconds, path):
+        if mode == MODE_CPROFILE:
+            import cProfile
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as err:      # another profiler is already active on this thread
+                self.logger.error(f"Unable to start profiling: {err}")
+                return
+        else:
+            profiler = StackSampler(threading.get_ident())
+            profiler.start()
+        self.active = (mode, time.time() + seconds, path, profiler)
+        self.logger.info(f"Profiling the receive thread ({mode}) for {seconds:g} seconds")
+
+    def _finish(self):
+        mode, _, path, profiler = self.active
+        self.active = None
+        try:
+            if mode == MODE_CPROFILE:
+                profiler.disable()
+                profiler.dump_stats(path)
+                import pstats
+                text = io.StringIO()
+                pstats.Stats(profiler, stream=text).strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(SUMMARY_LINES)
+                lines = [line for line in text.getvalue().splitlines() if line.strip()]
+            else:
+                profiler.stop()
+                profiler.write(path)
+                lines = [f"{profiler.samples} samples"] + profiler.summary()
+        except (IOError, OSError) as err:
+            self.logger.error(f"Unable to write profile to {path}: {err}")
+            return
+        self.logger.info(f"Profile written to {path}")
+        for line in lines:
+            self.logger.info(f"    {line}")
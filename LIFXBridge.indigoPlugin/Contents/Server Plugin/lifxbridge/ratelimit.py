@@ -0,0 +1,231 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Per-client rate limiting and flood protection for inbound requests.
+#
+# The bridge answers a GetService with one StateService per published device, so a client stuck in a loop
+# (a misbehaving app, a Harmony hub with bad firmware) can keep it busy answering and starve everyone else.
+# Every client, identified by its (ip, source ID) pair, gets a token bucket per class of request, checked on
+# the raw header before the request is decoded:
+#
+#   discovery   GetService
+#   query       the rest of the Get requests, tagged (answered for every device) or not, and EchoRequest
+#   set         Set commands
+#
+# Tagged Gets are what every lifxlan poll loop and Harmony hub sends to refresh its view of the lights, so
+# they share the query budget rather than the much smaller discovery one.
+#
+# Discovery and queries over budget are dropped; clients retry those anyway.  Set commands over budget are
+# held in a short per-client queue and handled when the bucket refills, so a burst of commands is slowed down
+# rather than lost.  A client that keeps going over budget (block_after drops within BLOCK_WINDOW seconds) is
+# blocked, and everything it sends is dropped for block_seconds.
+####################
+
+import logging
+import time
+from collections import deque
+
+from lifxlan.msgtypes import MSG_IDS, GetService
+
+from .router import REQUEST_TYPES, MSG_NAMES
+
+DISCOVERY = "discovery"
+QUERY = "query"
+SET = "set"
+
+# class -> (tokens per second, bucket size).  A query bucket has room for the inventory a client takes
+# after discovering a big install (GetLabel, GetVersion, LightGet... for every device).
+DEFAULT_BUDGETS = {DISCOVERY: (1.0, 10), QUERY: (100.0, 500), SET: (20.0, 50)}
+
+MAX_DEFERRED = 50           # set commands held per client
+BLOCK_AFTER = 200           # drops within BLOCK_WINDOW that get a client blocked
+BLOCK_WINDOW = 10.0         # seconds
+BLOCK_SECONDS = 60.0
+MAX_CLIENTS = 1024          # clients tracked by (ip, source); past this, new sources share a bucket per ip
+IDLE_SECONDS = 60.0         # clients that have been quiet this long are forgotten
+
+GET_SERVICE_ID = MSG_IDS[GetService]
+SET_TYPES = frozenset(msg_id for msg_id in REQUEST_TYPES if "Set" in MSG_NAMES[msg_id])
+
+ADMIT = "admit"
+DEFER = "defer"
+DROP = "drop"
+
+
+########################################
+# Budgets for the given rates (requests per second by class), with buckets that hold as many seconds' worth
+# as the defaults do
+########################################
+def budgets_for(rates):
+    budgets = dict(DEFAULT_BUDGETS)
+    for name, rate in rates.items():
+        default_rate, default_size = DEFAULT_BUDGETS[name]
+        budgets[name] = (float(rate), max(1, int(round(rate * default_size / default_rate))))
+    return budgets
+
+
+def request_class(header):
+    if header.msg_type in SET_TYPES:
+        return SET
+    if header.msg_type == GET_SERVICE_ID:
+        return DISCOVERY
+    return QUERY
+
+
+class Client(object):
+    __slots__ = ("key", "tokens", "updated", "deferred", "drops", "window_start", "blocked_until", "last_seen")
+
+    def __init__(self, key, budgets, now):
+        self.key = key
+        self.tokens = {name: float(size) for name, (_, size) in budgets.items()}
+        self.updated = now
+        self.deferred = deque()         # (header, data, addr) set commands waiting for tokens
+        self.drops = 0                  # in the current block window
+        self.window_start = now
+        self.blocked_until = 0.0
+        self.last_seen = now
+
+    def refill(self, budgets, now):
+        elapsed = now - self.updated
+        self.updated = now
+        if elapsed > 0:
+            for name, (rate, size) in budgets.items():
+                self.tokens[name] = min(float(size), self.tokens[name] + elapsed * rate)
+
+    def __str__(self):
+        ip, source = self.key
+        return f"{ip} (all sources)" if source is None else f"{ip} (source {source:08x})"
+
+    def take(self, name):
+        if self.tokens[name] < 1.0:
+            return False
+        self.tokens[name] -= 1.0
+        return True
+
+
+class RateLimiter(object):
+
+    def __init__(self, budgets=None, block_after=BLOCK_AFTER, block_seconds=BLOCK_SECONDS, max_clients=MAX_CLIENTS):
+        self.logger = logging.getLogger("Plugin.RateLimiter")
+        self.enabled = True
+        self.budgets = dict(budgets or DEFAULT_BUDGETS)
+        self.block_after = block_after
+        self.block_seconds = block_seconds
+        self.max_clients = max_clients
+        self.clients = dict()           # (ip, source) -> Client, or (ip, None) for the overflow bucket
+        self.waiting = set()            # clients with deferred set commands
+        self.next_sweep = 0.0
+        self.dropped = {DISCOVERY: 0, QUERY: 0, SET: 0}
+        self.deferred = 0               # set commands that were held, and handled later
+        self.blocked = 0                # datagrams dropped because their client was blocked
+        self.blocks = 0                 # times a client was blocked
+
+    ########################################
+    # Change the settings.  Clients keep the tokens they have, up to their new bucket sizes.
+    ########################################
+    def configure(self, enabled=True, budgets=None, block_after=BLOCK_AFTER, block_seconds=BLOCK_SECONDS):
+        self.enabled = enabled
+        self.budgets = dict(budgets or DEFAULT_BUDGETS)
+        self.block_after = block_after
+        self.block_seconds = block_seconds
+
+    # The settings as configure() arguments, to hand on to worker processes
+    def settings(self):
+        return {"enabled": self.enabled, "budgets": self.budgets, "block_after": self.block_after, "block_seconds": self.block_seconds}
+
+    ########################################
+    # Check a request against its client's budget.  Returns ADMIT to handle it now, DEFER if it's been queued
+    # for release(), or DROP.
+    ########################################
+    def admit(self, header, data, addr, now=None):
+        if not self.enabled:
+            return ADMIT
+        now = time.monotonic() if now is None else now
+        if now >= self.next_sweep:
+            self.sweep(now)
+        client = self.client(addr[0], header.source, now)
+        if client.blocked_until:
+            if now < client.blocked_until:
+                self.blocked += 1
+                return DROP
+            client.blocked_until = 0.0
+            self.logger.info(f"LIFX client {client} is no longer blocked")
+
+        client.refill(self.budgets, now)
+        name = request_class(header)
+        if name == SET and client.deferred:
+            pass    # keep the commands in order behind the ones already waiting
+        elif client.take(name):
+            return ADMIT
+        if name == SET and len(client.deferred) < MAX_DEFERRED:
+            client.deferred.append((header, data, addr))
+            self.waiting.add(client)
+            return DEFER
+        self.dropped[name] += 1
+        self.strike(client, now)
+        return DROP
+
+    def client(self, ip, source, now):
+        key = (ip, source)
+        client = self.clients.get(key)
+        if client is None:
+            if len(self.clients) >= self.max_clients:
+                key = (ip, None)
+                client = self.clients.get(key)
+            if client is None:
+                client = self.clients[key] = Client(key, self.budgets, now)
+        client.last_seen = now
+        return client
+
+    def strike(self, client, now):
+        if now - client.window_start > BLOCK_WINDOW:
+            client.window_start = now
+            client.drops = 0
+        client.drops += 1
+        if client.drops >= self.block_after and self.block_seconds > 0:
+            client.blocked_until = now + self.block_seconds
+            client.drops = 0
+            self.blocks += 1
+            self.blocked += len(client.deferred)
+            client.deferred.clear()
+            self.waiting.discard(client)
+            self.logger.warning(f"LIFX client {client} is flooding the bridge, ignoring it for {self.block_seconds:g} seconds")
+
+    ########################################
+    # The deferred set commands whose clients have tokens again, as (header, data, addr), in arrival order for
+    # each client.
+    ########################################
+    def release(self, now=None):
+        if not self.waiting:
+            return []
+        now = time.monotonic() if now is None else now
+        ready = []
+        for client in list(self.waiting):
+            client.refill(self.budgets, now)
+            while client.deferred and client.take(SET):
+                ready.append(client.deferred.popleft())
+                self.deferred += 1
+            if not client.deferred:
+                self.waiting.discard(client)
+        return ready
+
+    def pending(self):
+        return sum(len(client.deferred) for client in self.waiting)
+
+    ########################################
+    # Forget clients that have gone quiet, so the table doesn't grow with every source ID ever seen
+    ########################################
+    def sweep(self, now):
+        self.next_sweep = now + IDLE_SECONDS
+        for key, client in list(self.clients.items()):
+            if now - client.last_seen > IDLE_SECONDS and not client.deferred and now >= client.blocked_until:
+                del self.clients[key]
+
+    def blocked_clients(self, now=None):
+        now = time.monotonic() if now is None else now
+        return [client.key for client in self.clients.values() if client.blocked_until > now]
+
+    def stats(self):
+        stats = {f"dropped_{name}": count for name, count in self.dropped.items()}
+        stats.update(deferred=self.deferred, blocked=self.blocked, blocks=self.blocks, clients=len(self.clients))
+        return stats
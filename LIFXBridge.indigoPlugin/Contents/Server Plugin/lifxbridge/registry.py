@@ -0,0 +1,102 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Copy-on-write registry of the devices published to the bridge.
+#
+# The receive thread reads the registry on every packet, while Indigo callback threads add, remove and rename
+# devices.  Rather than lock the dict on both sides, the registry is an immutable snapshot: writers build a
+# complete new snapshot and swap it in with a single reference assignment, and readers grab the current
+# snapshot once per request and use it without any locking.  Writers are serialized among themselves only.
+#
+# Each snapshot also holds the pre-encoded parts of every device's replies (encode.EncodedDevice), carried over
+# from the previous snapshot for devices that haven't changed.
+####################
+
+import threading
+from collections import namedtuple
+from types import MappingProxyType
+
+from .encode import EncodedDevice
+
+
+class PublishedDevice(namedtuple("PublishedDevice", ["id", "name", "alias", "mac", "location"])):
+    __slots__ = ()
+
+    # The name the device is published under
+    @property
+    def label(self):
+        return self.alias or self.name
+
+
+class RegistrySnapshot(object):
+    __slots__ = ("devices", "by_mac", "encoded")
+
+    ########################################
+    #   encoded is a dict of devID -> EncodedDevice that's known to match the devices; the rest are encoded here
+    ########################################
+    def __init__(self, devices, encoded=None):
+        devices = {device.id: device for device in devices}
+        encoded = encoded or dict()
+        self.devices = MappingProxyType(devices)
+        self.by_mac = MappingProxyType({device.mac: device for device in devices.values()})
+        self.encoded = MappingProxyType({devID: encoded.get(devID) or EncodedDevice.of(device) for devID, device in devices.items()})
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __iter__(self):
+        return iter(self.devices.values())
+
+    def __contains__(self, devID):
+        return devID in self.devices
+
+    def get(self, devID):
+        return self.devices.get(devID)
+
+    def lookup(self, mac):
+        return self.by_mac.get(mac)
+
+
+class DeviceRegistry(object):
+
+    def __init__(self):
+        self.snapshot = RegistrySnapshot(())
+        self.write_lock = threading.Lock()
+        self.listeners = []
+
+    ########################################
+    # callback(snapshot) is called after every swap, with the write lock held so listeners see swaps in order
+    ########################################
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    ########################################
+    #   encoded is passed on to the new snapshot; by default the encodings of unchanged devices are reused.
+    #   The snapshot is built with the write lock held, so an update() can't land between reading the current
+    #   snapshot and swapping in the new one.
+    ########################################
+    def replace(self, devices, encoded=None):
+        with self.write_lock:
+            if encoded is None:
+                current = self.snapshot
+                encoded = {device.id: current.encoded[device.id] for device in devices if current.get(device.id) == device}
+            self._swap(RegistrySnapshot(devices, encoded))
+
+    def update(self, device):
+        with self.write_lock:
+            devices = dict(self.snapshot.devices)
+            devices[device.id] = device
+            encoded = {devID: encoded for devID, encoded in self.snapshot.encoded.items() if devID != device.id}
+            self._swap(RegistrySnapshot(devices.values(), encoded))
+
+    def remove(self, devID):
+        with self.write_lock:
+            if devID not in self.snapshot:
+                return False
+            self._swap(RegistrySnapshot((device for device in self.snapshot if device.id != devID), self.snapshot.encoded))
+        return True
+
+    def _swap(self, snapshot):
+        self.snapshot = snapshot
+        for callback in self.listeners:
+            callback(snapshot)
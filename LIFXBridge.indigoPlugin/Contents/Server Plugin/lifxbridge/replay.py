@@ -0,0 +1,397 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Replay recorded client traffic against the bridge engine and diff the replies.
+#
+# Reads a pcap (one saved from the Save Packet Capture menu item, or a tcpdump/Wireshark capture of the LAN),
+# starts a BridgeEngine on 127.0.0.1 with in-memory devices rebuilt from the capture, and sends every recorded
+# request to it again.  Each recorded client gets its own loopback socket and its requests go out in the
+# order they were captured, so per-client ordering is kept at any speed:
+#
+#   cd "LIFXBridge.indigoPlugin/Contents/Server Plugin"
+#   python -m lifxbridge.replay capture.pcap                # real time
+#   python -m lifxbridge.replay capture.pcap --speed 10     # ten times faster
+#   python -m lifxbridge.replay capture.pcap --speed 0      # as fast as the sockets go
+#
+# Replies are matched to the recorded ones by client, message type, target, source and sequence number, and
+# the report lists what went missing, what's extra, what came back with a different payload and which clients
+# saw their replies in a different order.  The exit status is 1 if anything differed.  Replies to set commands
+# go out on the egress queue's priority lane and everything else is paced out on the bulk lane, so how the
+# two lanes interleave depends on timing; the order is only compared within each lane.
+#
+# At --speed 0 the replay would outrun the engine and overflow its socket, and which requests got dropped
+# would change from run to run.  So no more than --outstanding requests are kept waiting for a reply: past
+# that the replay waits for one to come back (or for REPLY_TIMEOUT, if its reply was never recorded either).
+####################
+
+import argparse
+import collections
+import logging
+import selectors
+import socket
+import struct
+import sys
+import threading
+import time
+
+from lifxlan.message import HEADER_SIZE_BYTES
+from lifxlan.msgtypes import *
+
+from .backend import PRODUCT_COLOR_1000
+from .bench import ms, percentile
+from .capture import read_pcap
+from .engine import BridgeEngine, DEFAULT_LIFX_PORT
+from .fleet import raise_file_limit
+from .loadgen import mac_string
+from .memory_backend import InMemoryBackend
+from .ratelimit import SET_TYPES
+from .router import MSG_NAMES, REQUEST_TYPES, peek_header
+
+FAKE_MAC_PREFIX = b"\x00\x16"       # every MAC the bridge publishes starts with this, see fakeMAC()
+MAX_OUTSTANDING = 64                # requests waiting for their first reply before the replay holds off
+REPLY_TIMEOUT = 1.0                 # seconds to hold off for a reply that may not be coming
+ENGINE_RCVBUF = 4 * 1024 * 1024
+
+# Payload bytes that hold the time the reply was built, so never match a recording
+VOLATILE_FIELDS = {
+    MSG_IDS[StateInfo]: (0, 8),
+    MSG_IDS[StateLocation]: (48, 56),
+    MSG_IDS[StateGroup]: (48, 56),
+}
+
+_power = struct.Struct("<H").unpack_from
+_version = struct.Struct("<II").unpack_from
+_light_state = struct.Struct("<HHHHhH32s").unpack_from
+
+
+def label_string(raw):
+    return raw.split(b"\x00", 1)[0].decode("utf-8", "replace")
+
+
+class Recording(object):
+
+    ########################################
+    # Split capture records into the requests clients sent and the replies the bridge sent back.  Replies
+    # are recognized by the bridge's fake MACs, or by the bridge's address if it's given, so a capture of the
+    # whole LAN can be used as it is.
+    ########################################
+    def __init__(self, records, bridge=None):
+        self.requests = []                                  # (time, client, data) in capture order
+        self.replies = collections.defaultdict(list)        # client -> [data] in capture order
+        self.bridge_port = collections.Counter()
+        self.targets = dict()                               # fake MACs in the order the bridge first answered for them
+        for timestamp, src, dst, data in records:
+            header = peek_header(data)
+            if header is None:
+                continue
+            if header.msg_type in REQUEST_TYPES:
+                if bridge is None or src[0] != bridge:
+                    self.requests.append((timestamp, src, data))
+            elif bridge == src[0] if bridge else header.target.startswith(FAKE_MAC_PREFIX):
+                self.replies[dst].append(data)
+                self.bridge_port[src[1]] += 1
+                self.targets.setdefault(bytes(header.target), None)
+
+    @property
+    def port(self):
+        return self.bridge_port.most_common(1)[0][0] if self.bridge_port else DEFAULT_LIFX_PORT
+
+    def clients(self):
+        return sorted({client for _, client, _ in self.requests})
+
+    ########################################
+    # (client, source, seq) of the set commands, whose replies the engine sends on the priority lane
+    ########################################
+    def set_commands(self):
+        return {(client, header.source, header.seq)
+                for header, client in ((peek_header(data), client) for _, client, data in self.requests) if header.msg_type in SET_TYPES}
+
+    ########################################
+    # Rebuild the published devices from the capture: every fake MAC that was asked about or answered for,
+    # with the first label, product, power, color and location the bridge reported for it.  That's the
+    # state the devices were in when the capture started, which is what the replayed requests need to see.
+    # Devices are added in the order the bridge first answered for them, so replies to tagged requests come
+    # back in the recorded order.
+    ########################################
+    def backend(self, command_latency=0.0):
+        backend = InMemoryBackend(command_latency)
+        seen = dict()       # devID -> set of fields already taken from the capture
+
+        def device(target):
+            devID = int.from_bytes(target[2:6], "big")
+            if devID not in seen:
+                seen[devID] = set()
+                backend.add_device(devID, mac_string(target))
+            return backend.devices[devID], seen[devID]
+
+        for target in self.targets:
+            device(target)
+        for _, _, data in self.requests:
+            header = peek_header(data)
+            if header.target.startswith(FAKE_MAC_PREFIX):
+                device(header.target)
+
+        for replies in self.replies.values():
+            for data in replies:
+                header = peek_header(data)
+                dev, taken = device(header.target)
+                payload = data[HEADER_SIZE_BYTES:]
+                fields = dict()
+                if header.msg_type == MSG_IDS[StateLabel] and len(payload) >= 32:
+                    fields["name"] = label_string(payload[:32])
+                elif header.msg_type in (MSG_IDS[StatePower], MSG_IDS[LightStatePower]) and len(payload) >= 2:
+                    fields["power"] = _power(payload)[0]
+                elif header.msg_type == MSG_IDS[StateVersion] and len(payload) >= 8:
+                    fields["rgb"] = _version(payload)[1] == PRODUCT_COLOR_1000
+                elif header.msg_type == MSG_IDS[StateLocation] and len(payload) >= 16:
+                    fields["location"] = bytearray(payload[:16])
+                elif header.msg_type == MSG_IDS[LightState] and len(payload) >= 52:
+                    hue, saturation, brightness, kelvin, _, power, label = _light_state(payload)
+                    fields.update(hue=hue, saturation=saturation, kelvin=kelvin, power=power, name=label_string(label))
+                    if power:
+                        fields["brightness"] = brightness
+                for name, value in fields.items():
+                    if name not in taken:
+                        setattr(dev, name, value)
+                        taken.add(name)
+        return backend
+
+
+########################################
+# The parts of a reply that are compared: (type, target, source, seq) to pair it up, and the payload with
+# any timestamps blanked out.
+########################################
+def reply_key(data):
+    header = peek_header(data)
+    return header.msg_type, bytes(header.target), header.source, header.seq
+
+
+def reply_payload(data):
+    payload = bytearray(data[HEADER_SIZE_BYTES:])
+    span = VOLATILE_FIELDS.get(peek_header(data).msg_type)
+    if span:
+        payload[span[0]:span[1]] = bytes(min(span[1], len(payload)) - span[0])
+    return bytes(payload)
+
+
+class Replayer(object):
+
+    ########################################
+    #   speed is a multiple of real time, 0 for as fast as possible.  settle is how long to keep listening
+    #   for replies after the last request has gone out.  max_outstanding is how many requests that were
+    #   answered in the recording can be waiting for their first reply at once.
+    ########################################
+    def __init__(self, engine_port, recording, speed=1.0, settle=1.0, max_outstanding=MAX_OUTSTANDING):
+        self.addr = ("127.0.0.1", engine_port)
+        self.recording = recording
+        self.speed = speed
+        self.settle = settle
+        self.max_outstanding = max_outstanding
+        self.selector = selectors.DefaultSelector()
+        self.sockets = dict()           # recorded client -> loopback socket standing in for it
+        self.replies = collections.defaultdict(list)
+        self.sent_at = dict()           # (client, source, seq) -> time of a request still waiting for a reply
+        self.condition = threading.Condition()
+        self.answered = {(client, header.source, header.seq)
+                         for client, replies in recording.replies.items() for header in map(peek_header, replies)}
+        self.latencies = []             # request to first reply
+        self.done = threading.Event()
+
+        for client in recording.clients():
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+            sock.bind(("127.0.0.1", 0))
+            sock.setblocking(False)
+            self.sockets[client] = sock
+            self.selector.register(sock, selectors.EVENT_READ, client)
+
+    ########################################
+    # Receive thread: file every reply under the client whose socket it came in on.
+    ########################################
+    def receive(self):
+        while not self.done.is_set():
+            for key, _ in self.selector.select(0.05):
+                client = key.data
+                while True:
+                    try:
+                        data = key.fileobj.recv(2048)
+                    except BlockingIOError:
+                        break
+                    now = time.perf_counter()
+                    self.replies[client].append(data)
+                    header = peek_header(data)
+                    if header is not None:
+                        with self.condition:
+                            sent = self.sent_at.pop((client, header.source, header.seq), None)
+                            if sent is not None:
+                                self.latencies.append(now - sent)
+                                self.condition.notify()
+
+    ########################################
+    # Send every recorded request, keeping the recorded spacing divided by speed.  Everything goes out from
+    # this one thread in capture order, so each client's requests reach the engine in the order it sent them.
+    ########################################
+    def run(self):
+        receiver = threading.Thread(target=self.receive, name="ReplayReceiver", daemon=True)
+        receiver.start()
+        requests = self.recording.requests
+        first = requests[0][0] if requests else 0.0
+        start = time.perf_counter()
+        for timestamp, client, data in requests:
+            if self.speed:
+                delay = start + (timestamp - first) / self.speed - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            header = peek_header(data)
+            key = (client, header.source, header.seq)
+            if key in self.answered:
+                self.wait_for_room()
+                with self.condition:
+                    self.sent_at[key] = time.perf_counter()
+            self.sockets[client].sendto(data, self.addr)
+        elapsed = time.perf_counter() - start
+        time.sleep(self.settle)
+        self.done.set()
+        receiver.join()
+        return elapsed
+
+    ########################################
+    # Wait until fewer than max_outstanding requests are waiting for a reply.  A request that's waited
+    # REPLY_TIMEOUT isn't going to get one, and stops counting.
+    ########################################
+    def wait_for_room(self):
+        with self.condition:
+            while len(self.sent_at) >= self.max_outstanding:
+                if not self.condition.wait(REPLY_TIMEOUT):
+                    oldest = min(self.sent_at, key=self.sent_at.get)
+                    del self.sent_at[oldest]
+
+    def close(self):
+        for sock in self.sockets.values():
+            self.selector.unregister(sock)
+            sock.close()
+        self.selector.close()
+
+
+########################################
+# Compare recorded and replayed replies client by client.  Returns the counts and a list of
+# (client, what, key) for every difference.
+#
+#   set_commands is the (client, source, seq) of every set command; replies to them are ordered apart from
+#   the rest
+########################################
+def diff_replies(recorded, replayed, set_commands=frozenset()):
+    counts = collections.Counter()
+    differences = []
+    for client in sorted(set(recorded) | set(replayed)):
+        expected = collections.defaultdict(collections.deque)
+        expected_order = []
+        for data in recorded.get(client, ()):
+            key = reply_key(data)
+            expected[key].append(reply_payload(data))
+            expected_order.append(key)
+        counts["recorded"] += len(expected_order)
+
+        matched_order = []
+        for data in replayed.get(client, ()):
+            key = reply_key(data)
+            counts["replayed"] += 1
+            if not expected[key]:
+                counts["extra"] += 1
+                differences.append((client, "extra", key))
+                continue
+            if expected[key].popleft() != reply_payload(data):
+                counts["changed"] += 1
+                differences.append((client, "changed", key))
+            counts["matched"] += 1
+            matched_order.append(key)
+
+        for key, left in expected.items():
+            counts["missing"] += len(left)
+            differences.extend((client, "missing", key) for _ in left)
+
+        # the recorded order, restricted to the replies that came back, should be the order they came back in
+        remaining = collections.Counter(matched_order)
+        recorded_order = []
+        for key in expected_order:
+            if remaining[key]:
+                remaining[key] -= 1
+                recorded_order.append(key)
+        for priority in (True, False):
+            lane_recorded = [key for key in recorded_order if ((client, key[2], key[3]) in set_commands) == priority]
+            lane_matched = [key for key in matched_order if ((client, key[2], key[3]) in set_commands) == priority]
+            if lane_recorded != lane_matched:
+                counts["reordered_clients"] += 1
+                position = next(i for i, (a, b) in enumerate(zip(lane_recorded, lane_matched)) if a != b)
+                differences.append((client, "reordered", lane_matched[position]))
+                break
+    return counts, differences
+
+
+def describe(client, what, key):
+    msg_type, target, source, seq = key
+    return f"  {what:<9} {MSG_NAMES.get(msg_type, msg_type)} for {mac_string(target)} source {source:08x} seq {seq} to {client[0]}:{client[1]}"
+
+
+def print_report(recording, elapsed, latencies, counts, differences, show):
+    requests = len(recording.requests)
+    ordered = sorted(latencies)
+    print(f"Replayed {requests} requests from {len(recording.clients())} clients in {elapsed:.3f} seconds"
+          f" ({requests / elapsed if elapsed else 0:.1f} requests/sec)")
+    if ordered:
+        print(f"First reply latency: p50 {ms(percentile(ordered, 50))} ms, p95 {ms(percentile(ordered, 95))} ms,"
+              f" p99 {ms(percentile(ordered, 99))} ms")
+    print(f"Replies: {counts['recorded']} recorded, {counts['replayed']} replayed, {counts['matched']} matched")
+    print(f"Differences: {counts['missing']} missing, {counts['extra']} extra, {counts['changed']} changed payload,"
+          f" {counts['reordered_clients']} clients reordered")
+    for difference in differences[:show]:
+        print(describe(*difference))
+    if len(differences) > show:
+        print(f"  ... and {len(differences) - show} more")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="lifxbridge.replay", description="Replay captured LIFX client traffic against the bridge engine")
+    parser.add_argument("capture", help="pcap file to replay")
+    parser.add_argument("--speed", type=float, default=1.0, help="multiple of real time to replay at, 0 for as fast as possible")
+    parser.add_argument("--bridge", metavar="ADDRESS", help="IP address of the bridge in the capture, if the fake MACs aren't enough")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each backend set command takes")
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds to wait for replies after the last request")
+    parser.add_argument("--outstanding", type=int, default=MAX_OUTSTANDING, help="requests that can be waiting for a reply at once")
+    parser.add_argument("--show", type=int, default=20, help="number of differences to list")
+    parser.add_argument("--debug", action="store_true", help="log every message the engine handles")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING, format="%(asctime)s [%(levelname)8s] %(name)s: %(message)s")
+
+    recording = Recording(read_pcap(args.capture), args.bridge)
+    if not recording.requests:
+        print(f"No LIFX requests found in {args.capture}")
+        return 1
+    raise_file_limit(len(recording.clients()) + 64)
+
+    engine = BridgeEngine(recording.backend(args.latency), port=0, bind_addr="127.0.0.1")
+    engine.limiter.enabled = False      # replaying faster than real time would put the clients over budget
+    engine.inbound.prioritize = False   # the capture has the requests in the order they were handled, keep to it
+    engine.open()
+    engine.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, ENGINE_RCVBUF)
+    engine_port = engine.port
+    engine.port = recording.port        # so StateService advertises the port the recorded bridge did
+    engine.refresh()
+    engine.start()
+
+    replayer = Replayer(engine_port, recording, args.speed, args.settle, max(1, args.outstanding))
+    try:
+        elapsed = replayer.run()
+    finally:
+        replayer.close()
+        engine.stop()
+        engine.close()
+
+    counts, differences = diff_replies(recording.replies, replayer.replies, recording.set_commands())
+    print_report(recording, elapsed, replayer.latencies, counts, differences, args.show)
+    return 1 if differences else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,98 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Pre-decode routing for inbound datagrams.
+#
+# The bridge socket is bound to 0.0.0.0:56700, so it also hears every StateX reply and broadcast from the
+# real LIFX bulbs and other controllers on the LAN.  The router looks at the target MAC, the tagged bit and
+# the message type straight out of the raw header and throws away anything that isn't a request addressed to
+# one of the bridge's devices (or to everyone), before the packet is decoded.  It also drops requests that
+# would make the decoder fail: a size field that doesn't match the datagram, or a payload too short for the
+# message type.
+####################
+
+import struct
+from collections import namedtuple
+
+from lifxlan.message import HEADER_SIZE_BYTES
+from lifxlan.msgtypes import MSG_IDS, EchoRequest, SetPower, SetLabel, LightSetColor, LightSetWaveform, LightSetPower, \
+    LightSetInfrared, MultiZoneSetColorZones, MultiZoneGetColorZones, SetMultiZoneEffect, SetUserPosition, GetTileState64, SetTileEffect
+
+BROADCAST_TARGET = bytes(6)
+
+# Every Get/Set message plus EchoRequest.  State replies, Acknowledgement and EchoResponse are never
+# addressed to a bulb, so the bridge has no use for them.
+REQUEST_TYPES = frozenset(msg_id for cls, msg_id in MSG_IDS.items() if "Get" in cls.__name__ or "Set" in cls.__name__ or cls is EchoRequest)
+
+MSG_NAMES = {msg_id: cls.__name__ for cls, msg_id in MSG_IDS.items()}
+
+# Payload bytes the decoder reads for the requests that have a payload
+PAYLOAD_SIZES = {MSG_IDS[cls]: size for cls, size in (
+    (SetPower, 2), (SetLabel, 32), (LightSetColor, 13), (LightSetWaveform, 21), (LightSetPower, 6), (LightSetInfrared, 2),
+    (MultiZoneSetColorZones, 15), (MultiZoneGetColorZones, 2), (SetMultiZoneEffect, 59), (SetUserPosition, 11),
+    (GetTileState64, 6), (SetTileEffect, 60))}
+
+DROP_SHORT = "short"                # too small to hold a LIFX header
+DROP_NOT_REQUEST = "not_request"    # StateX, Ack, EchoResponse or an unknown message type
+DROP_UNTARGETED = "untargeted"      # addressed to a MAC that isn't one of ours
+DROP_MALFORMED = "malformed"        # size field doesn't match the datagram, or the payload is too short for the type
+
+RawHeader = namedtuple("RawHeader", ["msg_type", "tagged", "target", "source", "seq"])
+
+_size = struct.Struct("<H").unpack_from              # size at offset 0
+_flags_source = struct.Struct("<HI").unpack_from      # flags, source at offset 2
+_seq = struct.Struct("<B").unpack_from                # sequence at offset 23
+_msg_type = struct.Struct("<H").unpack_from           # message type at offset 32
+
+
+def mac_to_bytes(mac):
+    return bytes.fromhex(mac.replace(":", ""))
+
+
+########################################
+# Pull the routing fields out of a raw datagram.  Returns None if it's too short to be a LIFX message.
+########################################
+def peek_header(data):
+    if len(data) < HEADER_SIZE_BYTES:
+        return None
+    flags, source = _flags_source(data, 2)
+    return RawHeader(_msg_type(data, 32)[0], (flags >> 13) & 1, data[8:14], source, _seq(data, 23)[0])
+
+
+class InboundRouter(object):
+
+    def __init__(self, request_types=REQUEST_TYPES):
+        self.request_types = request_types
+        self.bridge_macs = frozenset()
+        self.accepted = 0
+        self.dropped = {DROP_SHORT: 0, DROP_NOT_REQUEST: 0, DROP_MALFORMED: 0, DROP_UNTARGETED: 0}
+
+    ########################################
+    # Replace the set of MACs the bridge answers for.  The set is swapped in whole, so route() never sees
+    # a half-built set.
+    ########################################
+    def set_bridge_macs(self, macs):
+        self.bridge_macs = frozenset(mac_to_bytes(mac) for mac in macs)
+
+    ########################################
+    # Returns the RawHeader for datagrams that should be decoded and handled, or None if it was dropped.
+    ########################################
+    def route(self, data):
+        header = peek_header(data)
+        if header is None:
+            self.dropped[DROP_SHORT] += 1
+            return None
+        if header.msg_type not in self.request_types:
+            self.dropped[DROP_NOT_REQUEST] += 1
+            return None
+        if _size(data)[0] != len(data) or len(data) < HEADER_SIZE_BYTES + PAYLOAD_SIZES.get(header.msg_type, 0):
+            self.dropped[DROP_MALFORMED] += 1
+            return None
+        if not header.tagged and header.target != BROADCAST_TARGET and header.target not in self.bridge_macs:
+            self.dropped[DROP_UNTARGETED] += 1
+            return None
+        self.accepted += 1
+        return header
+
+    def stats(self):
+        return dict(self.dropped, accepted=self.accepted)
@@ -0,0 +1,164 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Startup import benchmark.
+#
+# Indigo starts the plugin in a fresh interpreter every time, so everything plugin.py imports is paid for on
+# each start and on every reload.  This imports the same bridge modules in a fresh interpreter a number of
+# times and reports the median import time, the modules that cost the most (from python -X importtime), and
+# which of the modules the bridge should only load on first use got loaded anyway.  Results can be saved as
+# a JSON baseline and later runs compared against it, like lifxbridge.bench:
+#
+#   cd "LIFXBridge.indigoPlugin/Contents/Server Plugin"
+#   python -m lifxbridge.startup --save startup.json
+#   python -m lifxbridge.startup --compare startup.json
+#
+# lifxbridge.indigo_backend isn't included because it can only be imported inside the Indigo plugin host.
+####################
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+from .bench import ms
+
+# What plugin.py imports when Indigo loads it
+PLUGIN_IMPORTS = ("lifxbridge.backend", "lifxbridge.capture", "lifxbridge.engine", "lifxbridge.metrics", "lifxbridge.profiling")
+
+# Modules the bridge only needs for optional features or the lifxlan client, which shouldn't load at startup
+DEFERRED = ("ifaddr", "lifxlan.lifxlan", "lifxlan.device", "lifxlan.light", "lifxlan.multizonelight", "lifxlan.tilechain",
+            "lifxlan.group", "lifxlan.products", "multiprocessing", "http.server", "cProfile", "pstats")
+
+DEFAULT_RUNS = 15
+TOP_MODULES = 15
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+for name in sys.argv[1:]:
+    __import__(name)
+print(json.dumps({"seconds": time.perf_counter() - start, "modules": sorted(sys.modules)}))
+"""
+
+
+########################################
+# Import modules in a fresh interpreter.  Returns (seconds, loaded module names, {module: cumulative seconds}).
+########################################
+def measure(modules, cwd):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", CHILD] + list(modules), cwd=cwd,
+                            capture_output=True, text=True, check=True)
+    child = json.loads(result.stdout)
+    # A module's line comes after the lines of everything it imported, so collect lines until a top-level one
+    # and keep the group if it's one of ours (the interpreter's own startup imports are listed too)
+    cumulative = dict()
+    group = dict()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line.split("|")
+        group[name.strip()] = int(cumulative_us) / 1e6
+        if not name[1:].startswith(" "):
+            if name.strip() in modules:
+                cumulative.update(group)
+            group = dict()
+    return child["seconds"], child["modules"], cumulative
+
+
+def run(modules, runs, cwd):
+    seconds = []
+    by_module = dict()
+    loaded = set()
+    for _ in range(runs):
+        elapsed, names, cumulative = measure(modules, cwd)
+        seconds.append(elapsed)
+        loaded.update(names)
+        for name, value in cumulative.items():
+            by_module.setdefault(name, []).append(value)
+    seconds.sort()
+    slowest = sorted(((statistics.median(values), name) for name, values in by_module.items()), reverse=True)[:TOP_MODULES]
+    return {
+        "runs": runs,
+        "p50_ms": ms(statistics.median(seconds)),
+        "min_ms": ms(seconds[0]),
+        "max_ms": ms(seconds[-1]),
+        "modules_loaded": len(loaded),
+        "deferred_loaded": [name for name in DEFERRED if name in loaded],
+        "slowest": {name: ms(value) for value, name in slowest},
+    }
+
+
+def print_results(results):
+    print(f"Importing {', '.join(results['config']['modules'])}")
+    print(f"  {results['runs']} runs: p50 {results['p50_ms']} ms, min {results['min_ms']} ms, max {results['max_ms']} ms, "
+          f"{results['modules_loaded']} modules loaded")
+    print(f"\n  {'module (cumulative, with -X importtime)':<44} {'ms':>8}")
+    for name, value in results["slowest"].items():
+        print(f"  {name:<44} {value:>8}")
+    if results["deferred_loaded"]:
+        print(f"\n  Loaded at startup but only needed on first use: {', '.join(results['deferred_loaded'])}")
+
+
+########################################
+# Compare a run against a saved baseline.  Returns True if startup got slower by more than tolerance (a
+# fraction), or something that used to be deferred is now loaded at startup.
+########################################
+def compare(results, baseline, tolerance):
+    print(f"\nCompared with baseline from {baseline.get('timestamp', 'unknown')}:")
+    regressed = False
+    old, new = baseline.get("p50_ms"), results["p50_ms"]
+    if old and new:
+        change = (new - old) / old
+        flag = ""
+        if change > tolerance:
+            flag = "  REGRESSION"
+            regressed = True
+        print(f"  {'p50_ms':<20} {old:>10} -> {new:<10} {change:+.1%}{flag}")
+    newly_loaded = sorted(set(results["deferred_loaded"]) - set(baseline.get("deferred_loaded", [])))
+    if newly_loaded:
+        print(f"  Now loaded at startup: {', '.join(newly_loaded)}  REGRESSION")
+        regressed = True
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="lifxbridge.startup", description="Measure how long the bridge takes to import")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS, help="fresh interpreters to time")
+    parser.add_argument("--modules", default=",".join(PLUGIN_IMPORTS), help="comma separated list of modules to import")
+    parser.add_argument("--save", metavar="FILE", help="write the results to FILE as a JSON baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results with a JSON baseline")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="fractional change that counts as a regression")
+    args = parser.parse_args()
+
+    modules = [name.strip() for name in args.modules.split(",") if name.strip()]
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {"modules": modules},
+    }
+    results.update(run(modules, args.runs, cwd))
+
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "w") as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("config") != results["config"]:
+            print(f"\nWarning: baseline config {baseline.get('config')} differs from this run")
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
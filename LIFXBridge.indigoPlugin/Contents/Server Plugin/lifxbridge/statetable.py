@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Fixed-layout table of published device state in shared memory.
+#
+# One row per device, at a fixed offset, so a reader in any process gets a device's state with a couple of
+# struct reads instead of a chain of Python object lookups, and a large install costs 80 bytes per device.
+# There is one writer (the plugin process, serialized by a lock) and any number of readers, kept apart with
+# a seqlock: the writer makes the row's version odd, writes the row, and makes it even again, and a reader
+# that sees an odd version, or a different version after reading, reads the row again.
+#
+# Row layout, little endian:
+#
+#   version      uint32     seqlock counter, odd while the row is being written
+#   device id    uint64     0 for a free row
+#   present      uint8      0 if the device couldn't be read from the backend
+#   mac          6 bytes
+#   power        uint16     0 or 65535
+#   brightness   uint16
+#   hue, saturation, brightness, kelvin    uint16 each
+#   product      uint32     LIFX product ID
+#   label        32 bytes   UTF-8, NUL padded, as sent in StateLabel
+####################
+
+import struct
+import time
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+from .encode import encode_label
+
+MAGIC = b"LXST"
+HEADER = struct.Struct("<4sI")                          # magic, capacity
+VERSION = struct.Struct("<I")
+BODY = struct.Struct("<QB6sHHHHHHI32s")
+ROW_SIZE = 80
+DEFAULT_CAPACITY = 256                                  # rows in a new table
+
+assert VERSION.size + BODY.size <= ROW_SIZE
+
+
+class DeviceState(namedtuple("DeviceState", ["version", "id", "mac", "power", "brightness", "color", "product", "label"])):
+    __slots__ = ()
+
+
+def mac_bytes(mac):
+    return bytes.fromhex(mac.replace(":", ""))
+
+
+def mac_string(raw):
+    return ":".join(f"{byte:02x}" for byte in raw)
+
+
+class StateTable(object):
+
+    def __init__(self, memory, owner):
+        self.memory = memory
+        self.owner = owner
+        self.buffer = memory.buf
+        magic, self.capacity = HEADER.unpack_from(self.buffer, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{memory.name} isn't a device state table")
+
+    ########################################
+    # Make a new table, owned (and eventually unlinked) by this process
+    ########################################
+    @classmethod
+    def create(cls, capacity=DEFAULT_CAPACITY):
+        memory = shared_memory.SharedMemory(create=True, size=HEADER.size + capacity * ROW_SIZE)
+        HEADER.pack_into(memory.buf, 0, MAGIC, capacity)
+        return cls(memory, True)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(shared_memory.SharedMemory(name=name), False)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def offset(self, row):
+        if not 0 <= row < self.capacity:
+            raise IndexError(f"row {row} is outside the table ({self.capacity} rows)")
+        return HEADER.size + row * ROW_SIZE
+
+    ########################################
+    # Write a device's row.  state is (power, brightness, color, product) or None if the device couldn't be read.
+    # Only one thread at a time may write to a table.
+    ########################################
+    def write(self, row, device, state):
+        if state is None:
+            fields = (device.id, 0, mac_bytes(device.mac), 0, 0, 0, 0, 0, 0, 0, encode_label(device.label))
+        else:
+            power, brightness, (hue, saturation, value, kelvin), product = state
+            fields = (device.id, 1, mac_bytes(device.mac), int(power), int(brightness), int(hue), int(saturation), int(value), int(kelvin),
+                      int(product), encode_label(device.label))
+        self._write(row, fields)
+
+    def clear(self, row):
+        self._write(row, (0, 0, bytes(6), 0, 0, 0, 0, 0, 0, 0, b""))
+
+    def _write(self, row, fields):
+        offset = self.offset(row)
+        version = VERSION.unpack_from(self.buffer, offset)[0]
+        VERSION.pack_into(self.buffer, offset, (version + 1) & 0xFFFFFFFF)
+        BODY.pack_into(self.buffer, offset + VERSION.size, *fields)
+        VERSION.pack_into(self.buffer, offset, (version + 2) & 0xFFFFFFFF)
+
+    ########################################
+    # Read a row.  Returns a DeviceState, or None if the row is free or the device couldn't be read.
+    ########################################
+    def read(self, row):
+        offset = self.offset(row)
+        while True:
+            version = VERSION.unpack_from(self.buffer, offset)[0]
+            if version & 1:
+                time.sleep(0)       # the writer is part way through, let it finish
+                continue
+            devID, present, mac, power, brightness, hue, saturation, value, kelvin, product, label = BODY.unpack_from(self.buffer, offset + VERSION.size)
+            if VERSION.unpack_from(self.buffer, offset)[0] == version:
+                break
+        if not devID or not present:
+            return None
+        return DeviceState(version, devID, mac_string(mac), power, brightness, (hue, saturation, value, kelvin), product,
+                           label.rstrip(b"\0").decode("utf-8", "ignore"))
+
+    ########################################
+    # The row's version alone, to tell whether it's been written since it was last read
+    ########################################
+    def version(self, row):
+        return VERSION.unpack_from(self.buffer, self.offset(row))[0]
+
+    def close(self):
+        self.buffer = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
@@ -0,0 +1,155 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Per-request stage tracing for the bridge.
+#
+# While tracing is on, every request the receive thread handles gets a Trace.  The engine calls mark(stage)
+# as it goes, and each mark credits the time since the previous mark to that stage, so a finished trace is a
+# breakdown of where the request's time went:
+#
+#   route     peeking at the raw header, rate limiting, and waiting in the inbound priority queue
+#   decode    unpack_lifx_message
+#   lookup    dispatch and registry lookups up to a backend call
+#   backend   the device backend (Indigo) call itself
+#   encode    building the reply message, which is where the bitstring packing happens
+#   queue     handing the reply to the egress queue
+#   send      the egress flush right after the request was handled
+#   dispatch  whatever is left after the last reply, mostly logging
+#
+# Finished traces go into a bounded buffer.  Any trace over the slow threshold is logged with its breakdown,
+# at most one every slow_log_interval seconds so a burst of slow requests doesn't flood the log.
+#
+# Each mark is a perf_counter_ns() call and a list append.  When tracing is off, start() returns None and
+# mark() returns as soon as it finds no trace for the current thread.
+####################
+
+import logging
+import threading
+import time
+from collections import deque
+
+DEFAULT_TRACE_BUFFER = 2048         # finished traces kept
+DEFAULT_SLOW_THRESHOLD = 0.25       # seconds
+DEFAULT_SLOW_LOG_INTERVAL = 10.0    # seconds between slow request log entries
+
+STAGES = ("route", "decode", "lookup", "backend", "encode", "queue", "send", "dispatch")
+
+
+class Trace(object):
+    __slots__ = ("client", "name", "start", "last", "marks")
+
+    def __init__(self, client, start=None):
+        self.client = client
+        self.name = None
+        self.start = self.last = start or time.perf_counter_ns()
+        self.marks = []             # (stage, nanoseconds) in the order they happened
+
+    def mark(self, stage):
+        now = time.perf_counter_ns()
+        self.marks.append((stage, now - self.last))
+        self.last = now
+
+    def total(self):
+        return self.last - self.start
+
+    ########################################
+    # Nanoseconds spent in each stage, in STAGES order, for the stages this request went through
+    ########################################
+    def stages(self):
+        totals = dict()
+        for stage, elapsed in self.marks:
+            totals[stage] = totals.get(stage, 0) + elapsed
+        return {stage: totals[stage] for stage in STAGES if stage in totals}
+
+    def __str__(self):
+        stages = ", ".join(f"{stage} {elapsed / 1e6:.2f}" for stage, elapsed in self.stages().items())
+        return f"{self.name} from {self.client[0]}:{self.client[1]} took {self.total() / 1e6:.2f} ms ({stages})"
+
+
+class Tracer(object):
+
+    def __init__(self, size=DEFAULT_TRACE_BUFFER, slow_threshold=DEFAULT_SLOW_THRESHOLD, slow_log_interval=DEFAULT_SLOW_LOG_INTERVAL):
+        self.logger = logging.getLogger("Plugin.Trace")
+        self.enabled = False
+        self.traces = deque(maxlen=size)
+        self.slow_threshold = slow_threshold
+        self.slow_log_interval = slow_log_interval
+        self.local = threading.local()
+        self.next_slow_log = 0.0
+        self.slow_suppressed = 0
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+        if not enabled:
+            self.traces.clear()
+
+    ########################################
+    # Start tracing a request on the current thread, from start (perf_counter_ns) if it's given.  Returns
+    # None if tracing is off.
+    ########################################
+    def start(self, client, start=None):
+        if not self.enabled:
+            return None
+        trace = self.local.trace = Trace(client, start)
+        return trace
+
+    ########################################
+    # Credit the time since the last mark to stage.  Does nothing on threads that aren't tracing a request,
+    # which includes the fan-out pool.
+    ########################################
+    def mark(self, stage):
+        trace = getattr(self.local, "trace", None)
+        if trace is not None:
+            trace.mark(stage)
+
+    def name(self, name):
+        trace = getattr(self.local, "trace", None)
+        if trace is not None:
+            trace.name = name
+
+    ########################################
+    # End the current thread's trace.  Datagrams that weren't handled as requests are dropped.
+    ########################################
+    def finish(self, stage):
+        trace = self.local.trace
+        self.local.trace = None
+        if trace.name is None:
+            return
+        trace.mark(stage)
+        self.traces.append(trace)
+        if trace.total() >= self.slow_threshold * 1e9:
+            now = time.time()
+            if now < self.next_slow_log:
+                self.slow_suppressed += 1
+                return
+            suppressed = f" ({self.slow_suppressed} more slow requests since the last one logged)" if self.slow_suppressed else ""
+            self.logger.warning(f"Slow request: {trace}{suppressed}")
+            self.next_slow_log = now + self.slow_log_interval
+            self.slow_suppressed = 0
+
+    ########################################
+    # Summary of the buffered traces for the log: per message type, the mean and worst total time and the
+    # mean time in each stage, followed by the slowest few traces.
+    ########################################
+    def report(self, slowest=5):
+        traces = list(self.traces)
+        if not traces:
+            return ["No request traces recorded" + ("" if self.enabled else ", tracing is turned off")]
+        by_name = dict()
+        for trace in traces:
+            by_name.setdefault(trace.name, []).append(trace)
+
+        lines = [f"Request traces for the last {len(traces)} requests (ms):"]
+        for name, group in sorted(by_name.items()):
+            stage_totals = dict()
+            for trace in group:
+                for stage, elapsed in trace.stages().items():
+                    stage_totals[stage] = stage_totals.get(stage, 0) + elapsed
+            totals = [trace.total() for trace in group]
+            stages = ", ".join(f"{stage} {stage_totals[stage] / len(group) / 1e6:.2f}" for stage in STAGES if stage in stage_totals)
+            lines.append(f"    {name:<18} count {len(group):>6}  mean {sum(totals) / len(totals) / 1e6:8.2f}  max {max(totals) / 1e6:8.2f}  ({stages})")
+
+        lines.append("Slowest requests:")
+        for trace in sorted(traces, key=Trace.total, reverse=True)[:slowest]:
+            lines.append(f"    {trace}")
+        return lines
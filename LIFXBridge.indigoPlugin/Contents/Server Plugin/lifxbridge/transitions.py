@@ -0,0 +1,315 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Software transitions: fades for the duration field of LightSetColor/LightSetPower, and LightSetWaveform.
+#
+# Indigo devices can't fade or pulse by themselves, so the bridge does it by sending a series of intermediate
+# color/brightness commands.  All of them run on one scheduler thread, driven by a hierarchical timer wheel:
+# every running transition has a single timer for its next step, so scheduling and cancelling are O(1) and
+# hundreds of fades cost one thread and a few list appends per step.
+#
+# Steps are rate limited twice over.  Each device gets at most one step every step_interval, and a step is
+# only sent when the color has moved far enough for Indigo to show it (1% brightness, 1 degree of hue).  On
+# top of that the whole scheduler sends at most max_steps_per_second, so a big fade can't swamp the Z-Wave or
+# Insteon network; steps over the budget are skipped and the next one catches up.  The final step of a
+# transition is always sent.  A newer command for a device cancels its running transition.
+####################
+
+import logging
+import math
+import threading
+import time
+
+DEFAULT_TICK = 0.02                 # seconds per timer wheel tick
+WHEEL_SLOTS = (256, 64, 64)         # buckets per level: about 5 seconds, 5 minutes and 6 hours at 20 ms ticks
+DEFAULT_STEP_INTERVAL = 0.25        # seconds between steps for one device
+DEFAULT_MAX_STEPS_PER_SECOND = 20   # for all devices together, 0 for no limit
+LOWEST_LEVEL = 656                  # the dimmest visible step, 1%, where a fade to off ends before the device is turned off
+
+# LightSetWaveform waveform field
+WAVEFORM_SAW = 0
+WAVEFORM_SINE = 1
+WAVEFORM_HALF_SINE = 2
+WAVEFORM_TRIANGLE = 3
+WAVEFORM_PULSE = 4
+
+
+class TimerWheel(object):
+
+    ########################################
+    # Level 0 has a bucket per tick; each bucket of a higher level covers a whole turn of the level below it.
+    # Timers are kept in the lowest level that reaches far enough, and moved down a level ("cascaded") as
+    # their bucket comes round.  Anything beyond the top level waits in overflow.
+    ########################################
+    def __init__(self, slots=WHEEL_SLOTS):
+        self.slots = slots
+        self.levels = [[[] for _ in range(count)] for count in slots]
+        self.spans = []             # ticks covered by one bucket at each level
+        span = 1
+        for count in slots:
+            self.spans.append(span)
+            span *= count
+        self.overflow = []
+        self.current = 0            # the last tick that has been run
+        self.count = 0              # timers in the wheel, including cancelled ones not yet reached
+
+    ########################################
+    # Move the wheel to tick without running anything in between.  Only used when it's empty.
+    ########################################
+    def reset(self, tick):
+        self.current = tick
+
+    def schedule(self, due, item):
+        self.count += 1
+        self._insert(max(due, self.current + 1), item)
+
+    def _insert(self, due, item):
+        ahead = due - self.current
+        for level, span in enumerate(self.spans):
+            if ahead < span * self.slots[level]:
+                self.levels[level][(due // span) % self.slots[level]].append((due, item))
+                return
+        self.overflow.append((due, item))
+
+    ########################################
+    # Run the wheel forward to tick.  Returns the items that came due, in order.
+    ########################################
+    def advance(self, tick):
+        due = []
+        while self.current < tick:
+            self.current += 1
+            for level in range(len(self.slots) - 1, 0, -1):
+                span = self.spans[level]
+                if self.current % span == 0:
+                    if level == len(self.slots) - 1 and self.overflow:
+                        waiting, self.overflow = self.overflow, []
+                        for entry in waiting:
+                            self._insert(*entry)
+                    index = (self.current // span) % self.slots[level]
+                    bucket, self.levels[level][index] = self.levels[level][index], []
+                    for entry in bucket:
+                        self._insert(*entry)
+            index = self.current % self.slots[0]
+            bucket, self.levels[0][index] = self.levels[0][index], []
+            due.extend(item for _, item in bucket)
+        self.count -= len(due)
+        return due
+
+
+########################################
+# Mix two (hue, saturation, brightness, kelvin) colors, fraction of the way from start to end.  Hue goes the
+# short way round the color wheel.
+########################################
+def blend(start, end, fraction):
+    hue_change = (end[0] - start[0] + 32768) % 65536 - 32768
+    return (int(round(start[0] + hue_change * fraction)) % 65536,
+            int(round(start[1] + (end[1] - start[1]) * fraction)),
+            int(round(start[2] + (end[2] - start[2]) * fraction)),
+            int(round(start[3] + (end[3] - start[3]) * fraction)))
+
+
+########################################
+# The steps Indigo can tell apart: whole degrees of hue, whole percent of saturation and brightness, 50K
+########################################
+def visible(color):
+    return color[0] // 182, color[1] // 656, color[2] // 656, color[3] // 50
+
+
+class Transition(object):
+
+    def __init__(self, devID, on_done=None):
+        self.devID = devID
+        self.on_done = on_done      # called once after the final step, unless the transition is cancelled or a step fails
+        self.started = None
+        self.last_sent = None
+
+    # The color elapsed seconds in, and whether that's the end of the transition
+    def color_at(self, elapsed):
+        raise NotImplementedError
+
+
+class Fade(Transition):
+
+    ########################################
+    #   brightness is, for a power fade, the device's brightness with the power on: what a fade to off started
+    #   from and the device comes back to, or what a fade to on ends at
+    ########################################
+    def __init__(self, devID, start, end, duration, on_done=None, brightness=None):
+        Transition.__init__(self, devID, on_done)
+        self.start = tuple(start)
+        self.end = tuple(end)
+        self.duration = duration
+        self.brightness = brightness
+
+    def color_at(self, elapsed):
+        if elapsed >= self.duration:
+            return self.end, True
+        return blend(self.start, self.end, elapsed / self.duration), False
+
+
+########################################
+# A LightSetWaveform: swing between the original color and color for cycles periods.  skew is 0-1; it's the
+# fraction of the period spent on color for a pulse, and where the peak falls for a sine or triangle.  A
+# transient waveform ends back on the original color, otherwise it ends on color.
+########################################
+class Waveform(Transition):
+
+    def __init__(self, devID, original, color, period, cycles, skew, waveform, transient, on_done=None):
+        Transition.__init__(self, devID, on_done)
+        self.original = tuple(original)
+        self.color = tuple(color)
+        self.period = max(period, 0.001)
+        self.cycles = max(cycles, 0.0)
+        self.skew = min(max(skew, 0.0), 1.0)
+        self.waveform = waveform
+        self.transient = transient
+
+    def color_at(self, elapsed):
+        if elapsed >= self.period * self.cycles:
+            return (self.original if self.transient else self.color), True
+        return blend(self.original, self.color, self.level(elapsed / self.period % 1.0)), False
+
+    ########################################
+    # How far towards color the waveform is at phase (0-1) of a period
+    ########################################
+    def level(self, phase):
+        if self.waveform == WAVEFORM_SAW:
+            return phase
+        if self.waveform == WAVEFORM_PULSE:
+            return 1.0 if phase < self.skew else 0.0
+        if self.waveform == WAVEFORM_HALF_SINE:
+            return math.sin(math.pi * phase)
+        # sine and triangle rise to color at the skew point and fall back by the end of the period
+        peak = self.skew if 0.0 < self.skew < 1.0 else 0.5
+        rising = phase / peak if phase < peak else (1.0 - phase) / (1.0 - peak)
+        if self.waveform == WAVEFORM_TRIANGLE:
+            return rising
+        return (1.0 - math.cos(math.pi * rising)) / 2.0
+
+
+class TransitionScheduler(object):
+
+    ########################################
+    #   apply(devID, color) sends one step to the device and returns True if it worked; a failed step ends the
+    #   transition
+    ########################################
+    def __init__(self, apply, step_interval=DEFAULT_STEP_INTERVAL, max_steps_per_second=DEFAULT_MAX_STEPS_PER_SECOND,
+                 tick=DEFAULT_TICK):
+        self.logger = logging.getLogger("Plugin.Transitions")
+        self.apply = apply
+        self.enabled = True
+        self.step_interval = step_interval
+        self.max_steps_per_second = max_steps_per_second
+        self.tick = tick
+        self.wheel = TimerWheel()
+        self.active = dict()                # devID -> running Transition
+        self.condition = threading.Condition()
+        self.step_lock = threading.Lock()   # held while a step runs, so cancel() can wait for it
+        self.epoch = time.monotonic()
+        self.budget = float(max_steps_per_second)
+        self.budget_time = self.epoch
+        self.steps = 0
+        self.skipped = 0
+        self.thread = None
+        self.stopping = False
+
+    def now_tick(self):
+        return int((time.monotonic() - self.epoch) / self.tick)
+
+    ########################################
+    # Start a transition, replacing any that's running for the same device.  The first step is sent on the
+    # scheduler thread, at the next tick.
+    ########################################
+    def start(self, transition):
+        self.cancel(transition.devID)
+        transition.started = time.monotonic()
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="LIFXTransitions", daemon=True)
+                self.thread.start()
+            self.active[transition.devID] = transition
+            if not self.wheel.count:
+                self.wheel.reset(self.now_tick())
+            self.wheel.schedule(self.now_tick() + 1, transition)
+            self.condition.notify()
+
+    ########################################
+    # Stop a device's transition where it is.  Waits for a step that's being sent to finish, so a command
+    # sent after this can't be overtaken by a late step.  Returns True if there was one.
+    ########################################
+    def cancel(self, devID):
+        if devID not in self.active:
+            return False
+        with self.step_lock:
+            with self.condition:
+                return self.active.pop(devID, None) is not None
+
+    def running(self):
+        return len(self.active)
+
+    ########################################
+    # Cancel everything and end the scheduler thread.  Takes step_lock like cancel(), so a step that's being
+    # sent finishes first.
+    ########################################
+    def stop(self):
+        with self.step_lock:
+            with self.condition:
+                self.stopping = True
+                self.active = dict()
+                self.condition.notify()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopping and not self.wheel.count:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                self.condition.wait(self.tick)
+                due = self.wheel.advance(self.now_tick())
+            for transition in due:
+                try:
+                    self.step(transition)
+                except Exception as err:
+                    self.logger.exception(f"Transition step for device {transition.devID} failed: {err}")
+                    with self.condition:
+                        if self.active.get(transition.devID) is transition:
+                            del self.active[transition.devID]
+
+    ########################################
+    # Send one step of a transition and schedule the next
+    ########################################
+    def step(self, transition):
+        with self.step_lock:
+            if self.active.get(transition.devID) is not transition:
+                return      # cancelled or replaced since this step was scheduled
+            now = time.monotonic()
+            color, finished = transition.color_at(now - transition.started)
+            failed = False
+            if visible(color) != transition.last_sent and (finished or self.take_step(now)):
+                transition.last_sent = visible(color)
+                self.steps += 1
+                failed = self.apply(transition.devID, color) is not True
+            elif not finished:
+                self.skipped += 1
+            if finished or failed:
+                with self.condition:
+                    if self.active.get(transition.devID) is transition:
+                        del self.active[transition.devID]
+                if finished and not failed and transition.on_done:
+                    transition.on_done()
+                return
+        with self.condition:
+            self.wheel.schedule(int((now + self.step_interval - self.epoch) / self.tick), transition)
+
+    def take_step(self, now):
+        if not self.max_steps_per_second:
+            return True
+        self.budget = min(float(self.max_steps_per_second), self.budget + (now - self.budget_time) * self.max_steps_per_second)
+        self.budget_time = now
+        if self.budget < 1.0:
+            return False
+        self.budget -= 1.0
+        return True
@@ -0,0 +1,89 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Warm-start snapshot of the published devices.
+#
+# Building the registry means scanning the whole Indigo database, which takes seconds on a big install, and
+# clients that poll while the bridge isn't answering mark their devices unreachable.  The registry is saved
+# to a small binary file after every full scan and at shutdown, together with the pre-encoded parts of each
+# device's replies.  At startup the file is memory-mapped and the registry built straight from it, so the
+# bridge can answer discovery right away while the real scan runs in the background.
+#
+# File layout, little endian:
+#
+#   header   magic "LXWS", format version (uint16), reserved (uint16), device count (uint32)
+#   device   id (uint64), name length (uint16), alias length (uint16), target (8 bytes: MAC and two zero
+#            bytes), location (16 bytes), encoded label (32 bytes), then the name and alias in UTF-8
+####################
+
+import mmap
+import os
+import struct
+
+from .encode import EncodedDevice
+from .registry import PublishedDevice
+
+MAGIC = b"LXWS"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHHI")
+RECORD = struct.Struct("<QHH8s16s32s")
+
+
+########################################
+# Write the snapshot's devices to path.  The file is written next to it and renamed into place, so a crash
+# part way through leaves the old one.  Returns the number of devices written.
+########################################
+def save(path, snapshot):
+    chunks = [HEADER.pack(MAGIC, FORMAT_VERSION, 0, len(snapshot))]
+    for device in snapshot:
+        encoded = snapshot.encoded[device.id]
+        name = device.name.encode("utf-8")
+        alias = device.alias.encode("utf-8")
+        chunks.append(RECORD.pack(device.id, len(name), len(alias), encoded.target, encoded.location, encoded.label))
+        chunks.append(name)
+        chunks.append(alias)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as out:
+        out.write(b"".join(chunks))
+    os.replace(temp_path, path)
+    return len(snapshot)
+
+
+########################################
+# Read a snapshot written by save.  Returns (devices, encoded): a list of PublishedDevice and a dict of
+# devID -> EncodedDevice, ready for DeviceRegistry.replace.  Raises OSError if the file can't be read and
+# ValueError if it isn't a snapshot or is damaged.
+########################################
+def load(path):
+    with open(path, "rb") as source:
+        with mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return parse(data)
+
+
+def parse(data):
+    try:
+        magic, version, _, count = HEADER.unpack_from(data, 0)
+    except struct.error:
+        raise ValueError("too short for a warm-start snapshot")
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError("not a warm-start snapshot, or from a different version")
+
+    devices = []
+    encoded = dict()
+    offset = HEADER.size
+    try:
+        for _ in range(count):
+            devID, name_length, alias_length, target, location, label = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            name = bytes(data[offset:offset + name_length]).decode("utf-8")
+            offset += name_length
+            alias = bytes(data[offset:offset + alias_length]).decode("utf-8")
+            offset += alias_length
+            mac = ":".join(f"{byte:02x}" for byte in target[:6])
+            devices.append(PublishedDevice(devID, name, alias, mac, bytearray(location)))
+            encoded[devID] = EncodedDevice(target, label, location)
+    except (struct.error, UnicodeDecodeError) as err:
+        raise ValueError(f"damaged warm-start snapshot: {err}")
+    if offset != len(data):
+        raise ValueError("damaged warm-start snapshot: unexpected data after the last device")
+    return devices, encoded
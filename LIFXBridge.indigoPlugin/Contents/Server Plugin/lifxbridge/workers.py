@@ -0,0 +1,411 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Multi-process receivers for the bridge.
+#
+# One receive thread doing decode, dispatch and encode is as fast as the bridge gets, and the GIL means more
+# threads don't help.  In worker mode several processes each run their own engine on the same port using
+# SO_REUSEPORT.  On Linux the kernel spreads unicast datagrams across the sockets by client address; every
+# socket gets its own copy of a broadcast, so each broadcast is answered by just one worker, picked from the
+# client's address the same way in every process.  The destination address comes from IP_PKTINFO.  macOS
+# doesn't balance unicast between SO_REUSEPORT sockets (the last one bound gets it all), so there only the
+# discovery broadcasts are spread out.
+#
+# The workers answer from the device state table (statetable.py) in shared memory, which only the main process
+# writes: every device when the registry changes, and one device whenever it's updated.  The device list
+# itself, with each device's row in the table, is pushed to the workers over a queue when the registry
+# changes.  Set commands are acknowledged by the worker straight away and sent back over a queue; the main
+# process is the only one that talks to the real backend (Indigo), and runs the commands through its own
+# engine so they're timed and counted there.  Worker log records are forwarded to the main process's loggers.
+#
+# Statistics, tracing and packet capture in the workers stay in the workers.
+####################
+
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+import threading
+from collections import OrderedDict
+
+from .backend import DeviceBackend, DeviceNotFound
+from .engine import BridgeEngine, IP_PKTINFO
+from .statetable import StateTable, DEFAULT_CAPACITY
+
+START_TIMEOUT = 10.0                # seconds for a worker to bind its socket
+STOP_TIMEOUT = 5.0                  # seconds for a worker to exit before it's terminated
+PARENT_CHECK_INTERVAL = 1.0         # seconds between checks that the main process is still there
+
+
+########################################
+# Which worker answers broadcasts from a client.  Python's hash() of a string differs between processes, so
+# this is worked out from the address itself.
+########################################
+def shard(addr, count):
+    return (int.from_bytes(socket.inet_aton(addr[0]), "big") + addr[1]) % count
+
+
+class WorkerBackend(DeviceBackend):
+
+    ########################################
+    # The devices pushed from the main process, each device's row in the state table, and the state this
+    # worker has assumed after sending a command: devID -> (row version when it was sent, state).
+    ########################################
+    def __init__(self, commands):
+        self.commands = commands
+        self.devices = []
+        self.table = None
+        self.rows = dict()
+        self.assumed = dict()
+
+    def published_devices(self):
+        return self.devices
+
+    ########################################
+    # Switch to a new device list, attaching to the table first if it's a new one
+    ########################################
+    def follow(self, devices, rows, table_name):
+        if self.table is None or self.table.name != table_name:
+            table = StateTable.attach(table_name)
+            if self.table:
+                self.table.close()
+            self.table = table
+        self.rows = rows
+        self.devices = devices
+
+    def close(self):
+        if self.table:
+            self.table.close()
+            self.table = None
+
+    ########################################
+    # Returns (power, brightness, color, product).  A command's assumed state is used until the main process
+    # writes the device's row again.
+    ########################################
+    def device_state(self, devID):
+        row = self.rows.get(devID)
+        state = self.table.read(row) if row is not None else None
+        if state is None or state.id != devID:
+            raise DeviceNotFound(devID)
+        assumed = self.assumed.get(devID)
+        if assumed:
+            if assumed[0] == state.version:
+                return assumed[1]
+            del self.assumed[devID]
+        return state.power, state.brightness, state.color, state.product
+
+    def get_power(self, devID):
+        return self.device_state(devID)[0]
+
+    def get_brightness(self, devID):
+        return self.device_state(devID)[1]
+
+    def get_color(self, devID):
+        return self.device_state(devID)[2]
+
+    def get_product(self, devID):
+        return self.device_state(devID)[3]
+
+    ########################################
+    # Commands go to the main process.  The new state is assumed right away so a state reply to the command
+    # shows it; the real state replaces it once the main process has written the device's row.
+    ########################################
+    def set_power(self, devID, turnOn):
+        power, brightness, color, product = self.device_state(devID)
+        self.commands.put(("set_power", devID, turnOn))
+        self.assume(devID, (65535 if turnOn else 0, brightness, color, product))
+        return True
+
+    def set_color(self, devID, hue, saturation, brightness, kelvin):
+        _, _, _, product = self.device_state(devID)
+        self.commands.put(("set_color", devID, hue, saturation, brightness, kelvin))
+        self.assume(devID, (65535 if brightness else 0, brightness, (hue, saturation, brightness, kelvin), product))
+        return True
+
+    def assume(self, devID, state):
+        self.assumed[devID] = (self.table.version(self.rows[devID]), state)
+
+
+class WorkerEngine(BridgeEngine):
+
+    def __init__(self, backend, port, bind_addr, index, count):
+        BridgeEngine.__init__(self, backend, port, bind_addr, reuse_port=True)
+        self.index = index
+        self.count = count
+        self.broadcasts_skipped = 0
+        # the backend commands go to the main process one by one, so timed commands and waveforms aren't
+        # played out here: the device goes straight to the end state
+        self.transitions.enabled = False
+
+    def open(self):
+        BridgeEngine.open(self)
+        if IP_PKTINFO is None:
+            self.logger.warning("IP_PKTINFO isn't available on this platform, every worker will answer broadcasts")
+        elif not self.pktinfo:
+            self.sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+            self.pktinfo = True
+
+    ########################################
+    # Like BridgeEngine.receive, but broadcasts are left to the worker whose turn it is for the client.  A
+    # datagram was broadcast if its header destination isn't the local address it arrived on.
+    ########################################
+    def receive(self):
+        received = self.receive_datagram()
+        if received is None:
+            return None
+        data, addr, local, destination = received
+        if self.count > 1 and local != destination and shard(addr, self.count) != self.index:
+            self.broadcasts_skipped += 1
+            return None
+        return data, addr
+
+    ########################################
+    # Apply the device lists pushed from the main process.  None, or the main process going away, stops the engine.
+    ########################################
+    def follow(self, updates, parent_pid):
+        while not self.stop_event.is_set():
+            try:
+                update = updates.get(timeout=PARENT_CHECK_INTERVAL)
+            except queue.Empty:
+                if os.getppid() != parent_pid:
+                    self.stop_event.set()
+                continue
+            if update is None:
+                self.stop_event.set()
+                continue
+            _, devices, rows, table_name = update
+            try:
+                self.backend.follow(devices, rows, table_name)
+            except FileNotFoundError:
+                continue        # the table has already been replaced, the next update has the new one
+            self.registry.replace(devices)
+
+
+########################################
+# Entry point of a worker process
+########################################
+def run_worker(index, count, port, bind_addr, level, limits, parent_pid, ready, updates, commands, log_queue):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)     # the main process decides when the workers stop
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(level)
+
+    engine = WorkerEngine(WorkerBackend(commands), port, bind_addr, index, count)
+    engine.limiter.configure(**limits)
+    try:
+        engine.open()
+    except socket.error as err:
+        ready.put((index, None, str(err)))
+        return
+    ready.put((index, engine.port, None))
+
+    follower = threading.Thread(target=engine.follow, args=(updates, parent_pid), name="LIFXFollow", daemon=True)
+    follower.start()
+    try:
+        engine.serve_forever(engine.stop_event)
+    finally:
+        engine.close()
+        engine.backend.close()
+        engine.logger.debug(f"worker {index} stopped, {engine.packets_in.total()} requests handled, "
+                            f"{engine.broadcasts_skipped} broadcasts left to other workers")
+
+
+########################################
+# Passes worker log records to the main process's logger of the same name
+########################################
+class ForwardHandler(logging.Handler):
+
+    def emit(self, record):
+        record.msg = f"[{record.processName}] {record.msg}"
+        logging.getLogger(record.name).handle(record)
+
+
+class WorkerPool(object):
+
+    ########################################
+    #   engine is the main process's engine.  It isn't opened; its registry and backend are the source of
+    #   the workers' devices, and the commands from the workers are run through it.
+    #   executable is the Python interpreter for the workers, if it isn't sys.executable.
+    ########################################
+    def __init__(self, engine, count, level=logging.INFO, executable=None):
+        self.logger = logging.getLogger("Plugin.Workers")
+        self.engine = engine
+        self.count = count
+        self.level = level
+        self.port = engine.port
+        self.context = multiprocessing.get_context("spawn")
+        if executable:
+            self.context.set_executable(executable)
+        self.processes = []
+        self.updates = []
+        self.commands = None
+        self.relay_thread = None
+        self.log_listener = None
+        self.lock = threading.Lock()     # serializes writes to the state table
+        self.table = None
+        self.rows = dict()               # devID -> row in the state table
+
+    ########################################
+    # Start the workers.  The first one binds the port (so a port of 0 is picked once) before the rest start.
+    # Raises socket.error if a worker can't be started or can't bind.
+    ########################################
+    def start(self):
+        self.table = StateTable.create(max(DEFAULT_CAPACITY, len(self.engine.registry.snapshot) * 2))
+        self.commands = self.context.Queue()
+        log_queue = self.context.Queue()
+        self.log_listener = logging.handlers.QueueListener(log_queue, ForwardHandler())
+        self.log_listener.start()
+        self.relay_thread = threading.Thread(target=self.relay, name="LIFXCommands", daemon=True)
+        self.relay_thread.start()
+
+        ready = self.context.Queue()
+        for index in range(self.count):
+            updates = self.context.Queue()
+            process = self.context.Process(target=run_worker, name=f"LIFXWorker{index + 1}", daemon=True,
+                                           args=(index, self.count, self.port, self.engine.bind_addr, self.level,
+                                                 self.engine.limiter.settings(), os.getpid(),
+                                                 ready, updates, self.commands, log_queue))
+            try:
+                process.start()
+            except OSError as err:     # e.g. the interpreter for the workers isn't there
+                self.stop()
+                raise socket.error(f"LIFX worker {index + 1} failed to start: {err}")
+            self.processes.append(process)
+            self.updates.append(updates)
+            try:
+                _, port, error = ready.get(timeout=START_TIMEOUT)
+            except queue.Empty:
+                error = f"no answer after {START_TIMEOUT} seconds"
+            if error:
+                self.stop()
+                raise socket.error(f"LIFX worker {index + 1} failed to start: {error}")
+            self.port = port
+
+        self.engine.registry.add_listener(self.publish)
+        self.publish(self.engine.registry.snapshot)
+        self.logger.info(f"{self.count} LIFX workers listening on port {self.port}")
+
+    def stop(self):
+        self.engine.registry.listeners = [listener for listener in self.engine.registry.listeners if listener != self.publish]
+        for updates in self.updates:
+            updates.put(None)
+        for process in self.processes:
+            process.join(STOP_TIMEOUT)
+            if process.is_alive():
+                self.logger.warning(f"{process.name} didn't stop, terminating it")
+                process.terminate()
+                process.join()
+        self.processes = []
+        self.updates = []
+        if self.relay_thread:
+            self.commands.put(None)
+            self.relay_thread.join()
+            self.relay_thread = None
+        if self.log_listener:
+            self.log_listener.stop()
+            self.log_listener = None
+        if self.table:
+            self.table.close()
+            self.table = None
+
+    ########################################
+    # Pushing devices and state to the workers
+    ########################################
+
+    ########################################
+    # Returns (power, brightness, color, product) for a device, or None if it's gone
+    ########################################
+    def device_state(self, devID):
+        backend = self.engine.backend
+        try:
+            return backend.get_power(devID), backend.get_brightness(devID), backend.get_color(devID), backend.get_product(devID)
+        except DeviceNotFound:
+            return None
+
+    ########################################
+    # Registry listener: write every device's row and send the workers the new device list.  A device keeps
+    # its row for as long as it's published, so a worker that hasn't had the new list yet still finds the
+    # devices it knows about.  When the table is full a bigger one replaces it.
+    ########################################
+    def publish(self, snapshot):
+        devices = list(snapshot)
+        with self.lock:
+            for devID in [devID for devID in self.rows if devID not in snapshot]:
+                self.table.clear(self.rows.pop(devID))
+            if len(devices) > self.table.capacity:
+                self.grow(len(devices) * 2)
+            free = sorted(set(range(self.table.capacity)) - set(self.rows.values()), reverse=True)
+            for device in devices:
+                if device.id not in self.rows:
+                    self.rows[device.id] = free.pop()
+                self.table.write(self.rows[device.id], device, self.device_state(device.id))
+            rows = dict(self.rows)
+            table_name = self.table.name
+        for updates in self.updates:
+            updates.put(("devices", devices, rows, table_name))
+
+    ########################################
+    # Move to a bigger, empty table; publish fills it in.  The old one is unlinked straight away, and workers
+    # still attached to it keep their mapping until they switch.
+    ########################################
+    def grow(self, capacity):
+        self.table.close()
+        self.table = StateTable.create(capacity)
+        self.logger.debug(f"device state table grown to {capacity} rows")
+
+    ########################################
+    # Rewrite one device's row, after it's changed
+    ########################################
+    def update_device(self, devID):
+        device = self.engine.registry.snapshot.get(devID)
+        if device is None:
+            return
+        state = self.device_state(devID)
+        with self.lock:
+            row = self.rows.get(devID)
+            if row is not None and self.table:
+                self.table.write(row, device, state)
+
+    ########################################
+    # Commands from the workers
+    ########################################
+
+    ########################################
+    # Runs on its own thread.  Whatever has queued up is taken in one go; each device's commands are run in
+    # order, and different devices in parallel through the engine's fan-out pool.
+    ########################################
+    def relay(self):
+        commands = {"set_power": self.engine.set_device_power, "set_color": self.engine.set_device_color}
+        while True:
+            batch = [self.commands.get()]
+            while batch[-1] is not None:
+                try:
+                    batch.append(self.commands.get_nowait())
+                except queue.Empty:
+                    break
+            by_device = OrderedDict()
+            for command in batch:
+                if command is not None:
+                    by_device.setdefault(command[1], []).append((commands[command[0]], command[2:]))
+            if len(by_device) == 1:
+                for devID, queued in by_device.items():
+                    self.run_commands(devID, queued)
+            elif by_device:
+                self.engine.fanout.run(list(by_device), lambda devID: self.run_commands(devID, by_device[devID]))
+            if batch[-1] is None:
+                return
+
+    ########################################
+    # The engine's setters log missing devices and count failures; anything else is logged here so one bad
+    # command doesn't stop the relay.
+    ########################################
+    def run_commands(self, devID, queued):
+        for func, args in queued:
+            try:
+                func(devID, *args)
+            except Exception as err:
+                self.logger.error(f"{func.__name__} for device {devID} failed: {err}")
+        return True
@@ -0,0 +1,192 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+####################
+# Zone strips: a group of devices published as one emulated LIFX Z, with one zone per device.
+#
+# A big install published bulb by bulb makes every discovery cost a StateService per device, and then a
+# GetVersion/GetLabel/LightGet exchange per device on top.  A zone strip is a single published device, so the
+# whole group costs one of each, and clients that understand multizone lights get at the members' colors
+# with MultiZoneGetColorZones (8 zones per reply) and change any range of them with MultiZoneSetColorZones.
+#
+# ZoneStripBackend wraps the real backend and adds the strips to its published devices.  Everything asked of
+# a strip is answered from, or carried out on, its member devices; everything else goes straight through.
+# The members of a strip are either the devices in a folder, in name order, looked up again at every rescan,
+# or a fixed list of device IDs.  A member that has gone away shows as an unlit zone and ignores commands,
+# so the zone numbering doesn't shift under the clients.
+####################
+
+import logging
+import threading
+from collections import namedtuple
+
+from .backend import DeviceBackend, DeviceNotFound, fakeMAC, PRODUCT_LIFX_Z
+from .registry import PublishedDevice
+
+FIRST_STRIP_ID = 0xF0000000     # above any Indigo ID, and still fits in a fake MAC
+MAX_ZONES = 255                 # zone indexes and counts are a single byte
+UNLIT_ZONE = (0, 0, 0, 3500)
+
+# MultiZoneSetColorZones apply field: NO_APPLY holds the colors until a later message applies them
+NO_APPLY = 0
+APPLY = 1
+APPLY_ONLY = 2
+
+
+########################################
+# A strip definition.  folder is a folder ID (0 for none) and devices a list of device IDs, used when there's
+# no folder.  location is the 16 byte LIFX location/group ID.
+########################################
+class ZoneStrip(namedtuple("ZoneStrip", ["id", "name", "folder", "devices", "location"])):
+    __slots__ = ()
+
+    @property
+    def published(self):
+        return PublishedDevice(self.id, self.name, "", fakeMAC(self.id), self.location)
+
+
+def next_strip_id(strips):
+    return max([FIRST_STRIP_ID - 1] + [strip.id for strip in strips]) + 1
+
+
+class ZoneStripBackend(DeviceBackend):
+
+    def __init__(self, backend):
+        self.logger = logging.getLogger("Plugin.ZoneStrips")
+        self.backend = backend
+        self.strips = dict()        # strip ID -> ZoneStrip
+        self.members = dict()       # strip ID -> list of member device IDs, one per zone
+        self.pending = dict()       # strip ID -> {zone: color} held by NO_APPLY messages
+        self.lock = threading.Lock()
+
+    def set_strips(self, strips):
+        with self.lock:
+            self.strips = {strip.id: strip for strip in strips}
+            self.members = dict()
+            self.pending = dict()
+
+    def published_devices(self):
+        devices = self.backend.published_devices()
+        with self.lock:
+            strips = list(self.strips.values())
+            self.members = dict()
+        for strip in strips:
+            self.resolve(strip)
+            devices.append(strip.published)
+        return devices
+
+    ########################################
+    # The member devices of a strip, looked up on first use after each rescan
+    ########################################
+    def zone_members(self, stripID):
+        with self.lock:
+            members = self.members.get(stripID)
+            strip = self.strips.get(stripID)
+        if members is not None:
+            return members
+        if strip is None:
+            raise DeviceNotFound(stripID)
+        return self.resolve(strip)
+
+    def resolve(self, strip):
+        members = self.backend.folder_devices(strip.folder) if strip.folder else list(strip.devices)
+        if len(members) > MAX_ZONES:
+            self.logger.warning(f"Zone strip {strip.name} has {len(members)} devices, only the first {MAX_ZONES} are published")
+            members = members[:MAX_ZONES]
+        with self.lock:
+            self.members[strip.id] = members
+        return members
+
+    def member_color(self, devID):
+        try:
+            return self.backend.get_color(devID) if self.backend.get_power(devID) else UNLIT_ZONE
+        except DeviceNotFound:
+            return UNLIT_ZONE
+
+    ########################################
+    # Run a command on some of a strip's members.  Members that have gone away are skipped; the command
+    # succeeded if it worked for every member that's still there.
+    ########################################
+    def run(self, members, func, *args):
+        result = True
+        for devID in members:
+            try:
+                if func(devID, *args) is not True:
+                    result = False
+            except DeviceNotFound:
+                pass
+        return result
+
+    ########################################
+    # Device state.  A strip is on if any member is on, reports its brightest member's brightness and the
+    # color of its first zone.
+    ########################################
+    def get_power(self, devID):
+        if devID not in self.strips:
+            return self.backend.get_power(devID)
+        return 65535 if any(self.member_color(member) != UNLIT_ZONE for member in self.zone_members(devID)) else 0
+
+    def get_brightness(self, devID):
+        if devID not in self.strips:
+            return self.backend.get_brightness(devID)
+        return max([self.member_color(member)[2] for member in self.zone_members(devID)] or [0])
+
+    def get_color(self, devID):
+        if devID not in self.strips:
+            return self.backend.get_color(devID)
+        members = self.zone_members(devID)
+        return self.member_color(members[0]) if members else UNLIT_ZONE
+
+    def get_product(self, devID):
+        if devID not in self.strips:
+            return self.backend.get_product(devID)
+        return PRODUCT_LIFX_Z
+
+    def folder_devices(self, folderID):
+        return self.backend.folder_devices(folderID)
+
+    ########################################
+    # Device commands.  Power and color commands for a strip go to every member.
+    ########################################
+    def set_power(self, devID, turnOn):
+        if devID not in self.strips:
+            return self.backend.set_power(devID, turnOn)
+        return self.run(self.zone_members(devID), self.backend.set_power, turnOn)
+
+    def set_color(self, devID, hue, saturation, brightness, kelvin):
+        if devID not in self.strips:
+            return self.backend.set_color(devID, hue, saturation, brightness, kelvin)
+        with self.lock:
+            self.pending.pop(devID, None)
+        return self.run(self.zone_members(devID), self.backend.set_color, hue, saturation, brightness, kelvin)
+
+    ########################################
+    # Multizone
+    ########################################
+    def get_zones(self, devID):
+        if devID not in self.strips:
+            return self.backend.get_zones(devID)
+        return [self.member_color(member) for member in self.zone_members(devID)]
+
+    def set_zones(self, devID, start, end, color, apply=APPLY):
+        if devID not in self.strips:
+            return self.backend.set_zones(devID, start, end, color, apply)
+        members = self.zone_members(devID)
+        with self.lock:
+            pending = self.pending.setdefault(devID, dict())
+            if apply != APPLY_ONLY:
+                for zone in range(start, min(end, len(members) - 1) + 1):
+                    pending[zone] = tuple(color)
+            if apply == NO_APPLY:
+                return True
+            del self.pending[devID]
+
+        # one command per color, for all the zones that are changing to it
+        by_color = dict()
+        for zone, zone_color in pending.items():
+            if zone < len(members):     # the strip may have shrunk at a rescan since
+                by_color.setdefault(zone_color, []).append(members[zone])
+        result = True
+        for (hue, saturation, brightness, kelvin), zone_members in by_color.items():
+            if self.run(zone_members, self.backend.set_color, hue, saturation, brightness, kelvin) is not True:
+                result = False
+        return result
@@ -1,13 +1,19 @@
-from .lifxlan import LifxLAN
-from .message import *
-from .msgtypes import *
-from .unpack import unpack_lifx_message
-from .device import *
-from .light import *
-from .multizonelight import *
-from .group import Group
-from .tilechain import TileChain, Tile
-from .utils import *
+import importlib
+
+# The submodules are imported the first time one of their names is used (PEP 562), so that something that
+# only needs the codec, e.g. "from lifxlan import unpack_lifx_message", doesn't pay for the client modules,
+# ifaddr, the products table and threading.  The names are the same as when every submodule was imported
+# here: these few come from the named submodule, and anything else is looked up in _STAR_MODULES in order.
+_NAMES = {
+    "LifxLAN": "lifxlan",
+    "unpack_lifx_message": "unpack",
+    "Group": "group",
+    "TileChain": "tilechain",
+    "Tile": "tilechain",
+}
+_STAR_MODULES = ("message", "msgtypes", "device", "light", "multizonelight", "utils")
+_SUBMODULES = ("device", "errors", "group", "lifxlan", "light", "message", "msgtypes", "multizonelight", "products",
+               "tilechain", "unpack", "utils")
 
 __version__     = '1.2.7'
 __description__ = 'API for local communication with LIFX devices over a LAN.'
@@ -15,3 +21,39 @@ __url__         = 'http://github.com/mclarkk/lifxlan'
 __author__      = 'Meghan Clark'
 __authoremail__ = 'mclarkk@berkeley.edu'
 __license__     = 'MIT'
+
+
+def _submodule(name):
+    return importlib.import_module(f".{name}", __name__)
+
+
+def _public_names():
+    names = set(_NAMES)
+    for name in _STAR_MODULES:
+        names.update(attr for attr in vars(_submodule(name)) if not attr.startswith("_"))
+    return sorted(names)
+
+
+def __getattr__(name):
+    if name == "__all__":
+        value = _public_names()     # "from lifxlan import *" still gets everything, so it loads everything
+    elif name in _SUBMODULES:
+        return _submodule(name)
+    elif name in _NAMES:
+        value = getattr(_submodule(_NAMES[name]), name)
+    else:
+        missing = object()
+        value = missing
+        if not name.startswith("_"):
+            for module_name in _STAR_MODULES:
+                value = getattr(_submodule(module_name), name, missing)
+                if value is not missing:
+                    break
+        if value is missing:
+            raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_NAMES) | set(_SUBMODULES))
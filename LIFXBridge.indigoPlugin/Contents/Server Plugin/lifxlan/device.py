@@ -21,7 +21,6 @@
 from datetime import datetime
 from socket import AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_BROADCAST, SO_REUSEADDR, socket, timeout, gethostbyname_ex, gethostname
 from time import sleep, time
-import ifaddr
 import platform
 import struct
 
@@ -39,6 +38,8 @@ DEFAULT_ATTEMPTS = 1
 VERBOSE = False
 
 def get_broadcast_addrs():
+    import ifaddr   # walks every interface through ctypes, so only loaded when a client first broadcasts
+
     broadcast_addrs = []
     for iface in ifaddr.get_adapters():
         for addr in iface.ips:
@@ -68,7 +69,19 @@ def get_broadcast_addrs():
 
     return broadcast_addrs
 
-UDP_BROADCAST_IP_ADDRS = get_broadcast_addrs()
+# The broadcast addresses are looked up the first time they're needed rather than at import, so importing
+# lifxlan doesn't enumerate the network interfaces.  Assigning UDP_BROADCAST_IP_ADDRS still overrides them.
+def broadcast_addrs():
+    addrs = globals().get("UDP_BROADCAST_IP_ADDRS")
+    if addrs is None:
+        addrs = globals()["UDP_BROADCAST_IP_ADDRS"] = get_broadcast_addrs()
+    return addrs
+
+def __getattr__(name):
+    if name == "UDP_BROADCAST_IP_ADDRS":
+        return broadcast_addrs()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 UDP_BROADCAST_PORT = 56700
 
 class Device(object):
@@ -488,7 +501,7 @@ class Device(object):
             if self.ip_addr:
                 sock.sendto(msg.packed_message, (self.ip_addr, self.port))
             else:
-                for ip_addr in UDP_BROADCAST_IP_ADDRS:
+                for ip_addr in broadcast_addrs():
                     sock.sendto(msg.packed_message, (ip_addr, self.port))
             if self.verbose:
                 print("SEND: " + str(msg))
@@ -524,7 +537,7 @@ class Device(object):
                     if self.ip_addr:
                         sock.sendto(msg.packed_message, (self.ip_addr, self.port))
                     else:
-                        for ip_addr in UDP_BROADCAST_IP_ADDRS:
+                        for ip_addr in broadcast_addrs():
                             sock.sendto(msg.packed_message, (ip_addr, self.port))
                     sent = True
                     if self.verbose:
@@ -7,7 +7,7 @@ from socket import AF_INET, SOCK_DGRAM, SOL_SOCKET, SO_BROADCAST, SO_REUSEADDR,
 from time import sleep, time
 import random
 
-from .device import DEFAULT_ATTEMPTS, DEFAULT_TIMEOUT, Device, UDP_BROADCAST_IP_ADDRS, UDP_BROADCAST_PORT
+from .device import DEFAULT_ATTEMPTS, DEFAULT_TIMEOUT, Device, UDP_BROADCAST_PORT, broadcast_addrs
 from .errors import InvalidParameterException, WorkflowException
 from .light import Light
 from .message import BROADCAST_MAC
@@ -218,7 +218,7 @@ class LifxLAN:
         sent_msg_count = 0
         sleep_interval = 0.05 if num_repeats > 20 else 0
         while(sent_msg_count < num_repeats):
-            for ip_addr in UDP_BROADCAST_IP_ADDRS:
+            for ip_addr in broadcast_addrs():
                 self.sock.sendto(msg.packed_message, (ip_addr, UDP_BROADCAST_PORT))
             if self.verbose:
                 print("SEND: " + str(msg))
@@ -242,7 +242,7 @@ class LifxLAN:
             timedout = False
             while (self.num_devices == None or num_devices_seen < self.num_devices) and not timedout:
                 if not sent:
-                    for ip_addr in UDP_BROADCAST_IP_ADDRS:
+                    for ip_addr in broadcast_addrs():
                         self.sock.sendto(msg.packed_message, (ip_addr, UDP_BROADCAST_PORT))
                     sent = True
                     if self.verbose:
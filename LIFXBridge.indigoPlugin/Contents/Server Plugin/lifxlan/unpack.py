@@ -177,6 +177,16 @@ def unpack_lifx_message(packed_message):
         payload = {"color": color, "duration": duration}
         message = LightSetColor(target_addr, source_id, seq_num, payload, ack_requested, response_requested)
 
+    elif message_type == MSG_IDS[LightSetWaveform]:  # 103
+        transient = struct.unpack("<B", payload_str[1:2])[0]
+        color = struct.unpack("<" + ("H"*4), payload_str[2:10])
+        period = struct.unpack("<I", payload_str[10:14])[0]
+        cycles = struct.unpack("<f", payload_str[14:18])[0]
+        duty_cycle = struct.unpack("<h", payload_str[18:20])[0]
+        waveform = struct.unpack("<B", payload_str[20:21])[0]
+        payload = {"transient": transient, "color": color, "period": period, "cycles": cycles, "duty_cycle": duty_cycle, "waveform": waveform}
+        message = LightSetWaveform(target_addr, source_id, seq_num, payload, ack_requested, response_requested)
+
     elif message_type == MSG_IDS[LightState]:
         color = struct.unpack("<" + ("H"*4), payload_str[0:8])
         reserved1 = struct.unpack("<H", payload_str[8:10])[0]
@@ -3,31 +3,26 @@
 ####################
 
 import socket
-import time
-from random import randint
-import json
 import logging
-import colorsys
 import os
 import base64
-import re
-
-from lifxlan.msgtypes import *
-from lifxlan.unpack import unpack_lifx_message
-from lifxlan.message import Message, BROADCAST_MAC, HEADER_SIZE_BYTES, little_endian
-
-PUBLISHED_KEY = "published"
-ALT_NAME_KEY = "alternate-name"
-MAC_KEY = "fakeMAC"
-TARGET_KEY = "target"
-LOCATION_KEY = "location"
+import json
+import time
 
-DEFAULT_LIFX_PORT = 56700
+from lifxbridge.backend import fakeMAC
+from lifxbridge.capture import DEFAULT_CAPTURE_SIZE
+from lifxbridge.engine import BridgeEngine, DEFAULT_LIFX_PORT
+from lifxbridge.indigo_backend import IndigoBackend, PUBLISHED_KEY, ALT_NAME_KEY, MAC_KEY, LOCATION_KEY
+from lifxbridge.metrics import MetricsServer
+from lifxbridge.profiling import MODE_CPROFILE
+from lifxbridge.ratelimit import budgets_for, DISCOVERY, QUERY, SET
+from lifxbridge.zones import ZoneStrip, ZoneStripBackend, next_strip_id
 
-def fakeMAC(deviceID):
-    hexString = format(deviceID, '08x')
-    macString = ':'.join(re.findall('..', hexString))
-    return f"00:16:{macString}"
+METRICS_FOLDER = "LIFX Bridge"
+METRICS_VARIABLE_PREFIX = "lifxBridge_"
+WARM_START_FILE = "warmstart.lxws"     # in the plugin's Preferences folder
+ZONE_STRIPS_KEY = "zoneStrips"         # plugin pref holding the zone strip definitions as JSON
+WORKER_PYTHON = "/Library/Frameworks/Python.framework/Versions/Current/bin/python3"   # the Python 3 Indigo runs plugins with
 
 
 ################################################################################
@@ -42,49 +37,83 @@ class Plugin(indigo.PluginBase):
         self.indigo_log_handler.setLevel(self.logLevel)
         self.logger.debug(f"logLevel = {self.logLevel}")
 
-        self.seen_msg_list = [-1, -1, -1, -1, -1, -1]
-        self.publishedDevices = dict()
-
-        try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        except socket.error as msg:
-            self.logger.error(f"Failed to create socket. Error Code : {msg[0]}, Message: {msg[1]}")
+        # the protocol engine does all the LIFX work, the backend connects it to the Indigo devices (and
+        # publishes the zone strips made of them)
+        captureSize = int(pluginPrefs.get("captureSize", DEFAULT_CAPTURE_SIZE))
+        self.zoneStrips = ZoneStripBackend(IndigoBackend())
+        self.engine = BridgeEngine(self.zoneStrips, DEFAULT_LIFX_PORT, capture_size=captureSize)
+        self.registry = self.engine.registry
+        self.configureTracing(pluginPrefs)
+        self.configurePacketLog(pluginPrefs)
+        self.configureTransitions(pluginPrefs)
+        self.configureRateLimit(pluginPrefs)
+        self.engine.allocations.enable(bool(pluginPrefs.get("trackAllocations", False)))
+
+        self.metricsServer = None
+        self.metricsVariables = bool(pluginPrefs.get("metricsVariables", False))
+        self.metricsInterval = float(pluginPrefs.get("metricsInterval", 60))
+        self.nextMetricsUpdate = 0.0
+        self.lastPacketsIn = None
+
+        # in worker mode the engine here isn't opened, the worker processes answer the clients
+        self.workerCount = int(pluginPrefs.get("workerProcesses", 0))
+        self.workers = None
+        if self.workerCount:
+            if self.loadZoneStrips():
+                self.logger.warning("Zone strips aren't published while worker processes are turned on")
             return
+        self.openEngine()
 
+    ########################################
+    # Answer the clients from the engine here, with the zone strips published
+    ########################################
+    def openEngine(self):
+        self.zoneStrips.set_strips(self.loadZoneStrips())
         try:
-            self.sock.bind(('', DEFAULT_LIFX_PORT))
-            self.sock.settimeout(2)
-        except socket.error as msg:
-            self.logger.error(f"LIFX port bind failed. Error Code : {msg[0]}, Message: {msg[1]}")
-            return
+            self.engine.open()
+        except socket.error as err:
+            self.logger.error(f"LIFX port bind failed: {err}")
 
     def startup(self):
         self.logger.info("Starting LIFX Bridge")
-        self.refreshDeviceList()
+
+        # answer from the devices saved last time straight away, and rescan Indigo in the background
+        warmStartPath = os.path.join(indigo.server.getInstallFolderPath(), "Preferences", "Plugins", self.pluginId, WARM_START_FILE)
+        os.makedirs(os.path.dirname(warmStartPath), exist_ok=True)
+        count = self.engine.warm_start(warmStartPath)
+        if count:
+            self.logger.info(f"Publishing {count} devices from the warm-start snapshot, rescanning the device list")
+            self.engine.schedule_refresh()
+        else:
+            self.refreshDeviceList()
         indigo.devices.subscribeToChanges()
+        if self.workerCount:
+            self.startWorkers()
+        self.startMetricsServer(int(self.pluginPrefs.get("metricsPort", 0)))
 
     def shutdown(self):
         self.logger.info("Shutting down LIFX Bridge")
-        self.sock.close()
+        self.startMetricsServer(0)
+        self.engine.save_warm_start()
+        if self.workers:
+            self.workers.stop()
+        self.engine.close()
 
     def runConcurrentThread(self):
         try:
             while True:
-                if len(self.publishedDevices) > 0:  # no need to respond if there aren't any devices to emulate
-                    try:
-                        data, (ip_addr, port) = self.sock.recvfrom(2048)
-                    except socket.timeout:
-                        pass
-                    except socket.error as msg:
-                        self.logger.error(f"Socket recvfrom failed. Error Code : {msg[0]}, Message {msg[1]}")
+                if self.workerCount:
+                    self.sleep(1.0)  # the worker processes are doing the work
+                elif len(self.registry.snapshot) > 0:  # no need to respond if there aren't any devices to emulate
+                    self.engine.serve_once()
+                    if self.engine.inbound.pending() or self.engine.egress.pending() or self.engine.limiter.pending():
+                        self.sleep(self.engine.egress.tick)  # get on with the queued requests, replies and held commands
                     else:
-                        message = unpack_lifx_message(data)
-                        self.lifxRespond(message, ip_addr, port)
-                    self.sleep(0.1)  # short sleep while looking for inbound requests
+                        self.sleep(0.1)  # short sleep while looking for inbound requests
                 else:
                     self.sleep(1.0)  # longer sleep when not looking for LIFX requests
+                if self.metricsVariables and time.time() >= self.nextMetricsUpdate:
+                    self.updateMetricsVariables()
         except self.StopThread:
             pass
 
@@ -96,45 +125,115 @@ class Plugin(indigo.PluginBase):
             self.logLevel = int(valuesDict.get("logLevel", logging.INFO))
             self.indigo_log_handler.setLevel(self.logLevel)
             self.logger.debug(f"logLevel = {self.logLevel}")
+            self.engine.capture.resize(int(valuesDict.get("captureSize", DEFAULT_CAPTURE_SIZE)))
+            self.metricsVariables = bool(valuesDict.get("metricsVariables", False))
+            self.metricsInterval = float(valuesDict.get("metricsInterval", 60))
+            self.nextMetricsUpdate = 0.0
+            self.startMetricsServer(int(valuesDict.get("metricsPort", 0)))
+            self.configureTracing(valuesDict)
+            self.configurePacketLog(valuesDict)
+            self.configureTransitions(valuesDict)
+            self.configureRateLimit(valuesDict)
+            self.engine.allocations.enable(bool(valuesDict.get("trackAllocations", False)))
+
+    def validatePrefsConfigUi(self, valuesDict):
+        errorDict = indigo.Dict()
+        try:
+            if int(valuesDict.get("captureSize", DEFAULT_CAPTURE_SIZE)) < 0:
+                raise ValueError
+        except ValueError:
+            errorDict["captureSize"] = "Must be a whole number, 0 to turn the capture off"
+        try:
+            if float(valuesDict.get("metricsInterval", 60)) < 1:
+                raise ValueError
+        except ValueError:
+            errorDict["metricsInterval"] = "Must be at least 1 second"
+        try:
+            if float(valuesDict.get("slowRequestThreshold", 250)) <= 0:
+                raise ValueError
+        except ValueError:
+            errorDict["slowRequestThreshold"] = "Must be a number of milliseconds"
+        try:
+            if int(valuesDict.get("packetLogSample", 1)) < 1:
+                raise ValueError
+        except ValueError:
+            errorDict["packetLogSample"] = "Must be a whole number, 1 to log every packet"
+        try:
+            if float(valuesDict.get("packetLogSummary", 60)) < 1:
+                raise ValueError
+        except ValueError:
+            errorDict["packetLogSummary"] = "Must be at least 1 second"
+        try:
+            if float(valuesDict.get("transitionStepInterval", 250)) < 20:
+                raise ValueError
+        except ValueError:
+            errorDict["transitionStepInterval"] = "Must be at least 20 milliseconds"
+        try:
+            if int(valuesDict.get("transitionMaxSteps", 20)) < 0:
+                raise ValueError
+        except ValueError:
+            errorDict["transitionMaxSteps"] = "Must be a whole number, 0 for no limit"
+        for key, default in (("rateLimitDiscovery", 1), ("rateLimitQueries", 100), ("rateLimitSets", 20)):
+            try:
+                if float(valuesDict.get(key, default)) <= 0:
+                    raise ValueError
+            except ValueError:
+                errorDict[key] = "Must be a number of requests per second"
+        try:
+            if float(valuesDict.get("rateLimitBlock", 60)) < 0:
+                raise ValueError
+        except ValueError:
+            errorDict["rateLimitBlock"] = "Must be a number of seconds, 0 to never block"
+        try:
+            if not 0 <= int(valuesDict.get("workerProcesses", 0)) <= os.cpu_count():
+                raise ValueError
+        except ValueError:
+            errorDict["workerProcesses"] = f"Must be a whole number from 0 to {os.cpu_count()}"
+        try:
+            if not 0 <= int(valuesDict.get("metricsPort", 0)) <= 65535:
+                raise ValueError
+        except ValueError:
+            errorDict["metricsPort"] = "Must be a port number, 0 to turn the endpoint off"
+        if len(errorDict) > 0:
+            return False, valuesDict, errorDict
+        return True, valuesDict
 
     ########################################
     # The next two methods should catch when a device name changes in Indigo and when a device we have published
-    # gets deleted - we'll just rebuild the device list cache in those situations.
+    # gets deleted - only that device's registry entry is updated, there's no need to rescan the whole device list.
     ########################################
     def deviceDeleted(self, dev):
-        if dev.id in self.publishedDevices:
+        if self.registry.remove(dev.id):
             self.logger.info(f"A device ({dev.name}) that was published has been deleted.")
-            self.refreshDeviceList()
 
     def deviceUpdated(self, origDev, newDev):
-        if origDev.id in self.publishedDevices:
+        if self.workers:
+            self.workers.update_device(newDev.id)
+        if origDev.folderId != newDev.folderId:
+            stripFolders = {strip.folder for strip in self.zoneStrips.strips.values()}
+            if origDev.folderId in stripFolders or newDev.folderId in stripFolders:
+                self.engine.schedule_refresh()     # a zone strip gained or lost a zone
+        if origDev.id in self.registry.snapshot:
             # Drill down on the change a bit - if the name changed and there's no alternate name OR the alternate
-            # name changed then refresh the device list
-            if ALT_NAME_KEY in origDev.pluginProps or ALT_NAME_KEY in newDev.pluginProps:
-                if origDev.pluginProps.get(ALT_NAME_KEY, None) != newDev.pluginProps.get(ALT_NAME_KEY, None):
-                    self.refreshDeviceList()
+            # name changed then update the device's entry
+            origProps = origDev.pluginProps
+            newProps = newDev.pluginProps
+            if PUBLISHED_KEY not in newProps:
+                self.registry.remove(newDev.id)
+                self.logger.debug("Your published device list changed.")
+            elif ALT_NAME_KEY in origProps or ALT_NAME_KEY in newProps:
+                if origProps.get(ALT_NAME_KEY, None) != newProps.get(ALT_NAME_KEY, None):
+                    self.registry.update(IndigoBackend.published_device(newDev, newProps))
                     self.logger.debug("A device alternative name changed.")
             elif origDev.name != newDev.name:
-                self.refreshDeviceList()
+                self.registry.update(IndigoBackend.published_device(newDev, newProps))
                 self.logger.debug("A device name changed.")
-            elif origDev.pluginProps.get(PUBLISHED_KEY, "False") != newDev.pluginProps.get(PUBLISHED_KEY, "False"):
-                self.refreshDeviceList()
-                self.logger.debug("Your published device list changed.")
 
     ########################################
     # This method is called to refresh the list of published devices.
     ########################################
     def refreshDeviceList(self):
-        self.logger.debug("refreshDeviceList called")
-        for dev in indigo.devices:
-            props = dev.pluginProps
-            if PUBLISHED_KEY in props:
-                self.publishedDevices[dev.id] = props.get(ALT_NAME_KEY, "")
-                self.logger.debug(f"found published device: {dev.id:d} - {dev.name} ({self.publishedDevices[dev.id]}) - {props[MAC_KEY]}")
-                if not props.get(LOCATION_KEY, None):
-                    props[LOCATION_KEY] = base64.b64encode(bytearray(os.urandom(16)))
-                    dev.replacePluginPropsOnServer(props)
-        self.logger.debug(f"{len(self.publishedDevices):d} devices published")
+        self.engine.refresh()
 
     ########################################
     # This method is called to generate a list of devices that support onState only.
@@ -182,9 +281,6 @@ class Plugin(indigo.PluginBase):
         # field in the dialog that holds a comma-delimited list of device
         # ids, one for each of the devices in the scene.
         self.logger.debug(f"adding device: {deviceId}")
-        # Get the list of devices that are already in the scene
-        # Add or update the name to the plugin's cached list
-        self.publishedDevices[deviceId] = valuesDict["altName"]
         # Next, we need to add the properties to the device for permanent storage
         # Get the device instance
         dev = indigo.devices[deviceId]
@@ -210,6 +306,8 @@ class Plugin(indigo.PluginBase):
 
         # Replace the props on the server's copy of the device instance.
         dev.replacePluginPropsOnServer(props)
+        # Add or update the device in the plugin's registry
+        self.registry.update(IndigoBackend.published_device(dev, props))
         self.logger.threaddebug(f"valuesDict = {valuesDict}")
         # Clear out the name field and the source device field
         valuesDict["sourceDeviceMenu"] = ""
@@ -223,9 +321,9 @@ class Plugin(indigo.PluginBase):
     ########################################
     def deleteDevices(self, valuesDict, typeId=None, devId=None):
         self.logger.debug("deleteDevices called")
-        # Delete the device's properties for this plugin and delete the entry in self.publishedDevices
+        # Delete the device's properties for this plugin and delete the entry in the registry
         for devId in valuesDict['memberDeviceList']:
-            del self.publishedDevices[int(devId)]
+            self.registry.remove(int(devId))
             dev = indigo.devices[int(devId)]
             # Setting a device's plugin props to None will completely delete the props for this plugin in the devices' globalProps.
             dev.replacePluginPropsOnServer(None)
@@ -238,12 +336,14 @@ class Plugin(indigo.PluginBase):
     def memberDevices(self, filter="", valuesDict=None, typeId="", targetId=0):
         self.logger.debug(f"memberDevices called with filter: {filter}  typeId: {typeId}  targetId: {targetId}")
         returnList = list()
-        for did, name in self.publishedDevices.items():
-            deviceName = indigo.devices[did].name
-            if len(name) > 0:
-                deviceName += " (%s)" % name
-            returnList.append((did, deviceName))
-            returnList = sorted(returnList, key=lambda item: item[1])
+        for device in self.registry.snapshot:
+            if device.id in self.zoneStrips.strips:
+                continue
+            deviceName = indigo.devices[device.id].name
+            if len(device.alias) > 0:
+                deviceName += " (%s)" % device.alias
+            returnList.append((device.id, deviceName))
+        returnList = sorted(returnList, key=lambda item: item[1])
         return returnList
 
     ########################################
@@ -251,706 +351,224 @@ class Plugin(indigo.PluginBase):
     ########################################
     def listDevices(self):
         self.logger.info(f"{'Indigo DevID':<16}  {'LIFX Address':<20} {'Indigo Name (alias)':<30}")
-        for did, name in self.publishedDevices.items():
-            fMAC = indigo.devices[did].pluginProps[MAC_KEY]
-            deviceName = indigo.devices[did].name
-            if len(name) > 0:
-                deviceName = f"{deviceName} ({name})"
-            self.logger.info(f"{did:<16}  {fMAC:20} {deviceName:30}")
+        for device in self.registry.snapshot:
+            if device.id in self.zoneStrips.strips:
+                deviceName = f"{device.name} (zone strip, {len(self.zoneStrips.zone_members(device.id))} zones)"
+            else:
+                deviceName = indigo.devices[device.id].name
+            if len(device.alias) > 0:
+                deviceName = f"{deviceName} ({device.alias})"
+            self.logger.info(f"{device.id:<16}  {device.mac:20} {deviceName:30}")
 
     ########################################
-    #   Methods that deal with LIFX protocol messages
+    # Zone strips: groups of devices published as one LIFX Z, one zone per device.  The definitions are kept
+    # in the plugin prefs as JSON.
     ########################################
+    def loadZoneStrips(self):
+        try:
+            return [ZoneStrip(entry["id"], entry["name"], entry.get("folder", 0), entry.get("devices", []),
+                              bytearray(base64.b64decode(entry["location"]))) for entry in json.loads(self.pluginPrefs.get(ZONE_STRIPS_KEY, "[]"))]
+        except (ValueError, KeyError, TypeError) as err:
+            self.logger.error(f"Unable to read the zone strip definitions: {err}")
+            return []
+
+    def saveZoneStrips(self, strips):
+        self.pluginPrefs[ZONE_STRIPS_KEY] = json.dumps([{"id": strip.id, "name": strip.name, "folder": strip.folder, "devices": strip.devices,
+                                                          "location": base64.b64encode(strip.location).decode("ascii")} for strip in strips])
+        if not self.workerCount:
+            self.zoneStrips.set_strips(strips)
+            self.engine.schedule_refresh()
 
-    def lifxRespond(self, message, ip_addr, port):
-
-        source = message.source_id
-        seq_num = message.seq_num
-
-        if seq_num in self.seen_msg_list:
-
-            self.logger.threaddebug(f"lifxRespond, skipping repeat seq_num = {seq_num:d}, type = {message.message_type:d}, target = {message.target_addr}")
-            return
+    @staticmethod
+    def deviceFolders(filter="", valuesDict=None, typeId="", targetId=0):
+        return [(0, "- None, use the devices below -")] + [(folder.id, folder.name) for folder in indigo.devices.folders]
 
-        elif seq_num == 0:
-            pass
+    def zoneStripList(self, filter="", valuesDict=None, typeId="", targetId=0):
+        returnList = list()
+        for strip in self.loadZoneStrips():
+            if strip.folder:
+                source = f"folder {indigo.devices.folders[strip.folder].name}" if strip.folder in indigo.devices.folders else "missing folder"
+            else:
+                source = f"{len(strip.devices)} devices"
+            returnList.append((strip.id, f"{strip.name} ({source})"))
+        return sorted(returnList, key=lambda item: item[1])
+
+    ########################################
+    # Add/Update Zone Strip button.  A strip with the same name is updated, keeping its LIFX address.
+    ########################################
+    def addZoneStrip(self, valuesDict, typeId=None, devId=None):
+        name = valuesDict.get("stripName", "").strip()
+        folderId = int(valuesDict.get("stripFolder", 0) or 0)
+        deviceIds = [int(deviceId) for deviceId in valuesDict.get("stripDevices", [])]
+        if not name or not (folderId or deviceIds):
+            self.logger.error("A zone strip needs a name, and a folder or some devices")
+            return valuesDict
+
+        strips = self.loadZoneStrips()
+        existing = [strip for strip in strips if strip.name == name]
+        if existing:
+            strips.remove(existing[0])
+            strip = existing[0]._replace(folder=folderId, devices=deviceIds)
         else:
-            self.seen_msg_list.pop(0)
-            self.seen_msg_list.append(seq_num)
-
-        self.logger.threaddebug(f"lifxRespond: message = \n{message}")
-
-        if message.message_type == MSG_IDS[GetService]:  # 2
-
-            payload = {"service": "1", "port": "56700"}
-
-            for devID, alias in self.publishedDevices.items():
-                self.logger.debug(f"GetService message, replying for: {indigo.devices[devID].name}")
-                target_addr = indigo.devices[devID].pluginProps[MAC_KEY]
-                replyMessage = StateService(target_addr, source, seq_num, payload, False, False)
-                self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-                if message.ack_requested:
-                    self.logger.debug("GetService message, sending Ack ")
-                    replyMessage = Acknowledgement(target_addr, source, seq_num, None, False, False)
-                    self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-            # repeat with service 5?  The bulbs do.
-
-        elif message.message_type == MSG_IDS[StateService]:  # 3
-
-            for devID, alias in self.publishedDevices.items():
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-                    self.logger.debug(f"StateService message for device {devID} - not supported!")
-
-                    if message.ack_requested:
-                        self.logger.debug("Oops!  Client wants an ACK")
-                    if message.response_requested:
-                        self.logger.debug("Oops!  Client wants a response")
-
-        elif message.message_type == MSG_IDS[GetHostInfo]:  # 12
-
-            for devID, alias in self.publishedDevices.items():
-
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-
-                    self.logger.debug(f"GetHostInfo message, replying for: {indigo.devices[devID].name}")
-
-                    payload = {"signal": "0", "tx": "0", "rx": "0", "reserved1": "0"}
-                    replyMessage = StateHostInfo(message.target_addr, source, seq_num, payload, False, False)
-                    self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-                    if message.ack_requested:
-                        replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-        elif message.message_type == MSG_IDS[StateHostInfo]:  # 13
-
-            for devID, alias in self.publishedDevices.items():
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-
-                    self.logger.debug(f"StateHostInfo message for device {devID} - not supported!")
-
-                    if message.ack_requested:
-                        self.logger.debug("Oops!  Client wants an ACK")
-                    if message.response_requested:
-                        self.logger.debug("Oops!  Client wants a response")
-
-        elif message.message_type == MSG_IDS[GetHostFirmware]:  # 14
-
-            for devID, alias in self.publishedDevices.items():
-
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-
-                    self.logger.debug(f"GetHostFirmware message, replying for: {indigo.devices[devID].name}")
-
-                    payload = {"build": "1428977151000000000", "reserved1": "1428977151000000000", "version": "65538"}
-                    replyMessage = StateHostFirmware(message.target_addr, source, seq_num, payload, False, False)
-                    self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-                    if message.ack_requested:
-                        replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-        elif message.message_type == MSG_IDS[StateHostFirmware]:  # 15
-
-            for devID, alias in self.publishedDevices.items():
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-                    self.logger.debug(f"StateHostFirmware message for device {devID} - not supported!")
-
-                    if message.ack_requested:
-                        self.logger.debug("Oops!  Client wants an ACK")
-                    if message.response_requested:
-                        self.logger.debug("Oops!  Client wants a response")
-
-        elif message.message_type == MSG_IDS[GetWifiInfo]:  # 16
-
-            for devID, alias in self.publishedDevices.items():
-
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:  # reply with info for requested device
-
-                    self.logger.debug(f"GetWifiInfo message, replying for: {indigo.devices[devID].name}")
-
-                    payload = {"signal": "944912011", "tx": "3397400", "rx": "23670", "reserved1": "3010"}
-                    replyMessage = StateWifiInfo(message.target_addr, source, seq_num, payload, False, False)
-                    self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-                    if message.ack_requested:
-                        replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-        elif message.message_type == MSG_IDS[StateWifiInfo]:  # 17
-
-            for devID, alias in self.publishedDevices.items():
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-                    self.logger.debug(f"StateWifiInfo message for device {devID} - not supported!")
-
-                    if message.ack_requested:
-                        self.logger.debug("Oops!  Client wants an ACK")
-                    if message.response_requested:
-                        self.logger.debug("Oops!  Client wants a response")
-
-        elif message.message_type == MSG_IDS[GetWifiFirmware]:  # 18
-
-            for devID, alias in self.publishedDevices.items():
-
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:  # reply with info for requested device
-
-                    self.logger.debug(f"GetWifiFirmware message, replying for: {indigo.devices[devID].name}")
-
-                    payload = {"build": "0", "reserved1": "0", "version": "6619161"}
-                    replyMessage = StateWifiFirmware(message.target_addr, source, seq_num, payload, False, False)
-                    self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-                    if message.ack_requested:
-                        replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-        elif message.message_type == MSG_IDS[StateWifiFirmware]:  # 19
-
-            for devID, alias in self.publishedDevices.items():
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-                    self.logger.debug(f"StateWifiFirmware message for device {devID} - not supported!")
-
-                    if message.ack_requested:
-                        self.logger.debug("Oops!  Client wants an ACK")
-                    if message.response_requested:
-                        self.logger.debug("Oops!  Client wants a response")
-
-        elif message.message_type == MSG_IDS[GetPower]:  # 20
-
-            for devID, alias in self.publishedDevices.items():
-
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:  # reply with info for requested device
-
-                    self.logger.debug(f"GetPower message, replying for: {indigo.devices[devID].name}")
-
-                    payload = {"power_level": self.getDevicePower(devID)}
-                    replyMessage = StatePower(message.target_addr, source, seq_num, payload, False, False)
-                    self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-                    if message.ack_requested:
-                        replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-        elif message.message_type == MSG_IDS[SetPower]:  # 21
-
-            for devID, alias in self.publishedDevices.items():
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-
-                    self.logger.debug(f"SetPower message for: {indigo.devices[devID].name}")
-
-                    for field in message.payload_fields:
-                        if field[0] == "Power":
-                            self.turnOnOffDevice(devID, field[1])
-                            break
-
-            if message.ack_requested:
-                replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
-                self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-            if message.response_requested:
-                payload = {"power_level": self.getDevicePower(devID)}  # noqa
-                replyMessage = StatePower(message.target_addr, source, seq_num, payload, False, False)
-                self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-        elif message.message_type == MSG_IDS[StatePower]:  # 22
-
-            for devID, alias in self.publishedDevices.items():
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-                    self.logger.debug(f"StatePower message for device {devID} - not supported!")
-                    if message.ack_requested:
-                        self.logger.debug("Oops!  Client wants an ACK")
-                    if message.response_requested:
-                        self.logger.debug("Oops!  Client wants a response")
-
-        elif message.message_type == MSG_IDS[GetLabel]:  # 23
-
-            for devID, alias in self.publishedDevices.items():
-
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY] or message.tagged:
-
-                    self.logger.debug(f"GetLabel message, replying for: {indigo.devices[devID].name}")
-
-                    try:
-                        label = indigo.devices[devID].pluginProps[ALT_NAME_KEY]
-                    except (Exception,):
-                        label = indigo.devices[devID].name
-
-                    payload = {"label": label}
-                    replyMessage = StateLabel(message.target_addr, source, seq_num, payload, False, False)
-                    self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-                    if message.ack_requested:
-                        replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-        elif message.message_type == MSG_IDS[SetLabel]:  # 24
-            self.logger.debug("SetLabel message - not supported!")
-
-            if message.ack_requested:
-                for devID, alias in self.publishedDevices.items():
-
-                    if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:  # reply with info for requested device
-
-                        replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-            if message.response_requested:
-                self.logger.debug("Oops!  Client wants a response to SetLabel")
-
-        elif message.message_type == MSG_IDS[StateLabel]:  # 25
-
-            for devID, alias in self.publishedDevices.items():
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-
-                    self.logger.debug(f"StateLabel message for device {devID} - not supported!")
-
-                    if message.ack_requested:
-                        self.logger.debug("Oops!  Client wants an ACK to StateLabel")
-                    if message.response_requested:
-                        self.logger.debug("Oops!  Client wants a response to StateLabel")
-
-        elif message.message_type == MSG_IDS[GetVersion]:  # 32
-
-            for devID, alias in self.publishedDevices.items():
-
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:  # reply with info for requested device
-
-                    self.logger.debug(f"GetVersion message, replying for: {indigo.devices[devID].name}")
-
-                    if isinstance(indigo.devices[devID], indigo.DimmerDevice):
-
-                        if indigo.devices[devID].supportsRGB:
-                            product = "22"  # Color 1000
-                        else:
-                            product = "10"  # White 800 (Low Voltage)
-
-                    else:
-                        product = "10"  # White 800 (Low Voltage)
-
-                    payload = {"vendor": "1", "product": product, "version": "0"}
-                    replyMessage = StateVersion(message.target_addr, source, seq_num, payload, False, False)
-                    self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-                    if message.ack_requested:
-                        replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-        elif message.message_type == MSG_IDS[StateVersion]:  # 33
-
-            for devID, alias in self.publishedDevices.items():
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-                    self.logger.debug(f"StateVersion message for device {devID} - not supported!")
-
-                    if message.ack_requested:
-                        self.logger.debug("Oops!  Client wants an ACK")
-                    if message.response_requested:
-                        self.logger.debug("Oops!  Client wants a response")
-
-        elif message.message_type == MSG_IDS[GetInfo]:  # 34
-
-            time_s = str(int(time.time() * 1000000000))
-
-            for devID, alias in self.publishedDevices.items():
-
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:  # reply with info for requested device
-
-                    self.logger.debug(f"GetInfo message, replying for: {indigo.devices[devID].name}")
-
-                    payload = {"time": time_s, "uptime": "1243200000000", "downtime": "0"}
-                    replyMessage = StateInfo(message.target_addr, source, seq_num, payload, False, False)
-                    self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-                    if message.ack_requested:
-                        replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-        elif message.message_type == MSG_IDS[StateInfo]:  # 35
-
-            for devID, alias in self.publishedDevices.items():
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-                    self.logger.debug(f"StateInfo message for device {devID} - not supported!")
-
-                    if message.ack_requested:
-                        self.logger.debug("Oops!  Client wants an ACK")
-                    if message.response_requested:
-                        self.logger.debug("Oops!  Client wants a response")
-
-        elif message.message_type == MSG_IDS[Acknowledgement]:  # 45
-            self.logger.debug("Got an ACK message.  Don't know why.")
-            if message.ack_requested:
-                self.logger.debug("Oops!  Client wants an ACK")
-            if message.response_requested:
-                self.logger.debug("Oops!  Client wants a response")
-
-        elif message.message_type == MSG_IDS[GetLocation]:  # 48
-
-            time_s = str(int(time.time() * 1000000000))
-
-            for devID, alias in self.publishedDevices.items():
-
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:  # reply with info for requested device
-
-                    try:
-                        label = indigo.devices[devID].pluginProps[ALT_NAME_KEY]
-                    except (Exception,):
-                        label = indigo.devices[devID].name
-
-                    location = bytearray(base64.b64decode(indigo.devices[devID].pluginProps[LOCATION_KEY]))
-
-                    self.logger.debug(f"GetLocation message, replying for: {indigo.devices[devID].name}")
-
-                    payload = {"location": location, "label": label, "updated_at": time_s}
-                    replyMessage = StateLocation(message.target_addr, source, seq_num, payload, False, False)
-                    self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-                    if message.ack_requested:
-                        replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-        elif message.message_type == MSG_IDS[StateLocation]:  # 50
-
-            for devID, alias in self.publishedDevices.items():
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-                    self.logger.debug(f"StateLocation message for device {devID} - not supported!")
-
-                    if message.ack_requested:
-                        self.logger.debug("Oops!  Client wants an ACK")
-                    if message.response_requested:
-                        self.logger.debug("Oops!  Client wants a response")
-
-        elif message.message_type == MSG_IDS[GetGroup]:  # 51
-
-            time_s = str(int(time.time() * 1000000000))
-
-            for devID, alias in self.publishedDevices.items():
-
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:  # reply with info for requested device
-
-                    try:
-                        label = indigo.devices[devID].pluginProps[ALT_NAME_KEY]
-                    except (Exception,):
-                        label = indigo.devices[devID].name
-
-                    location = bytearray(base64.b64decode(indigo.devices[devID].pluginProps[LOCATION_KEY]))
-
-                    self.logger.debug(f"GetLocation message, replying for: {indigo.devices[devID].name}")
-
-                    payload = {"group": location, "label": label, "updated_at": time_s}
-                    replyMessage = StateGroup(message.target_addr, source, seq_num, payload, False, False)
-                    self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-                    if message.ack_requested:
-                        replyMessage = Acknowledgement(message.target_addr, source, seq_num, None, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-        elif message.message_type == MSG_IDS[StateGroup]:  # 53
-
-            for devID, alias in self.publishedDevices.items():
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-                    self.logger.debug(f"StateGroup message for device {devID} - not supported!")
-
-                    if message.ack_requested:
-                        self.logger.debug("Oops!  Client wants an ACK")
-                    if message.response_requested:
-                        self.logger.debug("Oops!  Client wants a response")
-
-        elif message.message_type == MSG_IDS[EchoRequest]:  # 58
-
-            payload = message.payload_fields
-            for devID, alias in self.publishedDevices.items():
-
-                self.logger.debug(f"EchoRequest message, replying for: {indigo.devices[devID].name}")
-
-                target_addr = indigo.devices[devID].pluginProps[MAC_KEY]
-                replyMessage = EchoReply(target_addr, source, seq_num, payload, False, False)
-                self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-                if message.ack_requested:
-                    replyMessage = Acknowledgement(target_addr, source, seq_num, None, False, False)
-                    self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-        elif message.message_type == MSG_IDS[EchoResponse]:  # 59
-            self.logger.debug("Got an EchoResponse message.  Don't know why.")
-            if message.ack_requested:
-                self.logger.debug("Oops!  Client wants an ACK")
-            if message.response_requested:
-                self.logger.debug("Oops!  Client wants a response")
-
-        elif message.message_type == MSG_IDS[LightGet]:  # 101
-
-            for devID, alias in self.publishedDevices.items():
-
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY] or message.tagged:
-
-                    try:
-                        label = indigo.devices[devID].pluginProps[ALT_NAME_KEY]
-                    except (Exception,):
-                        label = indigo.devices[devID].name
-
-                    colors = self.getDeviceColor(devID)
-                    power_level = self.getDevicePower(devID)
-                    self.logger.debug(f"LightGet for {indigo.devices[devID].name}, power_level = {power_level}, colors = {colors}")
-
-                    payload = {"color": colors, "power_level": power_level, "label": label, "reserved1": "0", "reserved2": "0"}
-                    target_addr = indigo.devices[devID].pluginProps[MAC_KEY]
-                    replyMessage = LightState(target_addr, source, seq_num, payload, False, False)
-                    self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-                    if message.ack_requested:
-                        replyMessage = Acknowledgement(target_addr, source, seq_num, None, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-        elif message.message_type == MSG_IDS[LightSetColor]:  # 102
-
-            for devID, alias in self.publishedDevices.items():
-
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-
-                    self.logger.debug(f"LightSetColor command is for device: {indigo.devices[devID].name}, payload = {message.payload_fields}")
-
-                    for field in message.payload_fields:
-                        if field[0] == "Color":
-                            (hue, saturation, brightness, color) = field[1]
-                            self.setDeviceColor(devID, hue, saturation, brightness, color)
-                            break
-
-                    if message.ack_requested:
-                        target_addr = indigo.devices[devID].pluginProps[MAC_KEY]
-                        replyMessage = Acknowledgement(target_addr, source, seq_num, None, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-                    #                    if message.response_requested:
-                    if True:
-                        try:
-                            label = indigo.devices[devID].pluginProps[ALT_NAME_KEY]
-                        except (Exception,):
-                            label = indigo.devices[devID].name
-
-                        colors = self.getDeviceColor(devID)
-                        power_level = self.getDevicePower(devID)
-                        self.logger.debug(f"LightSetColor response power_level = {power_level}, colors = {colors}")
-
-                        payload = {"color": colors, "power_level": power_level, "label": label, "reserved1": "0", "reserved2": "0"}
-                        target_addr = indigo.devices[devID].pluginProps[MAC_KEY]
-                        replyMessage = LightState(target_addr, source, seq_num, payload, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-        elif message.message_type == MSG_IDS[LightState]:  # 107
-
-            for devID, alias in self.publishedDevices.items():
-
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-
-                    self.logger.debug(f"LightState message for device {devID} - not supported!")
-
-                    if message.ack_requested:
-                        self.logger.debug("Oops!  Client wants an ACK")
-                    if message.response_requested:
-                        self.logger.debug("Oops!  Client wants a response")
-
-        elif message.message_type == MSG_IDS[LightGetPower]:  # 116
-
-            for devID, alias in self.publishedDevices.items():
-
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY] or message.tagged:
-
-                    self.logger.debug(f"LightGetPower message, replying for: {indigo.devices[devID].name}")
-
-                    payload = {"power_level": self.getDeviceBrightness(devID)}
-                    target_addr = indigo.devices[devID].pluginProps[MAC_KEY]
-                    replyMessage = LightStatePower(target_addr, source, seq_num, payload, False, False)
-                    self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-                    if message.ack_requested:
-                        replyMessage = Acknowledgement(target_addr, source, seq_num, None, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-        elif message.message_type == MSG_IDS[LightSetPower]:  # 117
-
-            for devID, alias in self.publishedDevices.items():
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-                    self.logger.debug(f"LightSetPower command is for device: '{indigo.devices[devID].name}', payload_fields = '{message.payload_fields}'")
-
-                    for field in message.payload_fields:
-                        if field[0] == "Power Level":
-                            self.turnOnOffDevice(devID, field[1])
-                            break
-
-                    if message.ack_requested:
-                        target_addr = indigo.devices[devID].pluginProps[MAC_KEY]
-                        replyMessage = Acknowledgement(target_addr, source, seq_num, None, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-                    if message.response_requested:
-                        payload = {"power_level": self.getDevicePower(devID)}
-                        target_addr = indigo.devices[devID].pluginProps[MAC_KEY]
-                        replyMessage = LightStatePower(target_addr, source, seq_num, payload, False, False)
-                        self.sock.sendto(replyMessage.packed_message, (ip_addr, port))
-
-        elif message.message_type == MSG_IDS[LightStatePower]:  # 118
-
-            for devID, alias in self.publishedDevices.items():
-                if message.target_addr == indigo.devices[devID].pluginProps[MAC_KEY]:
-                    self.logger.debug(f"LightStatePower message for device {devID} - not supported!")
-
-                    if message.ack_requested:
-                        self.logger.debug("Oops!  Client wants an ACK")
-                    if message.response_requested:
-                        self.logger.debug("Oops!  Client wants a response")
+            strip = ZoneStrip(next_strip_id(strips), name, folderId, deviceIds, bytearray(os.urandom(16)))
+        strips.append(strip)
+        self.saveZoneStrips(strips)
+        self.logger.info(f"Zone strip {name} {'updated' if existing else 'added'}")
+
+        valuesDict["stripName"] = ""
+        valuesDict["stripFolder"] = 0
+        valuesDict["stripDevices"] = []
+        return valuesDict
 
-        else:
-            self.logger.debug(f"Unknown message type from {ip_addr}:{port}\n{message}")
+    def deleteZoneStrips(self, valuesDict, typeId=None, devId=None):
+        selected = {int(stripId) for stripId in valuesDict.get("zoneStripList", [])}
+        self.saveZoneStrips([strip for strip in self.loadZoneStrips() if strip.id not in selected])
+        for stripId in selected:
+            self.registry.remove(stripId)
+        return valuesDict
 
     ########################################
-    # Method called from lifxRespond() to turn on/off a device
-    #
-    #   deviceId is the ID of the device in Indigo
-    #   turnOn is a boolean to indicate on/off
+    # Save the packet capture ring to a pcap file in the plugin's log folder
     ########################################
-    def turnOnOffDevice(self, deviceId, turnOn):
-        self.logger.debug(f"Set on state of device {deviceId:d} to {turnOn}")
+    def saveCapture(self):
+        folder = indigo.server.getLogsFolderPath(pluginId=self.pluginId)
+        path = os.path.join(folder, f"capture-{time.strftime('%Y%m%d-%H%M%S')}.pcap")
         try:
-            if turnOn:
-                indigo.device.turnOn(deviceId)
-            else:
-                indigo.device.turnOff(deviceId)
-        except (Exception,):
-            self.logger.error(f"Device with id {deviceId:d} doesn't exist. The device list will be rebuilt.")
-            self.refreshDeviceList()
+            count = self.engine.save_capture(path)
+        except (IOError, OSError) as err:
+            self.logger.error(f"Unable to save packet capture: {err}")
+            return
+        self.logger.info(f"Saved {count} packets to {path}")
 
     ########################################
-    # Method called from lifxRespond() to set brightness of a device
-    #
-    #   deviceId is the ID of the device in Indigo
-    #   brightness is in the range 0-65535 (LIFX range)
+    # Bridge statistics
     ########################################
-    def setDeviceBrightness(self, deviceId, brightness):
-        try:
-            iDev = indigo.devices[deviceId]
-        except (Exception,):
-            self.logger.error(f"Device with id {deviceId:d} doesn't exist. The device list will be rebuilt.")
-            self.refreshDeviceList()
-            return
-        if isinstance(iDev, indigo.DimmerDevice):
-            adjusted = int((brightness / 65535.0) * 100.0)  # adjust to Indigo range
-            self.logger.debug(f"setDeviceBrightness: {deviceId:d} to {brightness:d}")
-            indigo.dimmer.setBrightness(iDev, value=adjusted)
-        else:
-            self.logger.debug(f"Device with id {deviceId:d} doesn't support dimming.")
+    def printStatistics(self):
+        for line in self.engine.metrics.report():
+            self.logger.info(line)
 
     ########################################
-    # Method called from lifxRespond() to get the brightness of a device
-    #
-    #   deviceId is the ID of the device in Indigo
-    #   brightness is in the range 0-65535 (LIFX range)
+    # Start the worker processes.  The engine in the plugin process keeps the device registry and runs the
+    # commands the workers send back, so Indigo is only ever called from here.  If the workers can't be
+    # started, the plugin answers the clients itself rather than leaving them with no answer at all.
     ########################################
-    def getDeviceBrightness(self, deviceId):
+    def startWorkers(self):
+        from lifxbridge.workers import WorkerPool      # multiprocessing is only needed when workers are turned on
+        executable = WORKER_PYTHON if os.path.exists(WORKER_PYTHON) else None
+        self.workers = WorkerPool(self.engine, self.workerCount, self.logLevel, executable)
         try:
-            iDev = indigo.devices[deviceId]
-        except (Exception,):
-            self.logger.error(f"Device with id {deviceId} doesn't exist. The device list will be rebuilt.")
-            self.refreshDeviceList()
-            return
-
-        if isinstance(iDev, indigo.DimmerDevice):
-            brightness = int((float(iDev.brightness) / 100.0) * 65535)  # adjust to LIFX range
-        else:
-            brightness = int(iDev.onState) * 65535
-        self.logger.debug(f"getDeviceBrightness: {deviceId} is {brightness}")
-        return brightness
+            self.workers.start()
+        except socket.error as err:
+            self.logger.error(f"LIFX workers failed to start: {err}")
+            self.logger.warning("Falling back to answering LIFX requests from the plugin process")
+            self.workers = None
+            self.workerCount = 0
+            self.openEngine()
+            self.engine.schedule_refresh()     # publish the zone strips
 
     ########################################
-    # Method called from lifxRespond() to set color of a device
-    #
-    #   deviceId is the ID of the device in Indigo
-    #    hue, saturation, brightness are in the range 0-65535 (LIFX range)
+    # Request tracing
     ########################################
-    def setDeviceColor(self, deviceId, hue, saturation, brightness, color):
-        self.logger.debug(f"setDeviceColor for {deviceId}: hue = {hue}, saturation = {saturation}, brightness = {brightness}, color = {color}")
-        try:
-            iDev = indigo.devices[deviceId]
-        except (Exception,):
-            self.logger.error(f"Device with id {deviceId:d} doesn't exist. The device list will be rebuilt.")
-            self.refreshDeviceList()
-            return
-
-        if isinstance(iDev, indigo.DimmerDevice):
-            if not iDev.supportsRGB:
-                adjusted = int(round(float(brightness / 65535.0) * 100.0))  # adjust to Indigo range
-                self.logger.debug(f"setDeviceColor: {deviceId:d} to {adjusted:d} (non-RGB)")
-                indigo.dimmer.setBrightness(iDev, value=adjusted)
-                return
-            else:
-                adj_hue = float(hue) / 65535.0
-                adj_sat = float(saturation) / 65535.0
-                adj_val = float(brightness) / 65535.0
-                self.logger.debug(f"setDeviceColor adjusted: hue = {adj_hue}, saturation = {adj_sat}, brightness = {adj_val}")
-                rgb_color = colorsys.hsv_to_rgb(adj_hue, adj_sat, adj_val)
-                self.logger.debug(f"setDeviceColor hsv_to_rgb = {rgb_color}")
-                adj_red = (rgb_color[0] * 100.0)
-                adj_green = (rgb_color[1] * 100.0)
-                adj_blue = (rgb_color[2] * 100.0)
-                self.logger.debug(f"setColorLevels: {deviceId} to red = {adj_red}, green = {adj_green}, blue = {adj_blue}")
-                indigo.dimmer.setColorLevels(iDev, adj_red, adj_green, adj_blue, 0, 0, 0)
-        else:
-            self.logger.debug(f"Device with id {deviceId} doesn't support dimming.")
+    def configureTracing(self, prefs):
+        self.engine.tracer.slow_threshold = float(prefs.get("slowRequestThreshold", 250)) / 1000.0
+        self.engine.tracer.enable(bool(prefs.get("traceRequests", False)))
 
     ########################################
-    # Method called from lifxRespond() to get the color of a device
-    #
-    #   deviceId is the ID of the device in Indigo
-    #   brightness is in the range 0-65535 (LIFX range)
+    # Packet debug logging follows the Indigo log level, not the plugin log file's
     ########################################
-    def getDeviceColor(self, deviceId):
-        try:
-            iDev = indigo.devices[deviceId]
-        except (Exception,):
-            self.logger.error(f"Device with id {deviceId:d} doesn't exist. The device list will be rebuilt.")
-            self.refreshDeviceList()
-            return
+    def configurePacketLog(self, prefs):
+        packetLog = self.engine.packet_log
+        packetLog.sample_every = int(prefs.get("packetLogSample", 1))
+        packetLog.summary_interval = float(prefs.get("packetLogSummary", 60))
+        packetLog.refresh(self.logLevel)
 
-        if isinstance(iDev, indigo.DimmerDevice):
-            if not iDev.supportsRGB:
-                adj_hue = 0
-                adj_sat = 0
-                adj_val = int((iDev.brightness / 100.0) * 65535)
-                temp = 3000
+    ########################################
+    # Fades and waveforms.  Turned off, timed commands take effect at once and waveforms are ignored.
+    ########################################
+    def configureTransitions(self, prefs):
+        transitions = self.engine.transitions
+        transitions.step_interval = float(prefs.get("transitionStepInterval", 250)) / 1000.0
+        transitions.max_steps_per_second = int(prefs.get("transitionMaxSteps", 20))
+        transitions.enabled = bool(prefs.get("transitions", True))
 
-            else:
-                red = iDev.redLevel / 100.0  # normalize first
-                green = iDev.greenLevel / 100.0
-                blue = iDev.blueLevel / 100.0
-                hsv_color = colorsys.rgb_to_hsv(red, green, blue)
-
-                adj_hue = int(hsv_color[0] * 65535)  # convert to LIFX
-                adj_sat = int(hsv_color[1] * 65535)
-                adj_val = int(hsv_color[2] * 65535)
-                temp = iDev.whiteTemperature
-                if not temp:
-                    temp = 3000
+    ########################################
+    # Per-client request budgets.  Worker processes get the settings they start with.
+    ########################################
+    def configureRateLimit(self, prefs):
+        rates = {DISCOVERY: float(prefs.get("rateLimitDiscovery", 1)), QUERY: float(prefs.get("rateLimitQueries", 100)),
+                 SET: float(prefs.get("rateLimitSets", 20))}
+        self.engine.limiter.configure(bool(prefs.get("rateLimit", True)), budgets_for(rates),
+                                      block_seconds=float(prefs.get("rateLimitBlock", 60)))
 
-        else:
-            adj_hue = 0
-            adj_sat = 0
-            adj_val = int(iDev.onState * 65535)
-            temp = 3000
+    def printTraces(self):
+        for line in self.engine.tracer.report():
+            self.logger.info(line)
 
-        self.logger.debug(f"getDeviceColor of device {deviceId}: hue = {adj_hue}, sat = {adj_sat}, val = {adj_val}, temp = {temp}")
-        return adj_hue, adj_sat, adj_val, temp
+    def printAllocations(self):
+        for line in self.engine.allocations.report():
+            self.logger.info(line)
 
     ########################################
-    # Method called from lifxRespond() to get the power state of a device
-    #
-    #   deviceId is the ID of the device in Indigo
-    #   brightness is in the range 0-65535 (LIFX range)
+    # Profile the receive thread for a while.  The profile starts the next time the thread goes round its loop.
     ########################################
-    def getDevicePower(self, deviceId):
+    def startProfiling(self, valuesDict, typeId):
+        errorDict = indigo.Dict()
         try:
-            dev = indigo.devices[deviceId]
-        except (Exception,):
-            self.logger.error(f"Device with id {deviceId:d} doesn't exist. The device list will be rebuilt.")
-            self.refreshDeviceList()
-            return
-        return int(dev.onState) * 65535
+            seconds = float(valuesDict.get("profileSeconds", 60))
+            if seconds <= 0:
+                raise ValueError
+        except ValueError:
+            errorDict["profileSeconds"] = "Must be a number of seconds"
+            return False, valuesDict, errorDict
+
+        mode = valuesDict.get("profileMode", "sampling")
+        extension = "pstats" if mode == MODE_CPROFILE else "folded"
+        folder = indigo.server.getLogsFolderPath(pluginId=self.pluginId)
+        path = os.path.join(folder, f"profile-{time.strftime('%Y%m%d-%H%M%S')}.{extension}")
+        if not self.engine.profiler.request(mode, seconds, path):
+            errorDict["profileMode"] = "A profile is already running"
+            return False, valuesDict, errorDict
+        return True, valuesDict
+
+    ########################################
+    # (Re)start the loopback Prometheus endpoint on port, or just stop it if port is 0
+    ########################################
+    def startMetricsServer(self, port):
+        if self.metricsServer:
+            if self.metricsServer.port == port:
+                return
+            self.metricsServer.close()
+            self.metricsServer = None
+        if port:
+            try:
+                self.metricsServer = MetricsServer(self.engine.metrics, port)
+                self.logger.info(f"Serving bridge statistics at http://127.0.0.1:{port}/metrics")
+            except socket.error as err:
+                self.logger.error(f"Unable to start the statistics endpoint on port {port}: {err}")
+
+    ########################################
+    # Copy the summary statistics into Indigo variables (created in their own folder as needed) so triggers
+    # can watch them.  request_rate is requests per second since the last update.
+    ########################################
+    def updateMetricsVariables(self):
+        now = time.time()
+        summary = self.engine.metrics_summary()
+        if self.lastPacketsIn is not None:
+            summary["request_rate"] = round((summary["packets_in"] - self.lastPacketsIn[1]) / (now - self.lastPacketsIn[0]), 2)
+        self.lastPacketsIn = (now, summary["packets_in"])
+        self.nextMetricsUpdate = now + self.metricsInterval
+
+        try:
+            if METRICS_FOLDER in indigo.variables.folders:
+                folderId = indigo.variables.folders[METRICS_FOLDER].id
+            else:
+                folderId = indigo.variables.folder.create(METRICS_FOLDER).id
+            for key, value in summary.items():
+                name = METRICS_VARIABLE_PREFIX + key
+                value = "" if value is None else str(value)
+                if name in indigo.variables:
+                    indigo.variable.updateValue(name, value=value)
+                else:
+                    indigo.variable.create(name, value=value, folder=folderId)
+        except Exception as err:
+            self.logger.error(f"Unable to update statistics variables: {err}")